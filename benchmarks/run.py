@@ -0,0 +1,208 @@
+"""
+Benchmarks of the loading, filtering and marker extraction hot paths on synthetic exports.
+Runs offline, results are saved as JSON (one file per run, named after the commit) so they
+can be compared across commits:
+
+    python -m benchmarks.run
+    python -m benchmarks.run --sizes 1 5 20 --repeat 7
+    python -m benchmarks.run --compare benchmarks/results/old.json benchmarks/results/new.json
+"""
+
+import gc
+import json
+import time
+import argparse
+import platform
+import datetime
+import tempfile
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+from benchmarks.synthetic import write_synthetic_cohort, PHOTO_STEP
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+def measure(func, repeat=5, number=1):
+    """Time func (best of repeat runs of number calls), after one warm-up call"""
+    func()
+    timings = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            timings.append((time.perf_counter() - start) / number)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return {
+        "min": min(timings),
+        "median": float(np.median(timings)),
+        "mean": float(np.mean(timings)),
+        "repeat": repeat,
+        "number": number,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_benchmarks(sizes=(1, 5, 20), repeat=5, samples=1024, skip_model=False):
+    """
+    Run all the benchmarks.
+    params:
+    - sizes: Cohort sizes (number of patients, 2 visits each) for ERGFeatureExtractor.extract_all_features
+    - repeat: Number of timed runs of each benchmark
+    - samples: Number of samples of the synthetic traces
+    - skip_model: Do not benchmark the GRU (evaluate), e.g. if torch is not installed
+    returns:
+    - dict benchmark name -> timings (see measure)
+    """
+    from birdshot.io.cache import set_recording_cache
+    from birdshot.io.files import list_patients
+    from birdshot.io.load import load_patient
+    from birdshot.analysis.cache import set_analysis_cache
+    from birdshot.analysis.engine import ERGFeatureExtractor, iter_cohort_features
+    from birdshot.analysis.filter import low_pass_filter
+    from birdshot.analysis.markers import (
+        extract_f30_analysis,
+        extract_scoto_rod_analysis,
+        extract_scoto_rod_cone_analysis,
+    )
+
+    # Measure the actual work, not the caches
+    set_recording_cache(None)
+    set_analysis_cache(maxsize=0)
+
+    results = dict()
+    with tempfile.TemporaryDirectory() as tmp:
+        root = write_synthetic_cohort(Path(tmp) / "single", patients=1, visits=1, samples=samples)
+        files = list_patients(root)["Patient 001"]
+        scoto = load_patient(files["Scoto"][0])
+        f30 = load_patient(files["F30"][0])
+        photo = load_patient(files["Photo"][0])
+
+        results["load_patient"] = measure(lambda: load_patient(files["Scoto"][0]), repeat)
+        results["low_pass_filter"] = measure(lambda: low_pass_filter(scoto, 75), repeat)
+        results["extract_scoto_rod_analysis"] = measure(
+            lambda: extract_scoto_rod_analysis(scoto, filtered=75), repeat
+        )
+        results["extract_scoto_rod_cone_analysis"] = measure(
+            lambda: extract_scoto_rod_cone_analysis(scoto, filtered=75), repeat
+        )
+        results["extract_f30_analysis"] = measure(
+            lambda: extract_f30_analysis(f30, filtered=150), repeat
+        )
+        if not skip_model:
+            from birdshot.analysis.markers import get_GRU_model
+            from birdshot.analysis.models import evaluate
+
+            model = get_GRU_model()
+            traces = np.stack(
+                [photo[(PHOTO_STEP, "OD")].to_numpy(), photo[(PHOTO_STEP, "OS")].to_numpy()]
+            )
+            results["evaluate"] = measure(lambda: evaluate(model, traces), repeat)
+
+        for size in sizes:
+            root = write_synthetic_cohort(
+                Path(tmp) / f"cohort_{size}", patients=size, visits=2, samples=samples
+            )
+            patients = list_patients(root)
+
+            def extract_cohort():
+                for patient_files in patients.values():
+                    ERGFeatureExtractor(
+                        patient_files=patient_files, plot=False, verbose=False
+                    ).extract_all_features()
+
+            results[f"extract_all_features[{size}]"] = measure(
+                extract_cohort, repeat=max(1, repeat // size)
+            )
+
+            def extract_cohort_stacked():
+                for _ in iter_cohort_features(
+                    patients, max_workers=1, chunk_size=2 * size, verbose=False
+                ):
+                    pass
+
+            results[f"extract_cohort_stacked[{size}]"] = measure(
+                extract_cohort_stacked, repeat=max(1, repeat // size)
+            )
+    return results
+
+
+def save_results(results, directory=RESULTS_DIR):
+    commit = git_commit()
+    now = datetime.datetime.now()
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    filepath = directory / f"{now:%Y%m%d-%H%M%S}_{commit}.json"
+    with open(filepath, "w") as f:
+        json.dump(
+            {
+                "commit": commit,
+                "date": now.isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "machine": platform.platform(),
+                "benchmarks": results,
+            },
+            f,
+            indent=2,
+        )
+    return filepath
+
+
+def compare(old_filepath, new_filepath, threshold=1.1):
+    """Print the ratio new/old of the minimum timings, flagging the regressions above threshold"""
+    with open(old_filepath) as f:
+        old = json.load(f)
+    with open(new_filepath) as f:
+        new = json.load(f)
+    print(f"{'benchmark':<40}{old['commit']:>12}{new['commit']:>12}{'ratio':>8}")
+    for name, timing in new["benchmarks"].items():
+        if name not in old["benchmarks"]:
+            continue
+        before = old["benchmarks"][name]["min"]
+        after = timing["min"]
+        ratio = after / before
+        flag = "  regression" if ratio > threshold else ""
+        print(f"{name:<40}{before * 1000:>10.2f}ms{after * 1000:>10.2f}ms{ratio:>8.2f}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the birdshot benchmarks")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 5, 20])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--samples", type=int, default=1024)
+    parser.add_argument("--skip-model", action="store_true")
+    parser.add_argument("--output", default=str(RESULTS_DIR))
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = run_benchmarks(args.sizes, args.repeat, args.samples, args.skip_model)
+    for name, timing in results.items():
+        print(f"{name:<40}{timing['min'] * 1000:>10.2f}ms")
+    print(f"Saved to {save_results(results, args.output)}")
+
+
+if __name__ == "__main__":
+    main()
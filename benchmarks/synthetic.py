@@ -0,0 +1,133 @@
+"""
+Synthetic ERG exports with the .TXT layout expected by birdshot.io.load, so the benchmarks
+can run without patient data.
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+PHOTO_STEP = 13
+MARKERS = (("a", 15.0), ("b", 32.0), ("i", 60.0))
+
+
+def gaussian(time, center, width, amplitude):
+    return amplitude * np.exp(-0.5 * ((time - center) / width) ** 2)
+
+
+def synthetic_traces(protocol, time, rng) -> dict:
+    """
+    Plausible traces of a protocol.
+    returns:
+    - dict (step, channel) -> trace in µV, channel 1 is OD and 2 is OS
+    """
+    traces = dict()
+    match protocol:
+        case "Scoto":
+            for step in range(1, 21):
+                for channel in (1, 2):
+                    trace = rng.normal(0, 3, len(time))
+                    if step == 9:
+                        trace += gaussian(time, 90, 20, 150 + 10 * channel)
+                    elif step == 19:
+                        trace += gaussian(time, 20, 5, -150) + gaussian(time, 50, 10, 300)
+                    else:
+                        trace += gaussian(time, 40, 10, 5 * step)
+                    traces[(step, channel)] = trace
+        case "F30":
+            for channel in (1, 2):
+                flicker = 50 * np.sin(2 * np.pi * 30 * time / 1000) * (time > 0)
+                traces[(1, channel)] = flicker + rng.normal(0, 2, len(time))
+        case "Photo":
+            for step in range(1, 16):
+                for channel in (1, 2):
+                    trace = (
+                        gaussian(time, 15, 3, -30)
+                        + gaussian(time, 32, 6, 90)
+                        + gaussian(time, 60, 8, 20)
+                    )
+                    traces[(step, channel)] = trace + rng.normal(0, 2, len(time))
+        case _:
+            raise ValueError(f"Unknown protocol {protocol}")
+    return traces
+
+
+def write_synthetic_export(filepath, protocol, samples=1024, seed=0):
+    """
+    Write a synthetic export of a protocol ("Scoto", "F30" or "Photo").
+    The file has a contents table pointing to a marker, a stimulus and a data table, as the exports
+    of the ERG system. The photopic step at 5.0 cd.s/m2 is PHOTO_STEP.
+    """
+    rng = np.random.default_rng(seed)
+    end = 200 if protocol == "F30" else 250
+    time = np.linspace(-20, end, samples)
+    traces = synthetic_traces(protocol, time, rng)
+    keys = sorted(traces)
+    nsteps = max(step for step, _ in keys)
+
+    header = ["Header Table\tx\tx", f"Protocol\t{protocol}", "DOB\t1962-04-01"]
+    header += ["Gender\tMale", ""]
+    markers = []
+    for step, channel in keys:
+        eye = "RE" if channel == 1 else "LE"
+        for name, ms in MARKERS:
+            markers.append(f"trace\t{step}\t{channel}\t{channel}\t{eye}\t{name}\t{ms}\t10.0")
+    stimuli = [
+        f"{step}\tstep {step}\t{5.0 if step == PHOTO_STEP else step / 10}"
+        for step in range(1, nsteps + 1)
+    ]
+
+    # 1-based line numbers of the tables, as written in the contents table
+    contents_length = 5
+    marker_begin = contents_length + len(header) + 4
+    marker_end = marker_begin + len(markers) - 1
+    stimulus_begin = marker_end + 5
+    stimulus_end = stimulus_begin + len(stimuli) - 1
+    data_begin = stimulus_end + 4
+    data_end = data_begin + samples - 1
+
+    lines = [
+        "Contents Table",
+        f"Marker Table\t1\t{marker_begin}\t8\t{marker_end}",
+        f"Stimulus Table\t1\t{stimulus_begin}\t3\t{stimulus_end}",
+        f"Data Table\t1\t{data_begin}\t{6 + len(keys)}\t{data_end}",
+        "",
+    ]
+    lines += header
+    lines += ["Markers", "Name\tS\tC\tR\tEye\tName\tms\tuV", "\t" * 7] + markers + [""]
+    lines += ["Stimuli", "Step\tDescription\tIntensity", "\t\t"] + stimuli + [""]
+    lines += ["Data"]
+    columns = ["Step", "Trial", "Chan", "Name", "Column", "Time (ms)"]
+    lines.append("\t".join(columns + ["Result (nV)"] * len(keys)))
+    for row in range(samples):
+        if row < len(keys):
+            step, channel = keys[row]
+            # Column index (1-based) of the trace in the data table
+            values = [str(step), "1", str(channel), "x", str(7 + row)]
+        else:
+            values = [""] * 5
+        values.append(f"{time[row]:.3f}")
+        values += [f"{traces[k][row] * 1000:.0f}" for k in keys]
+        lines.append("\t".join(values))
+    Path(filepath).write_text("\n".join(lines) + "\n", encoding="latin-1")
+
+
+def write_synthetic_cohort(root, patients=3, visits=2, samples=1024, seed=0):
+    """
+    Write a cohort in the folder layout expected by list_patients:
+    root/Patient XXX/PXXX (YYYY.MM.DD) {Scoto,Photo,F30}.TXT
+    """
+    root = Path(root)
+    for p in range(1, patients + 1):
+        directory = root / f"Patient {p:03d}"
+        directory.mkdir(parents=True, exist_ok=True)
+        for v in range(visits):
+            date = f"{2015 + v}.{1 + p % 12:02d}.{10 + v % 18}"
+            for protocol in ("Scoto", "Photo", "F30"):
+                write_synthetic_export(
+                    directory / f"P{p:03d} ({date}) {protocol}.TXT",
+                    protocol,
+                    samples=samples,
+                    seed=seed + p * 100 + v,
+                )
+    return root
@@ -0,0 +1,53 @@
+import numpy as np
+import scipy.signal
+
+from birdshot.analysis.cache import memoize
+
+
+def resample(time, values, grid) -> np.ndarray:
+    """
+    Linear resampling of traces on a time grid, NaN outside of the recorded time range.
+    params:
+    - time: array (T,) - Time vector of the traces
+    - values: array (T,) or (T, C) - One trace or several traces sharing the same time vector
+    - grid: array (G,) - The new time vector
+    returns:
+    - np.ndarray (G,) or (G, C)
+    """
+    time = np.asarray(time, dtype=float)
+    values = np.asarray(values, dtype=float)
+    grid = np.asarray(grid, dtype=float)
+    if values.ndim == 1:
+        return np.interp(grid, time, values, left=np.nan, right=np.nan)
+
+    # All the columns share the same interpolation weights
+    right = np.clip(np.searchsorted(time, grid, side="right"), 1, len(time) - 1)
+    left = right - 1
+    weight = (grid - time[left]) / (time[right] - time[left])
+    output = values[left] + (values[right] - values[left]) * weight[:, None]
+    # A grid point exactly on the last sample is kept, points outside the recording are not
+    outside = (grid < time[0]) | (grid > time[-1])
+    output[outside] = np.nan
+    return output
+
+
+def cross_correlation_lag(reference, values) -> int:
+    """
+    Lag (in samples) maximizing the cross-correlation between a reference and a trace, computed with
+    FFTs (O(N log N)). Same value as np.argmax(scipy.signal.correlate(reference, values)) - (len(values) - 1).
+    NaN samples (e.g. outside of the recorded time range) are ignored.
+    """
+    reference = np.nan_to_num(np.asarray(reference, dtype=float))
+    values = np.nan_to_num(np.asarray(values, dtype=float))
+    corr = scipy.signal.correlate(reference, values, mode="full", method="fft")
+    return int(np.argmax(corr)) - (len(values) - 1)
+
+
+@memoize()
+def estimate_lag(reference, values, time) -> float:
+    """
+    Delay (in ms) of a reference (e.g. the normative mean) relative to a trace sampled on time.
+    The result is cached per trace and reference.
+    """
+    time = np.asarray(time, dtype=float)
+    return cross_correlation_lag(reference, values) * (time[1] - time[0])
@@ -0,0 +1,222 @@
+import os
+import pickle
+import hashlib
+import inspect
+import threading
+from pathlib import Path
+from functools import wraps
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from birdshot.io.cache import atomic_write
+from birdshot.analysis.manifest import code_version
+
+
+def fingerprint(obj) -> str:
+    """
+    Cheap fingerprint of an analysis argument.
+    DataFrames, Series and arrays are hashed from their raw values (and labels), which is much cheaper
+    than pickling them. Other values are fingerprinted from their repr.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    if isinstance(obj, pd.DataFrame):
+        h.update(repr((obj.shape, obj.columns.tolist(), obj.dtypes.tolist())).encode())
+        h.update(pd.util.hash_pandas_object(obj.index).values.tobytes())
+        values = obj.to_numpy()
+        if values.dtype == object:
+            h.update(pickle.dumps(values))
+        else:
+            h.update(np.ascontiguousarray(values).tobytes())
+    elif isinstance(obj, pd.Series):
+        return fingerprint(obj.to_frame())
+    elif isinstance(obj, np.ndarray):
+        h.update(repr((obj.shape, obj.dtype)).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    else:
+        h.update(repr(obj).encode())
+    return h.hexdigest()
+
+
+def code_fingerprint(func) -> str:
+    """
+    Fingerprint of the code of a function, so persisted results are not reused after it changes.
+    The source of its whole module and of the analysis modules (see manifest.code_version) is hashed,
+    as the result also depends on the helpers it calls.
+    """
+    h = hashlib.blake2b(Path(inspect.getsourcefile(func)).read_bytes(), digest_size=8)
+    h.update(code_version().encode())
+    return h.hexdigest()
+
+
+class AnalysisCache:
+    """
+    Memoization of analysis results, independent of any UI framework.
+    Results are stored pickled, so callers always get their own copy, in an in-memory LRU bounded
+    both in number of entries and in bytes. If directory is given, results are also persisted on disk
+    and reloaded by later processes. The total size of the persisted results is capped by
+    max_disk_bytes, least recently used results are evicted first.
+    """
+
+    def __init__(
+        self, maxsize=512, max_bytes=256 * 1024**2, directory=None, max_disk_bytes=1024**3
+    ):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.directory = Path(directory) if directory is not None else None
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _disk_path(self, key):
+        return self.directory / f"{key}.pkl"
+
+    def get(self, key):
+        """Return the pickled result stored for key, or None"""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+        if self.directory is not None:
+            path = self._disk_path(key)
+            try:
+                data = path.read_bytes()
+                # Mark the result as recently used
+                os.utime(path)
+            except FileNotFoundError:
+                data = None
+            if data is not None:
+                self._store(key, data)
+                self.hits += 1
+                return data
+        self.misses += 1
+        return None
+
+    def _store(self, key, data):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = data
+            self._size += len(data)
+            while self._entries and (
+                len(self._entries) > self.maxsize or self._size > self.max_bytes
+            ):
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def put(self, key, data):
+        self._store(key, data)
+        if self.directory is not None:
+            path = self._disk_path(key)
+            with atomic_write(path) as f:
+                f.write(data)
+            self.evict_disk(keep=[path])
+
+    def disk_size(self):
+        if self.directory is None:
+            return 0
+        return sum(f.stat().st_size for f in self.directory.glob("*.pkl"))
+
+    def evict_disk(self, keep=()):
+        """
+        Remove the least recently used persisted results until they fit in max_disk_bytes.
+        The results in keep (e.g. the one just written) are never removed.
+        """
+        keep = {Path(f) for f in keep}
+        entries = []
+        total = 0
+        for f in self.directory.glob("*.pkl"):
+            try:
+                stat = f.stat()
+            except FileNotFoundError:
+                continue
+            total += stat.st_size
+            if f not in keep:
+                entries.append((stat.st_mtime_ns, stat.st_size, f))
+        entries.sort(key=lambda x: x[0])
+        for _, size, f in entries:
+            if total <= self.max_disk_bytes:
+                break
+            f.unlink(missing_ok=True)
+            total -= size
+
+    def clear(self, disk=False):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+        if disk and self.directory is not None:
+            for f in self.directory.glob("*.pkl"):
+                f.unlink(missing_ok=True)
+
+
+_analysis_cache = None
+
+
+def set_analysis_cache(
+    maxsize=512, max_bytes=256 * 1024**2, directory=None, max_disk_bytes=1024**3
+):
+    """
+    Configure the cache shared by all the memoized analyses.
+    Passing maxsize=0 disables memoization.
+    By default results are kept in memory only, unless BIRDSHOT_ANALYSIS_CACHE_DIR is set.
+    """
+    global _analysis_cache
+    _analysis_cache = AnalysisCache(maxsize, max_bytes, directory, max_disk_bytes)
+    return _analysis_cache
+
+
+def get_analysis_cache():
+    if _analysis_cache is None:
+        set_analysis_cache(directory=os.environ.get("BIRDSHOT_ANALYSIS_CACHE_DIR"))
+    return _analysis_cache
+
+
+def memoize(ignore=(), skip_if=()):
+    """
+    Memoize an analysis in the shared AnalysisCache.
+    The key is made of the function, a fingerprint of its code and a fingerprint of every argument.
+    params:
+    - ignore: Names of the arguments that do not change the result (e.g. a plot title)
+    - skip_if: Names of the arguments that bypass the cache when truthy (e.g. plot, which has side effects)
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+        code_key = f"{func.__module__}.{func.__qualname__}:{code_fingerprint(func)}"
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            cache = get_analysis_cache()
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            if cache.maxsize == 0 or any(bound.arguments[name] for name in skip_if):
+                return func(*args, **kwargs)
+
+            h = hashlib.blake2b(code_key.encode(), digest_size=16)
+            for name, value in bound.arguments.items():
+                if name in ignore:
+                    continue
+                h.update(f"{name}={fingerprint(value)};".encode())
+            key = h.hexdigest()
+
+            data = cache.get(key)
+            if data is not None:
+                return pickle.loads(data)
+            result = func(*args, **kwargs)
+            cache.put(key, pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+            return result
+
+        return wrapper
+
+    return decorator
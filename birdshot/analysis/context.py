@@ -0,0 +1,66 @@
+from birdshot.io.load import load_patient, get_photo_step_for_patient
+from birdshot.analysis.filter import low_pass_filter, get_step_columns, TIME_COLUMN
+
+
+class AnalysisContext:
+    """
+    Shared state of all the analyses run on one recording of a visit.
+    The recording is loaded on first access and its low-pass filtered steps are memoized,
+    so protocols analysed from the same file (e.g. scotopic rod and rod-cone functions)
+    only pay the I/O and filtering cost once.
+    If a CohortArchive (birdshot.io.archive) holding the file is given, the traces are read from it
+    instead of parsing the export (float32 samples).
+    """
+
+    def __init__(self, filepath, archive=None):
+        self.filepath = filepath
+        self.archive = archive
+        self._traces = None
+        self._filtered = dict()
+        self._photo_trial = None
+
+    def __repr__(self):
+        return f"AnalysisContext(filepath={self.filepath!r})"
+
+    @property
+    def traces(self):
+        if self._traces is None:
+            found = None if self.archive is None else self.archive.find_file(self.filepath)
+            if found is not None:
+                self._traces = self.archive.load_patient(*found)
+            else:
+                self._traces = load_patient(self.filepath)
+        return self._traces
+
+    def load(self):
+        """Load the recording if needed and return the context"""
+        self.traces
+        return self
+
+    def filtered(self, cutoff, step=None):
+        """
+        Return the traces low-pass filtered at cutoff (Hz).
+        If step is given, only the columns of this step (and the time) are filtered and returned.
+        If cutoff is 0, the raw traces are returned.
+        """
+        if not cutoff or cutoff <= 0:
+            return self.traces
+        key = (cutoff, step)
+        if key not in self._filtered:
+            columns = None
+            if step is not None:
+                columns = get_step_columns(self.traces, step)
+            self._filtered[key] = low_pass_filter(self.traces, cutoff, columns=columns)
+        return self._filtered[key]
+
+    def photo_trial(self):
+        """
+        Return the photopic trial (the step at 5.0 cd.s/m2) with "OD", "OS" and "Time (ms)" columns,
+        as expected by extract_photo_markers.
+        """
+        if self._photo_trial is None:
+            step = get_photo_step_for_patient(self.filepath)
+            trial = self.traces[step].copy()
+            trial["Time (ms)"] = self.traces[TIME_COLUMN]
+            self._photo_trial = trial
+        return self._photo_trial
@@ -1,15 +1,23 @@
+import os
 from pathlib import Path
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 from birdshot.io.files import list_patient_files
-from birdshot.io.load import load_patient
+from birdshot.analysis.context import AnalysisContext
+from birdshot.analysis.manifest import AnalysisManifest
 from birdshot.analysis.markers import (
     extract_f30_analysis,
     extract_scoto_rod_analysis,
     extract_scoto_rod_cone_analysis,
-    extract_photo_analysis,
+    extract_photo_markers,
+    extract_stacked_scoto_rod_cone_markers,
+    extract_stacked_scoto_rod_markers,
+    stack_step_traces,
 )
-import datetime
+import numpy as np
 import pandas as pd
 from birdshot.io.utils import extract_visit_date_from_filepath
+from birdshot.io.output import FeatureWriter, open_feature_writer
 
 
 class ERGFeatureExtractor:
@@ -27,6 +35,7 @@ class ERGFeatureExtractor:
         scotorodcone_time_limits=(10, 60),
         scotorod_low_pass=75,
         scotorod_time_limits=(10, 125),
+        archive=None,
     ):
         if patient_folder is None and patient_files is None:
             raise ValueError("Either patient_folder or patient_files must be provided")
@@ -35,6 +44,8 @@ class ERGFeatureExtractor:
         else:
             self.patient_files = patient_files
         self.features_per_visit = dict()
+        # Visits for which an analysis failed, their features are incomplete
+        self.failed_visits = set()
         self.plot = plot
         self.verbose = verbose
         self.f30_low_pass = f30_low_pass
@@ -45,6 +56,25 @@ class ERGFeatureExtractor:
         self.scotorod_low_pass = scotorod_low_pass
         self.scotorod_time_limits = scotorod_time_limits
         self.show_error = show_error
+        self.contexts = dict()
+        # CohortArchive the recordings are read from when packed in it (see AnalysisContext)
+        self.archive = archive
+
+    def get_context(self, filepath) -> AnalysisContext:
+        """Return the analysis context of a file, shared by all the protocols analysed from it"""
+        if filepath not in self.contexts:
+            self.contexts[filepath] = AnalysisContext(filepath, archive=self.archive)
+        return self.contexts[filepath]
+
+    def get_analysis_input(self, context: AnalysisContext, cutoff, step):
+        """
+        Return the traces and the cutoff to pass to an analysis.
+        The filtered step is taken from the context, so the analysis does not filter again.
+        When plotting, the analysis needs the raw traces to overlay them and filters by itself.
+        """
+        if self.plot:
+            return context.traces, cutoff
+        return context.filtered(cutoff, step), 0
 
     def extract_f30_features(self, only_date=None):
         for filepath in self.patient_files["F30"]:
@@ -55,12 +85,14 @@ class ERGFeatureExtractor:
 
             if date not in self.features_per_visit:
                 self.features_per_visit[date] = dict()
-            df = load_patient(filepath)
+            # Errors while loading the file are not caught, as before
+            context = self.get_context(filepath).load()
             try:
+                df, cutoff = self.get_analysis_input(context, self.f30_low_pass, 1)
                 od_peak_amp, os_peak_amp, od_peak_time, os_peak_time = (
                     extract_f30_analysis(
                         df,
-                        filtered=self.f30_low_pass,
+                        filtered=cutoff,
                         prominance=self.f30_prominance,
                         delta=self.f30_delta,
                         plot=self.plot,
@@ -74,6 +106,7 @@ class ERGFeatureExtractor:
                     print(filepath.name)
                     if self.show_error:
                         print(f"With error: {e}")
+                self.failed_visits.add(date)
                 continue
             for i, (od_amp, od_time) in enumerate(zip(od_peak_amp, od_peak_time)):
                 self.features_per_visit[date][f"F30_OD_amp_{i}"] = od_amp
@@ -84,19 +117,21 @@ class ERGFeatureExtractor:
 
     def extract_scoto_rod_features(self, only_date=None):
         for filepath in self.patient_files["Scoto"]:
-            df = load_patient(filepath)
             date = extract_visit_date_from_filepath(filepath)
             if only_date is not None:
                 if date != only_date:
                     continue
             if date not in self.features_per_visit:
                 self.features_per_visit[date] = dict()
+            # Errors while loading the file are not caught, as before
+            context = self.get_context(filepath).load()
             try:
+                df, cutoff = self.get_analysis_input(context, self.scotorod_low_pass, 9)
                 Bamp, B_time_od, B_time_os = extract_scoto_rod_analysis(
                     df,
                     plot=self.plot,
                     title=f"{filepath.name} (Rod function)",
-                    filtered=self.scotorod_low_pass,
+                    filtered=cutoff,
                     time_limits=self.scotorod_time_limits,
                 )
             except Exception as e:
@@ -106,6 +141,7 @@ class ERGFeatureExtractor:
                     print(filepath.name)
                     if self.show_error:
                         print(f"With error: {e}")
+                self.failed_visits.add(date)
                 continue
             self.features_per_visit[date]["Scoto_rod_B_amp_OS"] = Bamp["OS"]
             self.features_per_visit[date]["Scoto_rod_B_time_OS"] = B_time_os
@@ -114,7 +150,6 @@ class ERGFeatureExtractor:
 
     def extract_scoto_rod_cone_features(self, only_date=None):
         for filepath in self.patient_files["Scoto"]:
-            df = load_patient(filepath)
             date = extract_visit_date_from_filepath(filepath)
 
             if only_date is not None:
@@ -122,14 +157,18 @@ class ERGFeatureExtractor:
                     continue
             if date not in self.features_per_visit:
                 self.features_per_visit[date] = dict()
-
+            # Errors while loading the file are not caught, as before
+            context = self.get_context(filepath).load()
             try:
+                df, cutoff = self.get_analysis_input(
+                    context, self.scotorodcone_low_pass, 19
+                )
                 B_amplitude, A_amplitude, B_time_od, A_time_od, B_time_os, A_time_os = (
                     extract_scoto_rod_cone_analysis(
                         df,
                         plot=self.plot,
                         title=f"{filepath.name} (Rod-cone function)",
-                        filtered=self.scotorodcone_low_pass,
+                        filtered=cutoff,
                         time_limits=self.scotorodcone_time_limits,
                     )
                 )
@@ -140,6 +179,7 @@ class ERGFeatureExtractor:
                     print(filepath.name)
                     if self.show_error:
                         print(f"With error: {e}")
+                self.failed_visits.add(date)
                 continue
             self.features_per_visit[date]["Scoto_rod_cone_B_amp_OS"] = B_amplitude["OS"]
             self.features_per_visit[date]["Scoto_rod_cone_B_time_OS"] = B_time_os
@@ -151,34 +191,62 @@ class ERGFeatureExtractor:
             self.features_per_visit[date]["Scoto_rod_cone_A_time_OD"] = A_time_od
 
     def extract_photo_features(self, only_date=None):
+        entries = []
         for filepath in self.patient_files["Photo"]:
-            df = load_patient(filepath)
             date = extract_visit_date_from_filepath(filepath)
             if only_date is not None:
                 if date != only_date:
                     continue
             if date not in self.features_per_visit:
                 self.features_per_visit[date] = dict()
+            # Errors while loading the file are not caught, as before
+            entries.append((self, date, filepath, self.get_context(filepath).load()))
+        extract_batched_photo_features(entries)
 
-            try:
-                extract_photo_analysis(
-                    df, plot=self.plot, title=f"{filepath.name} (Photo function)"
-                )
-
-            except Exception as e:
-                if self.verbose:
-                    if self.show_error:
-                        print("Failed to process photo analysis")
-                    print(filepath.name)
-                    if self.show_error:
-                        print(f"With error: {e}")
-                continue
+    def get_params(self):
+        """Parameters of the analyses, the extracted features only depend on them and on the files"""
+        return dict(
+            f30_low_pass=self.f30_low_pass,
+            f30_prominance=self.f30_prominance,
+            f30_delta=self.f30_delta,
+            scotorodcone_low_pass=self.scotorodcone_low_pass,
+            scotorodcone_time_limits=self.scotorodcone_time_limits,
+            scotorod_low_pass=self.scotorod_low_pass,
+            scotorod_time_limits=self.scotorod_time_limits,
+        )
 
-    def extract_all_features(self):
-        self.extract_scoto_rod_cone_features()
-        self.extract_scoto_rod_features()
-        self.extract_f30_features()
-        self.extract_photo_features()
+    def extract_all_features(self, manifest: AnalysisManifest = None):
+        """
+        Extract the features of all the visits.
+        If a manifest is given, the visits whose files, analysis parameters and analysis code did not
+        change since they were recorded in it are not analysed again, their previous features are reused.
+        The manifest is updated with the analysed visits, except those for which an analysis failed,
+        saving it is left to the caller.
+        """
+        if manifest is None:
+            self.extract_scoto_rod_cone_features()
+            self.extract_scoto_rod_features()
+            self.extract_f30_features()
+            self.extract_photo_features()
+        else:
+            params = self.get_params()
+            visits = split_patient_files_by_visit(self.patient_files)
+            for date, visit_files in visits.items():
+                features = manifest.get(date, visit_files, params)
+                if features is not None:
+                    self.features_per_visit[date] = features
+                    continue
+                self.extract_scoto_rod_cone_features(only_date=date)
+                self.extract_scoto_rod_features(only_date=date)
+                self.extract_f30_features(only_date=date)
+                self.extract_photo_features(only_date=date)
+                # Visits with a failed analysis are analysed again next time
+                if date not in self.failed_visits:
+                    features = self.features_per_visit.get(date, dict())
+                    manifest.update(date, visit_files, params, features)
+                self.contexts.clear()
+        # The recordings are not needed anymore once every protocol was analysed
+        self.contexts.clear()
         return self.features_per_visit
 
     def format_results(self):
@@ -203,6 +271,10 @@ class ERGFeatureExtractor:
                 techniques.append("Photopic Flicker30HZ (cone function)")
                 waves.append("b-wave")
 
+            elif "Photo" in index:
+                techniques.append("Photopic (cone function)")
+                waves.append(f"{index.split('_')[1].lower()}-wave")
+
             elif "Scoto_rod_cone" in index:
                 techniques.append("Scotopic (rod-cone function)")
                 if "_B_" in index:
@@ -224,3 +296,340 @@ class ERGFeatureExtractor:
         )
         df.sort_index()
         return df
+
+
+def split_patient_files_by_visit(patient_files: dict) -> dict:
+    """
+    Split the files of a patient (as returned by list_patient_files) by visit date.
+    returns a dictionary date -> {"Scoto": [...], "Photo": [...], "F30": [...]}
+    Dates are ordered as ERGFeatureExtractor.extract_all_features would first encounter them.
+    """
+    visits = dict()
+    for protocol in ["Scoto", "F30", "Photo"]:
+        for filepath in patient_files.get(protocol, []):
+            date = extract_visit_date_from_filepath(filepath)
+            if date not in visits:
+                visits[date] = {"Scoto": [], "Photo": [], "F30": []}
+            visits[date][protocol].append(filepath)
+    return visits
+
+
+def _report_error(featex: ERGFeatureExtractor, filepath, analysis, error):
+    featex.failed_visits.add(extract_visit_date_from_filepath(filepath))
+    if featex.verbose:
+        if featex.show_error:
+            print(f"Failed to process {analysis}")
+        print(filepath.name)
+        if featex.show_error:
+            print(f"With error: {error}")
+
+
+def _extract_stacked_step(entries, step, cutoff, time_limits, kernel, analysis):
+    """
+    Filter one step of each recording, stack them and run a stacked kernel.
+    returns the entries that could be analysed and the kernel outputs, aligned with them
+    """
+    trials = []
+    kept = []
+    for entry in entries:
+        featex, _, filepath, context = entry
+        try:
+            trial = context.filtered(cutoff, step)
+            missing = [(step, eye) for eye in ("OD", "OS") if (step, eye) not in trial]
+            if missing:
+                raise KeyError(missing)
+        except Exception as e:
+            _report_error(featex, filepath, analysis, e)
+            continue
+        trials.append(trial)
+        kept.append(entry)
+    if not kept:
+        return [], None
+
+    traces, time = stack_step_traces(trials, step)
+    markers = kernel(traces, time, time_limits)
+    # As with the per-file analyses, recordings without samples in the time limits of a wave
+    # (B, and A for the rod-cone function) have no features
+    analysed = ~np.any(
+        [np.isnan(markers[k]).any(axis=1) for k in ["A_time", "B_time"] if k in markers],
+        axis=0,
+    )
+    for entry in np.asarray(kept, dtype=object)[~analysed]:
+        _report_error(entry[0], entry[2], analysis, "No samples in the time limits")
+    return [(r, entry) for r, entry in enumerate(kept) if analysed[r]], markers
+
+
+def extract_stacked_scoto_features(extractors: list):
+    """
+    Scotopic rod-cone and rod features of the Scoto files of several extractors (e.g. the visits of
+    a cohort), computed with the stacked kernels of birdshot.analysis.markers in a few array
+    reductions instead of one pandas analysis per file.
+    Equivalent to calling extract_scoto_rod_cone_features then extract_scoto_rod_features on each
+    extractor. Extractors that plot use the per-file analyses.
+    """
+    entries = []
+    for featex in extractors:
+        if featex.plot:
+            featex.extract_scoto_rod_cone_features()
+            featex.extract_scoto_rod_features()
+            continue
+        for filepath in featex.patient_files["Scoto"]:
+            date = extract_visit_date_from_filepath(filepath)
+            if date not in featex.features_per_visit:
+                featex.features_per_visit[date] = dict()
+            # Errors while loading the file are not caught, as in the per-file analyses
+            entries.append((featex, date, filepath, featex.get_context(filepath).load()))
+
+    # Recordings are stacked per set of analysis parameters
+    groups = dict()
+    for entry in entries:
+        featex = entry[0]
+        key = (featex.scotorodcone_low_pass, tuple(featex.scotorodcone_time_limits))
+        groups.setdefault(key, []).append(entry)
+    for (cutoff, time_limits), group in groups.items():
+        analysed, markers = _extract_stacked_step(
+            group,
+            19,
+            cutoff,
+            time_limits,
+            extract_stacked_scoto_rod_cone_markers,
+            "scoto rod cone analysis",
+        )
+        for r, (featex, date, _, _) in analysed:
+            features = featex.features_per_visit[date]
+            for eye, e in [("OS", 1), ("OD", 0)]:
+                features[f"Scoto_rod_cone_B_amp_{eye}"] = markers["B_amplitude"][r, e]
+                features[f"Scoto_rod_cone_B_time_{eye}"] = markers["B_time"][r, e]
+                features[f"Scoto_rod_cone_A_amp_{eye}"] = markers["A_amplitude"][r, e]
+                features[f"Scoto_rod_cone_A_time_{eye}"] = markers["A_time"][r, e]
+
+    groups = dict()
+    for entry in entries:
+        featex = entry[0]
+        key = (featex.scotorod_low_pass, tuple(featex.scotorod_time_limits))
+        groups.setdefault(key, []).append(entry)
+    for (cutoff, time_limits), group in groups.items():
+        analysed, markers = _extract_stacked_step(
+            group,
+            9,
+            cutoff,
+            time_limits,
+            extract_stacked_scoto_rod_markers,
+            "scoto rod analysis",
+        )
+        for r, (featex, date, _, _) in analysed:
+            features = featex.features_per_visit[date]
+            for eye, e in [("OS", 1), ("OD", 0)]:
+                features[f"Scoto_rod_B_amp_{eye}"] = markers["B_amplitude"][r, e]
+                features[f"Scoto_rod_B_time_{eye}"] = markers["B_time"][r, e]
+
+
+def extract_batched_photo_features(entries: list):
+    """
+    Photopic a, b and i features of several Photo files (e.g. the visits of a cohort), the traces of
+    all the files are scored together by the GRU model (see extract_photo_markers).
+    params:
+    - entries: list of (ERGFeatureExtractor, visit date, filepath, AnalysisContext) - The features are
+    stored in the features_per_visit of the extractor
+    """
+    trials = []
+    kept = []
+    for entry in entries:
+        featex, _, filepath, context = entry
+        try:
+            trials.append(context.photo_trial())
+        except Exception as e:
+            _report_error(featex, filepath, "photo analysis", e)
+            continue
+        kept.append(entry)
+    if not kept:
+        return
+    try:
+        markers = extract_photo_markers(trials)
+    except Exception as e:
+        for featex, _, filepath, _ in kept:
+            _report_error(featex, filepath, "photo analysis", e)
+        return
+    for (featex, date, _, _), results in zip(kept, markers):
+        features = featex.features_per_visit[date]
+        for eye in ["OS", "OD"]:
+            for label in ["a", "b", "i"]:
+                (time,), (amplitude,) = results[f"{eye} {label}"]
+                features[f"Photo_{label.upper()}_amp_{eye}"] = float(amplitude)
+                features[f"Photo_{label.upper()}_time_{eye}"] = float(time)
+
+
+def _extract_visits_features(visits_files: list, params: dict, stacked=False):
+    """
+    Extract the features of several visits.
+    If stacked, the scotopic features of all the visits are computed at once with the stacked kernels.
+    returns a list of (features_per_visit, failed_visits), one per visit
+    """
+    extractors = [
+        ERGFeatureExtractor(patient_files=visit_files, **params)
+        for visit_files in visits_files
+    ]
+    if not stacked:
+        for featex in extractors:
+            featex.extract_all_features()
+    else:
+        extract_stacked_scoto_features(extractors)
+        for featex in extractors:
+            featex.extract_f30_features()
+        # One forward pass of the GRU model for the photopic trials of the whole chunk
+        entries = []
+        for featex in extractors:
+            for filepath in featex.patient_files["Photo"]:
+                date = extract_visit_date_from_filepath(filepath)
+                featex.features_per_visit.setdefault(date, dict())
+                entries.append((featex, date, filepath, featex.get_context(filepath).load()))
+        extract_batched_photo_features(entries)
+        for featex in extractors:
+            featex.contexts.clear()
+    return [(featex.features_per_visit, featex.failed_visits) for featex in extractors]
+
+
+def iter_cohort_features(
+    patients: dict,
+    max_workers=None,
+    manifest: AnalysisManifest = None,
+    chunk_size=None,
+    **kwargs,
+):
+    """
+    Run ERGFeatureExtractor.extract_all_features on a whole cohort using a process pool.
+    params:
+    - patients: dict - The output of list_patients (patient name -> patient files)
+    - max_workers: int (default None) - Number of worker processes (defaults to the number of CPUs).
+    If 1, everything is run serially in the current process.
+    - manifest: AnalysisManifest (default None) - If given, only the new or changed visits are analysed
+    (see ERGFeatureExtractor.extract_all_features). It is saved after each patient.
+    - chunk_size: int (default None) - If given, the visits are processed by chunks of this size, whose
+    scotopic features are computed at once with the stacked kernels (see extract_stacked_scoto_features).
+    By default, each visit is a separate task analysed with the per-file analyses.
+    - kwargs: Parameters forwarded to ERGFeatureExtractor (f30_low_pass, scotorod_time_limits, ...).
+    With archive=CohortArchive(...), the recordings packed in the archive are read from it instead of
+    parsing their text export.
+    yields:
+    - (patient name, DataFrame as returned by ERGFeatureExtractor.format_results) as soon as all the
+    visits of a patient are done, in the order of patients. The results are identical to a serial run.
+    """
+    kwargs.setdefault("plot", False)
+    params = ERGFeatureExtractor(patient_files=dict(), **kwargs).get_params()
+    tasks = {
+        patient: split_patient_files_by_visit(patient_files)
+        for patient, patient_files in patients.items()
+    }
+
+    def format_patient(patient, visits_features):
+        featex = ERGFeatureExtractor(patient_files=patients[patient], **kwargs)
+        for (date, files), (visit_features, failed) in zip(
+            tasks[patient].items(), visits_features
+        ):
+            featex.features_per_visit.update(visit_features)
+            # Visits with a failed analysis are analysed again next time
+            if manifest is not None and date not in failed:
+                manifest.update(date, files, params, visit_features.get(date, dict()))
+        if manifest is not None:
+            manifest.save()
+        return featex.format_results()
+
+    # Visits already in the manifest are reused, the others are split in chunks
+    previous = dict()
+    pending = []
+    for patient, visits in tasks.items():
+        for position, (date, files) in enumerate(visits.items()):
+            features = None
+            if manifest is not None:
+                features = manifest.get(date, files, params)
+            if features is None:
+                pending.append(((patient, position), files))
+            else:
+                previous[(patient, position)] = ({date: features}, set())
+    size = chunk_size or 1
+    workers = 1 if max_workers == 1 else max_workers or os.cpu_count() or 1
+    # Small cohorts are split so that every worker gets a chunk
+    size = max(1, min(size, -(-len(pending) // workers)))
+    chunks = [pending[i : i + size] for i in range(0, len(pending), size)]
+    location = {
+        key: (c, k) for c, chunk in enumerate(chunks) for k, (key, _) in enumerate(chunk)
+    }
+    stacked = chunk_size is not None
+
+    with (
+        ProcessPoolExecutor(max_workers=max_workers)
+        if max_workers != 1
+        else nullcontext()
+    ) as executor:
+        outputs = dict()
+        # Chunks are consumed in order, only the next max_in_flight ones are submitted ahead
+        # so the pending results do not pile up in memory
+        max_in_flight = 2 * workers
+        submitted = 0
+
+        def submit_until(end):
+            nonlocal submitted
+            while executor is not None and submitted < min(end, len(chunks)):
+                files = [files for _, files in chunks[submitted]]
+                outputs[submitted] = executor.submit(
+                    _extract_visits_features, files, kwargs, stacked
+                )
+                submitted += 1
+
+        def get_output(c):
+            submit_until(c + 1 + max_in_flight)
+            # Earlier chunks were entirely consumed
+            for done in [d for d in outputs if d < c]:
+                del outputs[done]
+            if c not in outputs:
+                # Serial run, chunks are processed when first needed
+                files = [files for _, files in chunks[c]]
+                outputs[c] = _extract_visits_features(files, kwargs, stacked)
+            elif not isinstance(outputs[c], list):
+                outputs[c] = outputs[c].result()
+            return outputs[c]
+
+        submit_until(max_in_flight)
+        # Collect in submission order so the output does not depend on scheduling
+        for patient, visits in tasks.items():
+            visits_features = []
+            for position in range(len(visits)):
+                key = (patient, position)
+                if key in previous:
+                    visits_features.append(previous[key])
+                else:
+                    c, k = location[key]
+                    visits_features.append(get_output(c)[k])
+            yield patient, format_patient(patient, visits_features)
+
+
+def extract_cohort_features(patients: dict, max_workers=None, **kwargs):
+    """
+    Same as iter_cohort_features, but returns a dict patient name -> DataFrame.
+    """
+    return dict(iter_cohort_features(patients, max_workers=max_workers, **kwargs))
+
+
+def export_cohort_features(
+    patients: dict, output, max_workers=None, manifest: AnalysisManifest = None, **kwargs
+) -> int:
+    """
+    Extract the features of a cohort (see iter_cohort_features) and stream them to an export file,
+    each patient is written as soon as its visits are done.
+    params:
+    - patients: dict - The output of list_patients
+    - output: str | Path | FeatureWriter - Export file (.csv, .parquet or .xlsx, see open_feature_writer)
+    or an open writer, which is left open
+    - max_workers, manifest, kwargs: see iter_cohort_features
+    returns:
+    - Number of patients written
+    """
+    writer = output if isinstance(output, FeatureWriter) else open_feature_writer(output)
+    written = 0
+    with writer if writer is not output else nullcontext(writer):
+        for patient, data in iter_cohort_features(
+            patients, max_workers=max_workers, manifest=manifest, **kwargs
+        ):
+            writer.write(patient, data)
+            written += 1
+    return written
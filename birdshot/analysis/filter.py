@@ -1,18 +1,62 @@
+from functools import lru_cache
 import pandas as pd
 import scipy.signal
 
+TIME_COLUMN = ("", "Time (ms)")
 
-def low_pass_filter(trial: pd.DataFrame, cutoff):
-    trial = trial.copy()
+
+@lru_cache(maxsize=128)
+def butter_lowpass(cutoff, fs, order=5, sos=False):
+    """Butterworth low pass coefficients, cached per (cutoff, fs, order, sos)"""
+    if sos:
+        return scipy.signal.butter(order, cutoff / (fs / 2), btype="low", output="sos")
+    return scipy.signal.butter(order, cutoff / (fs / 2), btype="low")
+
+
+def get_step_columns(trial: pd.DataFrame, step):
+    """Return the columns of a given step (all eyes)"""
+    return [c for c in trial.columns if c[0] == step]
+
+
+def low_pass_filter(trial: pd.DataFrame, cutoff, columns=None, order=5, sos=False):
+    """
+    Apply a zero-phase Butterworth low pass filter to the traces of a trial.
+    All the columns are filtered at once with a single filtfilt call along the time axis.
+    params:
+    - trial: pd.DataFrame - Traces with a ("", "Time (ms)") column
+    - cutoff: float - The cutoff frequency (Hz)
+    - columns: list (default None) - The columns to filter. If None, all the traces are filtered.
+    Only these columns (and the time) are returned.
+    - order: int (default 5) - The order of the filter
+    - sos: bool (default False) - Use second-order sections (sosfiltfilt), numerically more stable for
+    low cutoffs, results differ slightly from the default.
+    returns:
+    - pd.DataFrame - A new frame with the filtered traces, the columns keep their original order
+    """
+    time = trial[TIME_COLUMN]
     N = len(trial)
-    time = trial[("", "Time (ms)")]
     fs = N / (time.iloc[-1] - time.iloc[0]) * 1000
 
-    b, a = scipy.signal.butter(5, cutoff / (fs / 2), btype="low")
+    if columns is not None:
+        columns = set(columns)
+    positions = []
+    time_position = 0
+    for i, c in enumerate(trial.columns):
+        if c == TIME_COLUMN:
+            time_position = len(positions)
+        elif columns is None or c in columns:
+            positions.append(i)
 
-    for c in trial.columns:
-        if c == ("", "Time (ms)"):
-            continue
-        trial[c] = scipy.signal.filtfilt(b, a, trial[c])
+    values = trial.iloc[:, positions].to_numpy(dtype=float)
+    if sos:
+        sos_coefs = butter_lowpass(cutoff, fs, order, sos=True)
+        values = scipy.signal.sosfiltfilt(sos_coefs, values, axis=0)
+    else:
+        b, a = butter_lowpass(cutoff, fs, order)
+        values = scipy.signal.filtfilt(b, a, values, axis=0)
 
-    return trial
+    filtered = pd.DataFrame(
+        values, index=trial.index, columns=trial.columns[positions]
+    )
+    filtered.insert(time_position, TIME_COLUMN, time)
+    return filtered
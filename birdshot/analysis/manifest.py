@@ -0,0 +1,133 @@
+import json
+import time
+import hashlib
+from pathlib import Path
+from functools import lru_cache
+
+from birdshot.io.cache import atomic_write, file_digest, RACY_WINDOW_NS
+
+MANIFEST_VERSION = 1
+# Modules whose code changes the extracted features (relative to the birdshot package),
+# including the loading of the recordings
+ANALYSIS_MODULES = [
+    "analysis/engine.py",
+    "analysis/context.py",
+    "analysis/filter.py",
+    "analysis/markers.py",
+    "analysis/cache.py",
+    "io/load.py",
+    "io/recording.py",
+    "io/cache.py",
+    "io/files.py",
+    "io/utils.py",
+]
+
+
+@lru_cache(maxsize=None)
+def code_version() -> str:
+    """Digest of the source of the analysis and loading modules"""
+    h = hashlib.blake2b(digest_size=8)
+    directory = Path(__file__).parents[1]
+    for name in ANALYSIS_MODULES:
+        h.update((directory / name).read_bytes())
+    return h.hexdigest()
+
+
+def params_key(params: dict) -> str:
+    """Digest of a set of analysis parameters"""
+    return hashlib.blake2b(
+        json.dumps(params, sort_keys=True, default=str).encode(), digest_size=8
+    ).hexdigest()
+
+
+class AnalysisManifest:
+    """
+    Record of the inputs of each analysed visit (files with their mtime, size and digest,
+    analysis parameters and code version) and of the features extracted from them.
+    A visit is only analysed again if one of these inputs changed, otherwise its previous
+    features are reused.
+    The manifest is a JSON file, usually stored next to the exported features (see for_output).
+    """
+
+    def __init__(self, filepath):
+        self.filepath = Path(filepath)
+        self.visits = dict()
+        if self.filepath.exists():
+            with open(self.filepath) as f:
+                content = json.load(f)
+            if content.get("version") == MANIFEST_VERSION:
+                self.visits = content["visits"]
+
+    @classmethod
+    def for_output(cls, output_path):
+        """Manifest stored next to an export file (e.g. features.csv -> features.csv.manifest.json)"""
+        output_path = Path(output_path)
+        return cls(output_path.with_name(f"{output_path.name}.manifest.json"))
+
+    def __len__(self):
+        return len(self.visits)
+
+    @staticmethod
+    def visit_key(date, visit_files: dict) -> str:
+        paths = sorted(str(Path(f).resolve()) for files in visit_files.values() for f in files)
+        return f"{date}|" + "|".join(paths)
+
+    @staticmethod
+    def describe_file(filepath, previous=None) -> dict:
+        """
+        Return the mtime, size and content digest of a file.
+        The digest of previous is reused if the file was not touched since, unless its mtime is within
+        RACY_WINDOW_NS of the time previous was recorded (a same-size rewrite in the same mtime tick).
+        """
+        stat = Path(filepath).stat()
+        if (
+            previous is not None
+            and previous["mtime_ns"] == stat.st_mtime_ns
+            and previous["size"] == stat.st_size
+            and stat.st_mtime_ns < previous.get("indexed_ns", 0) - RACY_WINDOW_NS
+        ):
+            return previous
+        return {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "digest": file_digest(filepath),
+            "indexed_ns": time.time_ns(),
+        }
+
+    def get(self, date, visit_files: dict, params: dict):
+        """Return the features previously extracted for this visit, or None if it must be analysed"""
+        entry = self.visits.get(self.visit_key(date, visit_files))
+        if entry is None:
+            return None
+        if entry["params"] != params_key(params) or entry["code"] != code_version():
+            return None
+        for files in visit_files.values():
+            for filepath in files:
+                previous = entry["files"].get(str(filepath))
+                if previous is None:
+                    return None
+                current = self.describe_file(filepath, previous)
+                if current["digest"] != previous["digest"]:
+                    return None
+                # Keep the new mtime and check time, so the digest is not computed again next time
+                previous.update(current)
+        return dict(entry["features"])
+
+    def update(self, date, visit_files: dict, params: dict, features: dict):
+        key = self.visit_key(date, visit_files)
+        previous_files = self.visits.get(key, {}).get("files", {})
+        self.visits[key] = {
+            "date": str(date),
+            "files": {
+                str(f): self.describe_file(f, previous_files.get(str(f)))
+                for files in visit_files.values()
+                for f in files
+            },
+            "params": params_key(params),
+            "code": code_version(),
+            "features": {k: float(v) for k, v in features.items()},
+        }
+
+    def save(self):
+        with atomic_write(self.filepath, mode="w") as f:
+            json.dump({"version": MANIFEST_VERSION, "visits": self.visits}, f)
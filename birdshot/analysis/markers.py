@@ -1,10 +1,10 @@
+from functools import lru_cache
 import numpy as np
 import scipy
-from birdshot.analysis.filter import low_pass_filter
-import matplotlib.pyplot as plt
-import streamlit as st
-from pickle import load
-from birdshot.analysis.models import load_model, evaluate
+from birdshot.analysis.filter import low_pass_filter, get_step_columns
+from birdshot.analysis.cache import memoize
+
+# torch (through birdshot.analysis.models) and matplotlib are imported only when needed
 
 
 def extract_baseline_value(trial, time=None):
@@ -53,7 +53,109 @@ def extract_scoto_rod_cone_markers(trial, time, time_limits=(10, 100), delta=0.7
     return ymax_value, ymin_value, xmax_value, xmin_value
 
 
-@st.cache_data
+def stack_step_traces(trials: list, step, eyes=("OD", "OS")):
+    """
+    Stack one step of several recordings (as returned by load_patient) into arrays, padded with NaN
+    for the shorter recordings (same layout as birdshot.io.archive.CohortArchive.stack).
+    returns:
+    - traces: np.ndarray (recordings, time, eyes)
+    - time: np.ndarray (recordings, time)
+    """
+    length = max((len(trial) for trial in trials), default=0)
+    traces = np.full((len(trials), length, len(eyes)), np.nan)
+    time = np.full((len(trials), length), np.nan)
+    for r, trial in enumerate(trials):
+        n = len(trial)
+        time[r, :n] = trial[("", "Time (ms)")].to_numpy()
+        traces[r, :n] = trial[[(step, eye) for eye in eyes]].to_numpy()
+    return traces, time
+
+
+def _stacked_time(traces, time):
+    time = np.asarray(time, dtype=float)
+    if time.ndim == 1:
+        time = np.broadcast_to(time, traces.shape[:2])
+    return time
+
+
+def extract_stacked_baseline(traces, time):
+    """
+    Baseline (mean of the samples at negative times) of stacked traces.
+    params:
+    - traces: np.ndarray (recordings, time, eyes) - NaN samples are ignored (padding)
+    - time: np.ndarray (time,) shared by all the recordings, or (recordings, time)
+    returns:
+    - np.ndarray (recordings, eyes)
+    """
+    time = _stacked_time(traces, time)
+    mask = (time < 0)[:, :, None] & ~np.isnan(traces)
+    total = np.where(mask, traces, 0).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return total / mask.sum(axis=1)
+
+
+def _stacked_extremum(traces, time, time_limits, largest=True):
+    """Value and time of the maximum (or minimum) of stacked traces strictly inside time_limits"""
+    mask = ((time > time_limits[0]) & (time < time_limits[1]))[:, :, None]
+    mask = mask & ~np.isnan(traces)
+    masked = np.where(mask, traces, -np.inf if largest else np.inf)
+    index = masked.argmax(axis=1) if largest else masked.argmin(axis=1)
+    value = np.take_along_axis(masked, index[:, None, :], axis=1)[:, 0, :]
+    latency = np.take_along_axis(time, index, axis=1)
+    empty = ~mask.any(axis=1)
+    value[empty] = np.nan
+    latency[empty] = np.nan
+    return value, latency
+
+
+def extract_stacked_scoto_rod_markers(traces, time, time_limits=(10, 150)):
+    """
+    Vectorized scotopic rod markers of many recordings at once, same definitions as
+    extract_scoto_rod_analysis (on already filtered traces).
+    params:
+    - traces: np.ndarray (recordings, time, eyes) - Step 9, padded with NaN
+    - time: np.ndarray (time,) or (recordings, time)
+    returns:
+    - dict of np.ndarray (recordings, eyes): baseline, B_amplitude, B_time.
+    Recordings without samples in time_limits get NaN.
+    """
+    time = _stacked_time(traces, time)
+    baseline = extract_stacked_baseline(traces, time)
+    ymax_value, xmax_time = _stacked_extremum(traces, time, time_limits)
+    return {
+        "baseline": baseline,
+        "B_amplitude": np.abs(ymax_value - baseline),
+        "B_time": xmax_time,
+    }
+
+
+def extract_stacked_scoto_rod_cone_markers(traces, time, time_limits=(10, 100), delta=0.7):
+    """
+    Vectorized scotopic rod-cone markers of many recordings at once, same definitions as
+    extract_scoto_rod_cone_analysis (on already filtered traces).
+    params:
+    - traces: np.ndarray (recordings, time, eyes) - Step 19, padded with NaN
+    - time: np.ndarray (time,) or (recordings, time)
+    returns:
+    - dict of np.ndarray (recordings, eyes): baseline, A_amplitude, A_time, B_amplitude, B_time.
+    Recordings without samples in the time limits get NaN.
+    """
+    time = _stacked_time(traces, time)
+    baseline = extract_stacked_baseline(traces, time)
+    ymax_value, xmax_time = _stacked_extremum(traces, time, time_limits)
+    ymin_value, xmin_time = _stacked_extremum(
+        traces, time, (time_limits[0], time_limits[1] * delta), largest=False
+    )
+    return {
+        "baseline": baseline,
+        "A_amplitude": np.abs(ymin_value - baseline),
+        "A_time": xmin_time,
+        "B_amplitude": np.abs(ymax_value - ymin_value),
+        "B_time": xmax_time,
+    }
+
+
+@memoize(ignore=("title",), skip_if=("plot",))
 def extract_scoto_rod_cone_analysis(
     trial,
     filtered=75,
@@ -62,9 +164,11 @@ def extract_scoto_rod_cone_analysis(
     title="",
     return_filtered=False,
 ):
-    org = trial.copy()
+    org = trial
     if filtered > 0:
-        trial = low_pass_filter(trial, filtered)
+        # Only step 19 is analysed, the other steps are filtered only if they are returned
+        columns = None if return_filtered else get_step_columns(trial, 19)
+        trial = low_pass_filter(trial, filtered, columns=columns)
     time = trial[("", "Time (ms)")]
     baseline = extract_baseline_value(trial[19], time)
     ymax_value, ymin_value, xmax_value, xmin_value = extract_scoto_rod_cone_markers(
@@ -80,6 +184,8 @@ def extract_scoto_rod_cone_analysis(
     A_time_os = time.loc[xmin_value["OS"]]
 
     if plot:
+        import matplotlib.pyplot as plt
+
         fig, axs = plt.subplots(1, 2, figsize=(8, 3))
         axs[1].plot(time, trial[(19, "OS")])
         axs[0].plot(time, trial[(19, "OD")])
@@ -137,7 +243,7 @@ def extract_scoto_rod_cone_analysis(
         return B_amplitude, A_amplitude, B_time_od, A_time_od, B_time_os, A_time_os
 
 
-@st.cache_data
+@memoize(ignore=("title",), skip_if=("plot",))
 def extract_scoto_rod_analysis(
     trial,
     filtered=100,
@@ -152,9 +258,11 @@ def extract_scoto_rod_analysis(
     value of the signal before 80ms.
 
     """
-    org = trial.copy()
+    org = trial
     if filtered > 0:
-        trial = low_pass_filter(trial, filtered)
+        # Only step 9 is analysed, the other steps are filtered only if they are returned
+        columns = None if return_filtered else get_step_columns(trial, 9)
+        trial = low_pass_filter(trial, filtered, columns=columns)
     time = trial[("", "Time (ms)")]
     baseline = extract_baseline_value(trial[9], time)
     ymax_value, xmax_value = extract_scoto_rod_markers(trial[9], time, time_limits)
@@ -163,6 +271,8 @@ def extract_scoto_rod_analysis(
     B_time_os = time.loc[xmax_value["OS"]]
 
     if plot:
+        import matplotlib.pyplot as plt
+
         fig, axs = plt.subplots(1, 2, figsize=(8, 3))
         axs[1].plot(time, trial[(9, "OS")])
         axs[0].plot(time, trial[(9, "OD")])
@@ -198,7 +308,7 @@ def extract_scoto_rod_analysis(
         return B_amplitude, B_time_od, B_time_os
 
 
-@st.cache_data
+@memoize(ignore=("title",), skip_if=("plot",))
 def extract_f30_analysis(
     trial,
     filtered=0,
@@ -232,12 +342,14 @@ def extract_f30_analysis(
     # Approximate time between peaks
     T = 1 / 30
     delta = T * delta
-    org = trial.copy()
+    org = trial
     if filtered > 0:
-        trial = low_pass_filter(trial, filtered)
+        columns = None if return_filtered else get_step_columns(trial, 1)
+        trial = low_pass_filter(trial, filtered, columns=columns)
 
-    od = trial[(1, "OD")]
-    os = trial[(1, "OS")]
+    t = time.to_numpy()
+    # Both eyes as a (time, 2) block
+    values = trial[[(1, "OD"), (1, "OS")]].to_numpy()
 
     def get_peaks(data):
         max_peaks, _ = scipy.signal.find_peaks(
@@ -249,48 +361,31 @@ def extract_f30_analysis(
 
         # A good peak should have a minimum followed by a maximum
         # We will filter the peaks that do not have this characteristic
-        max_peaks = max_peaks[np.where(time.loc[max_peaks] > time.loc[min_peaks[0]])]
-        # We make sure that we alternate between max and min peaks
-        peaks = []
-        for i, min_peak in enumerate(min_peaks):
-            if i >= len(max_peaks):
-                break
-            min_peak_t = time.loc[min_peak]
-            max_peak = max_peaks[i]
-            max_peak_t = time.loc[max_peak]
-            time_diff = (1e-3 * (max_peak_t - min_peak_t)) * 2
-
-            if (time_diff < T - delta) or (time_diff > T + delta):
-                continue
-            peaks.append((min_peak, max_peak))
-        return peaks
-
-    od_peaks = get_peaks(od)
-    os_peaks = get_peaks(os)
-
-    od_peaks_amplitude = []
-    os_peaks_amplitude = []
-    od_peaks_time = []
-    os_peaks_time = []
-
-    od_peaks_coords = []
-    os_peaks_coords = []
-
-    for min_peak, max_peak in od_peaks:
-        od_peaks_amplitude.append(od.loc[max_peak] - od.loc[min_peak])
-        od_peaks_time.append(time.loc[max_peak])
-        od_peaks_coords.append(
-            (od.loc[min_peak], od.loc[max_peak], time.loc[min_peak], time.loc[max_peak])
-        )
-
-    for min_peak, max_peak in os_peaks:
-        os_peaks_amplitude.append(os.loc[max_peak] - os.loc[min_peak])
-        os_peaks_time.append(time.loc[max_peak])
-        os_peaks_coords.append(
-            (os.loc[min_peak], os.loc[max_peak], time.loc[min_peak], time.loc[max_peak])
+        max_peaks = max_peaks[t[max_peaks] > t[min_peaks[0]]]
+        # We pair the i-th minimum with the i-th maximum and keep the pairs
+        # separated by half a period (30Hz +/- delta)
+        n = min(len(min_peaks), len(max_peaks))
+        min_peaks = min_peaks[:n]
+        max_peaks = max_peaks[:n]
+        time_diff = (1e-3 * (t[max_peaks] - t[min_peaks])) * 2
+        good = (time_diff >= T - delta) & (time_diff <= T + delta)
+        return min_peaks[good], max_peaks[good]
+
+    outputs = [[], [], [], []]
+    coords = []
+    for eye in range(2):
+        data = values[:, eye]
+        min_peaks, max_peaks = get_peaks(data)
+        # Amplitudes and times
+        outputs[eye] = list(data[max_peaks] - data[min_peaks])
+        outputs[eye + 2] = list(t[max_peaks])
+        coords.append(
+            list(zip(data[min_peaks], data[max_peaks], t[min_peaks], t[max_peaks]))
         )
 
     if plot:
+        import matplotlib.pyplot as plt
+
         fig, axs = plt.subplots(1, 2, figsize=(8, 3))
         axs[1].plot(time, trial[(1, "OS")])
         axs[0].plot(time, trial[(1, "OD")])
@@ -298,58 +393,70 @@ def extract_f30_analysis(
             axs[0].plot(time, org[(1, "OD")], alpha=0.5)
             axs[1].plot(time, org[(1, "OS")], alpha=0.5)
 
-        for min_peak, max_peak in od_peaks:
-            min_t = time.loc[min_peak]
-            max_t = time.loc[max_peak]
-            axs[0].fill_between(
-                [min_t, max_t],
-                [trial[(1, "OD")].loc[min_peak], trial[(1, "OD")].loc[min_peak]],
-                [trial[(1, "OD")].loc[max_peak], trial[(1, "OD")].loc[max_peak]],
-                color="red",
-                alpha=0.5,
-            )
-        for min_peak, max_peak in os_peaks:
-            min_t = time.loc[min_peak]
-            max_t = time.loc[max_peak]
-            axs[1].fill_between(
-                [min_t, max_t],
-                [trial[(1, "OS")].loc[min_peak], trial[(1, "OS")].loc[min_peak]],
-                [trial[(1, "OS")].loc[max_peak], trial[(1, "OS")].loc[max_peak]],
-                color="red",
-                alpha=0.5,
-            )
+        for ax, eye_coords in zip(axs, coords):
+            for ymin, ymax, min_t, max_t in eye_coords:
+                ax.fill_between(
+                    [min_t, max_t], [ymin, ymin], [ymax, ymax], color="red", alpha=0.5
+                )
         fig.suptitle(title)
         plt.show()
 
-    outputs = [od_peaks_amplitude, os_peaks_amplitude, od_peaks_time, os_peaks_time]
     if return_peaks:
-        outputs.extend([od_peaks_coords, os_peaks_coords])
+        outputs.extend(coords)
     if return_filtered:
         outputs.append(trial)
     return outputs
 
 
-@st.cache_resource
-def get_GRU_model():
-    return load_model()
+@lru_cache(maxsize=None)
+def get_GRU_model(backend="eager", quantize=False):
+    """
+    Cached GRU model.
+    backend can be "eager" or "torchscript", quantize enables dynamic int8 quantization (see optimize_model).
+    """
+    from birdshot.analysis.models import load_model
+
+    return load_model(backend=backend, quantize=quantize)
+
 
+def extract_photo_markers(trials, batch_size=None, backend="eager", quantize=False):
+    """
+    Extract the a, b and i markers of any number of photopic trials with the GRU model.
+    The traces of both eyes of all the trials are scored together (see evaluate_batch),
+    so a whole cohort only needs one forward pass per distinct trace length.
+    params:
+    - trials: list of pd.DataFrame - Each with "OD", "OS" and "Time (ms)" columns
+    - batch_size: int (default None) - Maximum number of traces per forward pass
+    - backend, quantize: The inference backend of the model (see get_GRU_model)
+    returns:
+    - list of dict - One per trial, as returned by extract_photo_analysis
+    """
+    from birdshot.analysis.models import evaluate_batch
 
-def extract_photo_analysis(trial):
     labels = ["a", "b", "i"]
     laterality = ["OS", "OD"]
-    results = {f"{eye} {label}": None for eye in laterality for label in labels}
-    time = trial["Time (ms)"]
-    model = get_GRU_model()
-
-    for lat in laterality:
-        x = trial[lat].values.reshape(-1, 1).transpose()
-        pred = evaluate(model, x, choice="first")
-        for label in labels:
-            xpt = int(pred[label].squeeze(0))
-            ypt = trial[lat].values[xpt]
-
-            # Get the exact time
-            xpt = time[xpt]
-
-            results[f"{lat} {label}"] = ([xpt], [ypt])
-    return results
+    traces = [trial[lat].values for trial in trials for lat in laterality]
+    model = get_GRU_model(backend=backend, quantize=quantize)
+    pred = evaluate_batch(model, traces, choice="first", batch_size=batch_size)
+
+    all_results = []
+    k = 0
+    for trial in trials:
+        time = trial["Time (ms)"]
+        results = dict()
+        for lat in laterality:
+            for label in labels:
+                xpt = int(pred[label][k])
+                ypt = trial[lat].values[xpt]
+
+                # Get the exact time
+                xpt = time[xpt]
+
+                results[f"{lat} {label}"] = ([xpt], [ypt])
+            k += 1
+        all_results.append(results)
+    return all_results
+
+
+def extract_photo_analysis(trial, backend="eager", quantize=False):
+    return extract_photo_markers([trial], backend=backend, quantize=quantize)[0]
@@ -1,6 +1,8 @@
+import argparse
+from pathlib import Path
+
 import torch.nn as nn
 import torch
-from sklearn.utils.class_weight import compute_class_weight
 import numpy as np
 
 
@@ -27,9 +29,11 @@ def train(
     ytrain,
     num_epochs=1000,
     learning_rate=1e-3,
-    device=torch.device("cuda"),
+    device=torch.device("cpu"),
     verbose=True,
 ):
+    from sklearn.utils.class_weight import compute_class_weight
+
     xtrain = torch.tensor(xtrain, dtype=torch.float32).unsqueeze(2).to(device)
     ytrain = torch.tensor(ytrain, dtype=torch.float32).to(device)
     model = model.to(device)
@@ -57,13 +61,247 @@ def train(
     return model
 
 
-def load_model():
+class TraceDataset(torch.utils.data.Dataset):
+    """Traces (possibly of different lengths) with their per-sample labels"""
+
+    def __init__(self, x, y):
+        self.x = [torch.as_tensor(np.asarray(t, dtype=np.float32)) for t in x]
+        self.y = [torch.as_tensor(np.asarray(t, dtype=np.int64)) for t in y]
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, index):
+        return self.x[index].unsqueeze(1), self.y[index]
+
+
+class LengthBucketSampler(torch.utils.data.Sampler):
+    """
+    Yield mini-batches of indices of traces of the same length, so batches can be stacked
+    without padding (which would change the output of the bidirectional GRU).
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, seed=0):
+        self.buckets = dict()
+        for index, length in enumerate(lengths):
+            self.buckets.setdefault(length, []).append(index)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.generator = np.random.default_rng(seed)
+
+    def __iter__(self):
+        batches = []
+        for indices in self.buckets.values():
+            indices = np.asarray(indices)
+            if self.shuffle:
+                indices = self.generator.permutation(indices)
+            for start in range(0, len(indices), self.batch_size):
+                batches.append(indices[start : start + self.batch_size].tolist())
+        if self.shuffle:
+            batches = [batches[i] for i in self.generator.permutation(len(batches))]
+        return iter(batches)
+
+    def __len__(self):
+        return sum(-(-len(b) // self.batch_size) for b in self.buckets.values())
+
+
+def fit(
+    model,
+    x,
+    y,
+    batch_size=32,
+    num_epochs=200,
+    learning_rate=1e-3,
+    validation_split=0.2,
+    groups=None,
+    patience=20,
+    num_threads=None,
+    checkpoint="models/GRU_checkpoint.pt",
+    seed=0,
+    verbose=True,
+):
+    """
+    Mini-batch training of the marker model, intended for CPU.
+    params:
+    - model: RNN
+    - x: array (N, T) or list of 1D arrays - The traces, they can have different lengths
+    - y: array (N, T) or list of 1D arrays - The label of each sample (0 background, 1 i, 2 b, 3 a),
+    as returned by PatientsData.get_xy
+    - batch_size: int (default 32) - Traces per mini-batch, batches only contain traces of the same length
+    - validation_split: float (default 0.2) - Fraction of the traces (or of the groups) kept for validation
+    - groups: array (N,) (default None) - Group of each trace (e.g. the patient ids), a group is never
+    split between training and validation
+    - patience: int (default 20) - Stop when the validation loss did not improve for this many epochs
+    - num_threads: int (default None) - Number of threads used by torch, torch's default if None
+    - checkpoint: str (default "models/GRU_checkpoint.pt") - Where the best weights are saved, in the
+    same format as the packaged weights (see load_model(filepath=...)). Not saved if None.
+    returns:
+    - The model with the weights of the epoch with the lowest validation loss
+    - dict with the training and validation loss of each epoch
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    torch.manual_seed(seed)
+    rng = np.random.default_rng(seed)
+
+    n = len(x)
+    groups = np.arange(n) if groups is None else np.asarray(groups)
+    unique_groups = rng.permutation(np.unique(groups))
+    n_val = int(round(len(unique_groups) * validation_split))
+    val_mask = np.isin(groups, unique_groups[:n_val])
+    train_idx = np.flatnonzero(~val_mask)
+    val_idx = np.flatnonzero(val_mask)
+
+    dataset = TraceDataset(x, y)
+    lengths = [len(t) for t in dataset.x]
+    train_set = torch.utils.data.Subset(dataset, train_idx)
+    train_loader = torch.utils.data.DataLoader(
+        train_set,
+        batch_sampler=LengthBucketSampler(
+            [lengths[i] for i in train_idx], batch_size, shuffle=True, seed=seed
+        ),
+    )
+    val_loader = torch.utils.data.DataLoader(
+        torch.utils.data.Subset(dataset, val_idx),
+        batch_sampler=LengthBucketSampler(
+            [lengths[i] for i in val_idx], batch_size, shuffle=False
+        ),
+    )
+
+    # Balanced class weights (as sklearn's compute_class_weight) over the training labels
+    counts = np.bincount(
+        np.concatenate([dataset.y[i].numpy() for i in train_idx]), minlength=4
+    )
+    class_weight = np.where(counts > 0, counts.sum() / (4 * np.maximum(counts, 1)), 0)
+    loss = nn.CrossEntropyLoss(weight=torch.tensor(class_weight, dtype=torch.float32))
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+
+    history = {"train_loss": [], "val_loss": []}
+    best_loss = np.inf
+    best_state = None
+    epochs_without_improvement = 0
+    for epoch in range(num_epochs):
+        model.train()
+        train_loss = 0.0
+        for xb, yb in train_loader:
+            optimizer.zero_grad()
+            ypred = model(xb)
+            loss_value = loss(ypred.reshape(-1, 4), yb.reshape(-1))
+            loss_value.backward()
+            optimizer.step()
+            train_loss += loss_value.item() * len(xb)
+        train_loss /= max(len(train_idx), 1)
+
+        model.eval()
+        val_loss = 0.0
+        with torch.no_grad():
+            for xb, yb in val_loader:
+                val_loss += loss(model(xb).reshape(-1, 4), yb.reshape(-1)).item() * len(xb)
+        # Without validation data, the training loss is monitored instead
+        val_loss = val_loss / len(val_idx) if len(val_idx) else train_loss
+        history["train_loss"].append(train_loss)
+        history["val_loss"].append(val_loss)
+
+        if val_loss < best_loss:
+            best_loss = val_loss
+            best_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+            epochs_without_improvement = 0
+            if checkpoint is not None:
+                Path(checkpoint).parent.mkdir(parents=True, exist_ok=True)
+                torch.save(best_state, checkpoint)
+        else:
+            epochs_without_improvement += 1
+
+        if verbose:
+            print(
+                f"Epoch {epoch}, Loss: {train_loss:.4f}, Validation loss: {val_loss:.4f}"
+            )
+        if epochs_without_improvement >= patience:
+            if verbose:
+                print(f"Early stopping at epoch {epoch}")
+            break
+
+    if best_state is not None:
+        model.load_state_dict(best_state)
+    model.eval()
+    return model, history
+
+
+def load_model(backend="eager", quantize=False, filepath="models/GRU_4l_16h.pt"):
+    """
+    Load the GRU marker model from its packaged weights.
+    See optimize_model for the backend and quantize options.
+    """
     model = RNN(input_dim=1, hidden_dim=16, output_dim=4, num_layers=4)
 
-    state_dict = torch.load("models/GRU_4l_16h.pt", map_location="cpu")
+    state_dict = torch.load(filepath, map_location="cpu")
     model.load_state_dict(state_dict)
     model.eval()
-    return model
+    return optimize_model(model, backend=backend, quantize=quantize)
+
+
+def optimize_model(model, backend="eager", quantize=False):
+    """
+    Prepare a model for CPU inference.
+    params:
+    - backend: str (default "eager") - "eager" keeps the python module,
+    "torchscript" compiles and freezes the graph
+    - quantize: bool (default False) - Apply dynamic int8 quantization to the GRU and Linear layers
+    """
+    model.eval()
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {nn.GRU, nn.Linear}, dtype=torch.qint8
+        )
+    match backend:
+        case "eager":
+            return model
+        case "torchscript":
+            return torch.jit.freeze(torch.jit.script(model))
+        case _:
+            raise ValueError(f"Unknown backend {backend}")
+
+
+def export_model(model, filepath, quantize=False):
+    """Save a TorchScript version of the model that can be loaded without the RNN class"""
+    torch.jit.save(optimize_model(model, backend="torchscript", quantize=quantize), filepath)
+
+
+def load_exported_model(filepath):
+    return torch.jit.load(filepath, map_location="cpu")
+
+
+@torch.inference_mode()
+def check_parity(model, reference=None, x=None, n=16, length=1024, seed=0):
+    """
+    Compare the predictions of an optimized model with the eager model on the packaged weights.
+    params:
+    - model: The model to check
+    - reference: (default None) - The reference model, the eager model if None
+    - x: np.ndarray (default None) - Traces (B, L) to compare on. If None, n random traces of length are used
+    returns:
+    - dict with the maximum and mean absolute differences of the class probabilities
+    ("max_proba_error", "mean_proba_error") and, for each marker, the fraction of traces where both
+    models give the same index
+    """
+    if reference is None:
+        reference = load_model()
+    if x is None:
+        rng = np.random.default_rng(seed)
+        x = rng.normal(scale=50, size=(n, length))
+    x = torch.tensor(x, dtype=torch.float32).unsqueeze(2)
+
+    proba = torch.softmax(model(x), dim=-1)
+    proba_ref = torch.softmax(reference(x), dim=-1)
+    error = (proba - proba_ref).abs()
+    results = {
+        "max_proba_error": error.max().item(),
+        "mean_proba_error": error.mean().item(),
+    }
+    for i, label in enumerate(["i", "b", "a"]):
+        same = proba[:, :, i + 1].argmax(1) == proba_ref[:, :, i + 1].argmax(1)
+        results[label] = same.float().mean().item()
+    return results
 
 
 @torch.inference_mode()
@@ -97,3 +335,83 @@ def evaluate(model, x, choice="max_proba"):
             results[label] = (ypred == i).long().argmax(1)
 
     return results
+
+
+@torch.inference_mode()
+def evaluate_batch(model, traces, choice="max_proba", batch_size=None):
+    """
+    Evaluate the model on any number of traces at once.
+    Traces are bucketed by length and each bucket is run in a single forward pass
+    (split in chunks of batch_size if given). Traces are never padded, as padding would change
+    the output of the bidirectional GRU.
+    params:
+    - model: RNN
+    - traces: list of 1D arrays or tensors, possibly of different lengths
+    - choice: str (default "max_proba") - See evaluate
+    - batch_size: int (default None) - Maximum number of traces per forward pass
+    returns:
+    - dict label -> np.ndarray (n_traces,) - The index of each marker ("i", "b", "a") in each trace
+    """
+    traces = [
+        (
+            t.detach().cpu().numpy().reshape(-1)
+            if isinstance(t, torch.Tensor)
+            else np.asarray(t, dtype=np.float32).reshape(-1)
+        )
+        for t in traces
+    ]
+    buckets = dict()
+    for index, trace in enumerate(traces):
+        buckets.setdefault(len(trace), []).append(index)
+
+    results = {label: np.zeros(len(traces), dtype=np.int64) for label in ["i", "b", "a"]}
+    for indices in buckets.values():
+        chunk_size = batch_size or len(indices)
+        for start in range(0, len(indices), chunk_size):
+            chunk = indices[start : start + chunk_size]
+            x = np.stack([traces[i] for i in chunk])
+            pred = evaluate(model, x, choice=choice)
+            for label in results:
+                results[label][chunk] = pred[label].cpu().numpy()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the GRU marker model")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    train_parser = subparsers.add_parser("train")
+    train_parser.add_argument("input_folder", help="Folder of patients with annotated markers")
+    train_parser.add_argument("--output", default="models/GRU_checkpoint.pt")
+    train_parser.add_argument("--batch-size", type=int, default=32)
+    train_parser.add_argument("--epochs", type=int, default=200)
+    train_parser.add_argument("--learning-rate", type=float, default=1e-3)
+    train_parser.add_argument("--validation-split", type=float, default=0.2)
+    train_parser.add_argument("--patience", type=int, default=20)
+    train_parser.add_argument("--threads", type=int, default=None)
+    train_parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == "train":
+        from birdshot.io.training import get_patients_photopic_trainable_data
+
+        patients, _ = get_patients_photopic_trainable_data(args.input_folder)
+        x, y = patients.get_xy()
+        model = RNN(input_dim=1, hidden_dim=16, output_dim=4, num_layers=4)
+        fit(
+            model,
+            x,
+            y,
+            batch_size=args.batch_size,
+            num_epochs=args.epochs,
+            learning_rate=args.learning_rate,
+            validation_split=args.validation_split,
+            groups=patients.ids,
+            patience=args.patience,
+            num_threads=args.threads,
+            checkpoint=args.output,
+            seed=args.seed,
+        )
+
+
+if __name__ == "__main__":
+    main()
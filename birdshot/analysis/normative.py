@@ -0,0 +1,343 @@
+import pickle
+import warnings
+from pathlib import Path
+from functools import lru_cache
+
+import numpy as np
+
+from birdshot.analysis.alignment import resample
+from birdshot.io.cache import atomic_write
+
+TIME_COLUMN = ("", "Time (ms)")
+PROTOCOLS = ["Scoto", "F30", "Photo"]
+# Upper bounds (exclusive) of the age bins, in years
+AGE_BINS = (30, 40, 50, 60, 200)
+PERCENTILES = (2.5, 5, 25, 50, 75, 95, 97.5)
+ALL = "all"
+
+NORMAL_RESULTS_PATH = "models/normal_results.pickle"
+NORMATIVE_STATS_PATH = "models/normative_stats.npz"
+
+
+def age_bin(age, age_bins=AGE_BINS) -> int:
+    """Index of the age bin of a subject"""
+    return int(np.searchsorted(age_bins, age, side="right"))
+
+
+def canonical_grid(times: list) -> np.ndarray:
+    """The most common time vector among the recordings of a protocol"""
+    lengths = [len(t) for t in times]
+    values, counts = np.unique(lengths, return_counts=True)
+    length = values[np.argmax(counts)]
+    return np.asarray(times[lengths.index(length)], dtype=float)
+
+
+def nanpercentile(values, percentiles) -> np.ndarray:
+    """
+    Same as np.nanpercentile(values, percentiles, axis=0) (linear interpolation), vectorized over the
+    samples instead of being computed sample by sample.
+    """
+    values = np.sort(values, axis=0)  # NaN are sorted last
+    count = np.sum(~np.isnan(values), axis=0)
+    output = np.full((len(percentiles), values.shape[1]), np.nan)
+    valid = count > 0
+    for i, q in enumerate(percentiles):
+        position = q / 100 * (count[valid] - 1)
+        low = np.floor(position).astype(np.int64)
+        high = np.minimum(low + 1, count[valid] - 1)
+        columns = values[:, valid]
+        lower = np.take_along_axis(columns, low[None], axis=0)[0]
+        upper = np.take_along_axis(columns, high[None], axis=0)[0]
+        output[i, valid] = lower + (upper - lower) * (position - low)
+    return output
+
+
+def get_result_traces(result, protocol):
+    """
+    Traces of a normal subject (birdshot.io.normal.Results) for a protocol.
+    returns:
+    - dict (step, eye) -> (time, values). The photopic trial has no step, it is stored as step None.
+    """
+    match protocol:
+        case "Scoto":
+            trial = result.scoto
+        case "F30":
+            trial = result.f30
+        case "Photo":
+            trial = result.photo
+    if trial is None:
+        return dict()
+    if protocol == "Photo":
+        time = trial["Time (ms)"].to_numpy()
+        return {(None, eye): (time, trial[eye].to_numpy()) for eye in ["OD", "OS"]}
+    time = trial[TIME_COLUMN].to_numpy()
+    return {c: (time, trial[c].to_numpy()) for c in trial.columns if c != TIME_COLUMN}
+
+
+class NormativeBand:
+    """Normative statistics of one trace (protocol, step, eye) for one group of subjects"""
+
+    def __init__(self, time, mean, std, percentiles: dict, count):
+        self.time = time
+        self.mean = mean
+        self.std = std
+        self.percentiles = percentiles
+        self.count = count
+
+    def __repr__(self):
+        return f"NormativeBand(count={self.count}, samples={len(self.time)})"
+
+    def at(self, time):
+        """Return the band resampled on another time vector (e.g. the one of a patient)"""
+        time = np.asarray(time, dtype=float)
+        if len(time) == len(self.time) and np.array_equal(time, self.time):
+            return self
+        return NormativeBand(
+            time,
+            resample(self.time, self.mean, time),
+            resample(self.time, self.std, time),
+            {q: resample(self.time, p, time) for q, p in self.percentiles.items()},
+            self.count,
+        )
+
+
+class NormativeStats:
+    """
+    Precomputed normative statistics (mean, std and percentile envelopes) of the normal subjects,
+    per protocol, step and eye, binned by age and sex, on a canonical time grid per protocol.
+    The statistics of a group are looked up in O(1), instead of being recomputed from the normal
+    traces on every chart.
+    Groups are keyed by age bin index (or "all") and sex (or "all"), see lookup.
+    """
+
+    def __init__(self, grids: dict, tables: dict, age_bins=AGE_BINS, percentiles=PERCENTILES):
+        # protocol -> time grid
+        self.grids = grids
+        # protocol -> dict of arrays: step, eye, age_bin, sex (K,), count (K,), mean (K, T), std (K, T),
+        # percentiles (K, P, T). Steps are stored as -1 and age bins as -1 when not applicable / pooled.
+        self.tables = tables
+        self.age_bins = tuple(age_bins)
+        self.percentiles = tuple(percentiles)
+        self.keys = dict()
+        for protocol, table in tables.items():
+            for row, key in enumerate(
+                zip(table["step"], table["eye"], table["age_bin"], table["sex"])
+            ):
+                step, eye, age, sex = key
+                step = None if step < 0 else int(step)
+                age = ALL if age < 0 else int(age)
+                self.keys[(protocol, step, str(eye), age, str(sex))] = row
+
+    def __repr__(self):
+        return f"NormativeStats(protocols={list(self.grids)}, groups={len(self.keys)})"
+
+    def _band(self, protocol, row) -> NormativeBand:
+        table = self.tables[protocol]
+        return NormativeBand(
+            self.grids[protocol],
+            table["mean"][row],
+            table["std"][row],
+            dict(zip(self.percentiles, table["percentiles"][row])),
+            int(table["count"][row]),
+        )
+
+    def lookup(self, protocol, step, eye, age=None, sex=None, min_count=5) -> NormativeBand:
+        """
+        Normative band of a trace for a subject of a given age and sex.
+        If the age/sex group has fewer than min_count normal subjects, the statistics are taken from
+        the age group (all sexes), then the sex group (all ages) and finally from all the subjects.
+        params:
+        - protocol: str - "Scoto", "F30" or "Photo"
+        - step: int - The step (None for the photopic trial)
+        - eye: str - "OD" or "OS"
+        - age: int (default None) - Age of the subject, None to pool all ages
+        - sex: str (default None) - "F" or "M", None to pool both sexes
+        """
+        age = ALL if age is None else age_bin(age, self.age_bins)
+        sex = ALL if sex is None else sex
+        candidates = [(age, sex), (age, ALL), (ALL, sex), (ALL, ALL)]
+        row = None
+        for a, s in candidates:
+            row = self.keys.get((protocol, step, eye, a, s), row)
+            if row is not None and self.tables[protocol]["count"][row] >= min_count:
+                break
+        if row is None:
+            raise KeyError(f"No normative data for {protocol}, step {step}, {eye}")
+        return self._band(protocol, row)
+
+    def zscore(self, protocol, step, eye, time, values, age=None, sex=None):
+        """
+        Z-score of traces against the normative mean and std.
+        params:
+        - time: array (T,) - Time vector of the traces
+        - values: array (..., T) - One or several traces sharing the same time vector
+        returns:
+        - array (..., T) - Z-scores, NaN where the normative std is 0 or undefined
+        """
+        band = self.lookup(protocol, step, eye, age, sex).at(time)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = (np.asarray(values, dtype=float) - band.mean) / band.std
+        return np.where(band.std > 0, z, np.nan)
+
+    def save(self, filepath):
+        """Save the statistics as a single .npz file (no pickled objects)"""
+        arrays = {
+            "age_bins": np.asarray(self.age_bins),
+            "percentiles": np.asarray(self.percentiles),
+        }
+        for protocol, table in self.tables.items():
+            arrays[f"{protocol}_grid"] = self.grids[protocol]
+            for name, values in table.items():
+                arrays[f"{protocol}_{name}"] = values
+        # np.savez appends .npz to file names, not to open files
+        with atomic_write(filepath) as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, filepath):
+        with np.load(filepath, allow_pickle=False) as data:
+            grids = dict()
+            tables = dict()
+            for key in data.files:
+                protocol, _, name = key.partition("_")
+                if protocol not in PROTOCOLS:
+                    continue
+                if name == "grid":
+                    grids[protocol] = data[key]
+                else:
+                    tables.setdefault(protocol, dict())[name] = data[key]
+            return cls(grids, tables, data["age_bins"].tolist(), data["percentiles"].tolist())
+
+
+def normal_band(
+    normal_data, protocol, step, eye, time, age=None, sex=None
+) -> NormativeBand:
+    """
+    Normative band of a trace on the time vector of a patient, as drawn by the charts.
+    params:
+    - normal_data: NormativeStats, or the list of the normal trials of the protocol (the former input
+    of the charts), whose mean and std are then computed over the trials of the same length as time
+    - protocol, step, eye, age, sex: see NormativeStats.lookup (age and sex are ignored for a list)
+    - time: array (T,) - Time vector of the patient
+    """
+    time = np.asarray(time, dtype=float)
+    if isinstance(normal_data, NormativeStats):
+        return normal_data.lookup(protocol, step, eye, age, sex).at(time)
+    column = eye if step is None else (step, eye)
+    values = np.asarray(
+        [r[column].to_numpy() for r in normal_data if len(r[column]) == len(time)],
+        dtype=float,
+    ).reshape(-1, len(time))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return NormativeBand(
+            time, values.mean(axis=0), values.std(axis=0), dict(), len(values)
+        )
+
+
+def build_normative_stats(results: list, age_bins=AGE_BINS, percentiles=PERCENTILES):
+    """
+    Compute the normative statistics from the normal subjects.
+    params:
+    - results: list - birdshot.io.normal.Results of the normal subjects (with age and sex)
+    returns:
+    - NormativeStats
+    """
+    grids = dict()
+    tables = dict()
+    for protocol in PROTOCOLS:
+        traces = [get_result_traces(r, protocol) for r in results]
+        times = [t for subject in traces for t, _ in subject.values()]
+        if not times:
+            continue
+        grid = canonical_grid(times)
+        T = len(grid)
+
+        # (step, eye) -> resampled traces, age bins and sexes of the subjects
+        groups = dict()
+        for result, subject in zip(results, traces):
+            for key, (time, values) in subject.items():
+                group = groups.setdefault(key, ([], [], []))
+                group[0].append(resample(time, values, grid))
+                group[1].append(age_bin(result.age, age_bins))
+                group[2].append(result.sex)
+
+        table = {
+            name: []
+            for name in ["step", "eye", "age_bin", "sex", "count", "mean", "std", "percentiles"]
+        }
+        for (step, eye), (values, ages, sexes) in groups.items():
+            values = np.stack(values)
+            ages = np.asarray(ages)
+            sexes = np.asarray(sexes)
+            for age in [ALL] + sorted(set(ages.tolist())):
+                for sex in [ALL] + sorted(set(sexes.tolist())):
+                    mask = np.ones(len(values), dtype=bool)
+                    if age != ALL:
+                        mask &= ages == age
+                    if sex != ALL:
+                        mask &= sexes == sex
+                    if not mask.any():
+                        continue
+                    group = values[mask]
+                    table["step"].append(-1 if step is None else step)
+                    table["eye"].append(eye)
+                    table["age_bin"].append(-1 if age == ALL else age)
+                    table["sex"].append(sex)
+                    table["count"].append(int(mask.sum()))
+                    # Samples outside of the time range of every subject of the group stay NaN
+                    with warnings.catch_warnings():
+                        warnings.simplefilter("ignore", RuntimeWarning)
+                        table["mean"].append(np.nanmean(group, axis=0))
+                        table["std"].append(np.nanstd(group, axis=0))
+                        table["percentiles"].append(
+                            nanpercentile(group, percentiles)
+                        )
+        grids[protocol] = grid
+        tables[protocol] = {
+            "step": np.asarray(table["step"], dtype=np.int64),
+            "eye": np.asarray(table["eye"], dtype=str),
+            "age_bin": np.asarray(table["age_bin"], dtype=np.int64),
+            "sex": np.asarray(table["sex"], dtype=str),
+            "count": np.asarray(table["count"], dtype=np.int64),
+            "mean": np.asarray(table["mean"]).reshape(-1, T),
+            "std": np.asarray(table["std"]).reshape(-1, T),
+            "percentiles": np.asarray(table["percentiles"]).reshape(
+                -1, len(percentiles), T
+            ),
+        }
+    return NormativeStats(grids, tables, age_bins, percentiles)
+
+
+@lru_cache(maxsize=4)
+def get_normative_stats(filepath=NORMATIVE_STATS_PATH, results_path=None):
+    """
+    Load the normative statistics, computing them from the normal database (see birdshot.io.normal)
+    the first time, or when the database is more recent than the statistics.
+    The pickled normal results are used when no database was built.
+    """
+    from birdshot.io.normal import NORMAL_DATABASE_PATH, load_normal_database
+
+    if results_path is None:
+        results_path = NORMAL_DATABASE_PATH
+        if not Path(results_path).exists():
+            results_path = NORMAL_RESULTS_PATH
+    filepath = Path(filepath)
+    results_path = Path(results_path)
+    if filepath.exists() and (
+        not results_path.exists()
+        or filepath.stat().st_mtime >= results_path.stat().st_mtime
+    ):
+        return NormativeStats.load(filepath)
+
+    if results_path.suffix == ".npz":
+        results = load_normal_database(results_path)
+    else:
+        with open(results_path, "rb") as f:
+            results = pickle.load(f)
+    stats = build_normative_stats(results)
+    try:
+        stats.save(filepath)
+    except OSError as e:
+        warnings.warn(f"Could not save the normative statistics to {filepath}: {e}")
+    return stats
@@ -1,141 +1,171 @@
 import numpy as np
 import pandas as pd
 
+INDEX_NAMES = ["Technique", "Wave", "Laterality", "Data type"]
+KEYS = ["patient", "year"] + INDEX_NAMES
+SCOTO_ROD = "Scotopic (rod function)"
+SCOTO_ROD_CONE = "Scotopic (rod-cone function)"
+F30 = "Photopic Flicker30HZ (cone function)"
+
+
+def to_long_format(results: dict) -> pd.DataFrame:
+    """
+    Reshape per-patient result frames (index Technique, Wave, Laterality, Data type and one column
+    per visit) into a single long table with one row per value.
+    The ground truth (load_gt_spreadcheet, one column per year) and the predictions
+    (ERGFeatureExtractor.format_results, one column per visit date) share this layout.
+    params:
+    - results: dict - patient -> DataFrame
+    returns:
+    - pd.DataFrame with columns patient, visit (column label), year, Technique, Wave, Laterality,
+    Data type and value (float, non numeric values are dropped)
+    """
+    columns = ["patient", "visit", "year"] + INDEX_NAMES + ["value"]
+    patients = []
+    visits = []
+    index = []
+    values = []
+    # Column-major flattening: all the rows of the first visit, then of the second visit, ...
+    for patient, df in results.items():
+        nrows, ncolumns = df.shape
+        if nrows * ncolumns == 0:
+            continue
+        patients.append(np.full(nrows * ncolumns, patient, dtype=object))
+        visits.append(np.repeat(np.asarray(df.columns, dtype=object), nrows))
+        index.append(np.tile(np.asarray(df.index.tolist(), dtype=object), (ncolumns, 1)))
+        values.append(df.to_numpy(dtype=object).transpose().ravel())
+    if not values:
+        return pd.DataFrame(columns=columns)
+    table = pd.DataFrame(np.concatenate(index), columns=INDEX_NAMES)
+    table["patient"] = np.concatenate(patients)
+    table["visit"] = np.concatenate(visits)
+    table["value"] = pd.to_numeric(np.concatenate(values), errors="coerce")
+    table = table.dropna(subset=["value"])
+
+    # Visits are either years (ground truth) or dates (predictions)
+    visits = pd.Series(table["visit"].unique())
+    years = pd.to_numeric(visits, errors="coerce")
+    dates = pd.to_datetime(visits[years.isna()], errors="coerce")
+    years[years.isna()] = dates.dt.year
+    table["year"] = table["visit"].map(dict(zip(visits, years))).astype(float)
+
+    # The flicker responses have one amplitude and one time per peak, compared through their mean
+    flicker = table["Technique"] == F30
+    data_types = table.loc[flicker, "Data type"]
+    normalized = {
+        d: next((t for t in ["amp", "time"] if t in str(d)), d) for d in data_types.unique()
+    }
+    table.loc[flicker, "Data type"] = data_types.map(normalized)
+    return table[columns].reset_index(drop=True)
+
+
+def match_results(gt, pred, verbose=True) -> pd.DataFrame:
+    """
+    Match the predictions of every visit with the ground truth of the same patient and year,
+    with a single merge of the long tables.
+    Repeated rows (e.g. the flicker peaks) are averaged per visit first.
+    params:
+    - gt: dict - patient -> DataFrame, as returned by load_gt_spreadcheet
+    - pred: dict - patient -> DataFrame, as returned by ERGFeatureExtractor.format_results
+    - verbose: bool (default True) - Print the visits without ground truth for their year
+    returns:
+    - pd.DataFrame with columns patient, year, Technique, Wave, Laterality, Data type, visit, gt,
+    pred, and the Bland-Altman mean ((gt + pred) / 2) and difference (pred - gt)
+    """
+    gt = to_long_format(gt).groupby(KEYS, as_index=False)["value"].mean()
+    pred = to_long_format(pred).groupby(KEYS + ["visit"], as_index=False)["value"].mean()
+    gt = gt.rename(columns={"value": "gt"})
+    pred = pred.rename(columns={"value": "pred"})
+
+    if verbose:
+        patients = pred["patient"].isin(gt["patient"].unique())
+        visits = pred.loc[patients, ["patient", "year", "visit"]].drop_duplicates()
+        known = visits.merge(
+            gt[["patient", "year"]].drop_duplicates(), how="left", indicator=True
+        )
+        for patient, year in known.loc[
+            known["_merge"] == "left_only", ["patient", "year"]
+        ].itertuples(index=False):
+            print(f"Year {year:.0f} not in gt of patient {patient}")
+
+    matched = gt.merge(pred, on=KEYS, how="inner")
+    matched = matched[KEYS + ["visit", "gt", "pred"]]
+    matched["mean"] = (matched["gt"] + matched["pred"]) / 2
+    matched["difference"] = matched["pred"] - matched["gt"]
+    return matched
+
+
+def compute_scores(matched: pd.DataFrame, by=("Technique", "Wave", "Data type")):
+    """
+    Agreement between ground truth and predictions for every metric at once.
+    params:
+    - matched: pd.DataFrame - As returned by match_results
+    - by: list of columns (default Technique, Wave, Data type) - The metrics, both eyes are pooled.
+    Add "Laterality" to score each eye separately.
+    returns:
+    - pd.DataFrame indexed by the metrics, with columns n, r2 (same as sklearn.metrics.r2_score),
+    mae, bias (mean difference), sd (std of the differences) and the Bland-Altman limits of
+    agreement loa_low, loa_high (bias -/+ 1.96 sd)
+    """
+    by = list(by)
+    table = matched[by + ["gt", "pred", "difference"]].copy()
+    groups = table.groupby(by)
+    table["residual"] = table["difference"] ** 2
+    table["total"] = (table["gt"] - groups["gt"].transform("mean")) ** 2
+    table["error"] = table["difference"].abs()
+    scores = table.groupby(by).agg(
+        n=("gt", "size"),
+        residual=("residual", "sum"),
+        total=("total", "sum"),
+        mae=("error", "mean"),
+        bias=("difference", "mean"),
+        sd=("difference", "std"),
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores["r2"] = 1 - scores["residual"] / scores["total"]
+    scores["loa_low"] = scores["bias"] - 1.96 * scores["sd"]
+    scores["loa_high"] = scores["bias"] + 1.96 * scores["sd"]
+    return scores[["n", "r2", "mae", "bias", "sd", "loa_low", "loa_high"]]
+
+
+def score_results(gt, pred, by=("Technique", "Wave", "Data type"), verbose=True):
+    """Match the predictions with the ground truth and score every metric (see compute_scores)"""
+    return compute_scores(match_results(gt, pred, verbose=verbose), by=by)
+
+
+def _paired_values(matched, technique, names):
+    """Matched values of some metrics of a technique, as lists <name> pred and <name> gt"""
+    matched = matched[matched["Technique"] == technique]
+    results = dict()
+    for c in ["pred", "gt"]:
+        for name, (wave, data_type) in names.items():
+            rows = matched[(matched["Wave"] == wave) & (matched["Data type"] == data_type)]
+            results[f"{name} {c}"] = rows[c].tolist()
+    return results
+
 
 def extract_scoto_rod_score(gt, pred):
-    gt_patients = gt.keys()
-    pred_patients = pred.keys()
-    patients = set(gt_patients).intersection(pred_patients)
-    results = {"amp pred": [], "time pred": [], "amp gt": [], "time gt": []}
-
-    for patient in patients:
-        df_gt = gt[patient]
-        df_pred = pred[patient]
-        for date in df_pred.columns:
-            year = date.year
-            if year not in df_gt.columns:
-                print(f"Year {year} not in gt of patient {patient}")
-                continue
-            for laterality in ["OD", "OS"]:
-                for technique in ["amp", "time"]:
-                    val_gt = df_gt.loc[
-                        ("Scotopic (rod function)", "b-wave", laterality, technique)
-                    ].squeeze()
-                    val_pred = df_pred.loc[
-                        ("Scotopic (rod function)", "b-wave", laterality, technique)
-                    ].squeeze()
-
-                    val_pred_d = val_pred[date]
-                    val_gt_y = val_gt[year]
-
-                    if np.isnan(val_pred_d) or np.isnan(val_gt_y):
-                        continue
-                    results[f"{technique} pred"].append(val_pred_d)
-                    results[f"{technique} gt"].append(val_gt_y)
-    return pd.DataFrame(results)
+    matched = match_results(gt, pred)
+    results = _paired_values(
+        matched,
+        SCOTO_ROD,
+        {"amp": ("b-wave", "amp"), "time": ("b-wave", "time")},
+    )
+    return pd.DataFrame({k: pd.Series(v, dtype=float) for k, v in results.items()})
 
 
 def extract_scoto_cone_rod_score(gt, pred):
-    gt_patients = gt.keys()
-    pred_patients = pred.keys()
-    patients = set(gt_patients).intersection(pred_patients)
-    cols = ["amp b-wave", "amp a-wave", "time b-wave", "time a-wave"]
-    results = dict()
-    for c in ["gt", "pred"]:
-        for col in cols:
-            results[f"{col} {c}"] = []
-
-    for patient in patients:
-        df_gt = gt[patient]
-        df_pred = pred[patient]
-        for date in df_pred.columns:
-            year = date.year
-            if year not in df_gt.columns:
-                print(f"Year {year} not in gt of patient {patient}")
-                continue
-            for wave in ["b-wave", "a-wave"]:
-                for laterality in ["OD", "OS"]:
-                    for technique in ["amp", "time"]:
-                        val_gt = df_gt.loc[
-                            (
-                                "Scotopic (rod-cone function)",
-                                wave,
-                                laterality,
-                                technique,
-                            )
-                        ].squeeze()
-                        val_pred = df_pred.loc[
-                            (
-                                "Scotopic (rod-cone function)",
-                                wave,
-                                laterality,
-                                technique,
-                            )
-                        ].squeeze()
-                        val_pred_d = val_pred[date]
-                        val_gt_y = val_gt[year]
-
-                        if not isinstance(val_pred_d, (int, float)):
-                            continue
-
-                        if not isinstance(val_gt_y, (int, float)):
-                            continue
-
-                        if np.isnan(val_pred_d) or np.isnan(val_gt_y):
-                            continue
-
-                        results[f"{technique} {wave} pred"].append(val_pred_d)
-                        results[f"{technique} {wave} gt"].append(val_gt_y)
-
-    return results
+    matched = match_results(gt, pred)
+    names = {
+        f"{data_type} {wave}": (wave, data_type)
+        for data_type in ["amp", "time"]
+        for wave in ["b-wave", "a-wave"]
+    }
+    results = _paired_values(matched, SCOTO_ROD_CONE, names)
+    return {k: results[k] for c in ["gt", "pred"] for k in [f"{n} {c}" for n in names]}
 
 
 def extract_f30_score(gt, pred):
-    gt_patients = gt.keys()
-    pred_patients = pred.keys()
-    patients = set(gt_patients).intersection(pred_patients)
-    results = {"F30 amp pred": [], "F30 amp gt": []}
-
-    for patient in patients:
-        df_gt = gt[patient]
-        df_pred = pred[patient]
-        for date in df_pred.columns:
-            year = date.year
-            if year not in df_gt.columns:
-                print(f"Year {year} not in gt of patient {patient}")
-                continue
-            for laterality in ["OD", "OS"]:
-                try:
-                    val_gt = df_gt.loc[
-                        (
-                            "Photopic Flicker30HZ (cone function)",
-                            "b-wave",
-                            laterality,
-                        )
-                    ].squeeze()
-                    val_pred = df_pred.loc[
-                        (
-                            "Photopic Flicker30HZ (cone function)",
-                            "b-wave",
-                            laterality,
-                        )
-                    ].squeeze()
-                except KeyError:
-                    continue
-
-                val_pred_d = val_pred[date]
-                val_gt_y = val_gt[year]
-                indices = ["amp" in c for c in val_pred_d.index]
-                val_pred_d = val_pred_d[indices]
-                indices = ["amp" in c for c in val_gt_y.index]
-                val_gt_y = val_gt_y[indices]
-                val_pred_d = val_pred_d.mean()
-                try:
-                    val_gt_y = val_gt_y.mean()
-                except TypeError:
-                    continue
-                if np.isnan(val_pred_d) or np.isnan(val_gt_y):
-                    continue
-                results[f"F30 amp pred"].append(val_pred_d)
-                results[f"F30 amp gt"].append(val_gt_y)
+    matched = match_results(gt, pred)
+    results = _paired_values(matched, F30, {"F30 amp": ("b-wave", "amp")})
     return pd.DataFrame(results)
@@ -0,0 +1,308 @@
+import json
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from birdshot.io.cache import TIME_COLUMN
+from birdshot.io.files import list_patients
+from birdshot.io.load import load_patient
+from birdshot.io.utils import extract_visit_date_from_filepath
+
+ARCHIVE_VERSION = 2
+PROTOCOLS = ["Scoto", "Photo", "F30"]
+# Types of the index fields, explicit so the tables of a protocol without recordings stay valid
+RECORDING_DTYPES = {
+    "patient": str,
+    "date": "datetime64[D]",
+    "path": str,
+    "mtime_ns": np.int64,
+    "size": np.int64,
+    "time_offset": np.int64,
+    "length": np.int64,
+}
+TRACE_DTYPES = {"recording": np.int64, "step": np.int64, "eye": str, "offset": np.int64}
+
+
+def pack_cohort(patients: dict, output_dir, verbose=True):
+    """
+    Convert the output of list_patients into a columnar archive in output_dir.
+    For each protocol, all traces are written one after the other in a single contiguous
+    float32 file ({protocol}.traces.f32), the time vectors of each recording in {protocol}.time.f32,
+    and the index tables (patient, visit date, source path with its mtime and size, step, eye,
+    offsets) in {protocol}.index.npz.
+    Recordings are streamed to disk one at a time, so the cohort never has to fit in memory.
+    Files that cannot be loaded are skipped and listed in meta.json.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    meta = {"version": ARCHIVE_VERSION, "protocols": {}, "skipped": []}
+
+    for protocol in PROTOCOLS:
+        recordings = {k: [] for k in RECORDING_DTYPES}
+        traces = {k: [] for k in TRACE_DTYPES}
+        offset = 0
+        time_offset = 0
+        with (
+            open(output_dir / f"{protocol}.traces.f32", "wb") as traces_file,
+            open(output_dir / f"{protocol}.time.f32", "wb") as time_file,
+        ):
+            for patient, files in patients.items():
+                for filepath in files[protocol]:
+                    try:
+                        stat = Path(filepath).stat()
+                        df = load_patient(filepath)
+                        date = extract_visit_date_from_filepath(Path(filepath))
+                    except Exception as e:
+                        if verbose:
+                            print(f"Skipping {filepath}: {e}")
+                        meta["skipped"].append({"path": str(filepath), "error": str(e)})
+                        continue
+
+                    columns = [c for c in df.columns if c != TIME_COLUMN]
+                    length = len(df)
+                    block = np.ascontiguousarray(
+                        df[columns].to_numpy(dtype=np.float32).transpose()
+                    )
+                    block.tofile(traces_file)
+                    df[TIME_COLUMN].to_numpy(dtype=np.float32).tofile(time_file)
+
+                    index = len(recordings["patient"])
+                    recordings["patient"].append(patient)
+                    recordings["date"].append(np.datetime64(date, "D"))
+                    recordings["path"].append(str(Path(filepath).resolve()))
+                    recordings["mtime_ns"].append(stat.st_mtime_ns)
+                    recordings["size"].append(stat.st_size)
+                    recordings["time_offset"].append(time_offset)
+                    recordings["length"].append(length)
+                    for step, eye in columns:
+                        traces["recording"].append(index)
+                        traces["step"].append(step)
+                        traces["eye"].append(eye)
+                        traces["offset"].append(offset)
+                        offset += length
+                    time_offset += length
+
+        np.savez(
+            output_dir / f"{protocol}.index.npz",
+            **{
+                f"recording_{k}": np.asarray(v, dtype=RECORDING_DTYPES[k])
+                for k, v in recordings.items()
+            },
+            **{f"trace_{k}": np.asarray(v, dtype=TRACE_DTYPES[k]) for k, v in traces.items()},
+        )
+        meta["protocols"][protocol] = {
+            "recordings": len(recordings["patient"]),
+            "traces": len(traces["step"]),
+            "samples": offset,
+            "time_samples": time_offset,
+        }
+
+    # meta.json is written last, its presence marks a complete archive
+    with open(output_dir / "meta.json", "w") as f:
+        json.dump(meta, f, indent=2)
+    return CohortArchive(output_dir)
+
+
+class CohortArchive:
+    """
+    Reader of an archive written by pack_cohort.
+    Trace samples are memory-mapped, only the index tables are loaded in memory.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / "meta.json") as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != ARCHIVE_VERSION:
+            raise ValueError(
+                f"Unsupported archive version {self.meta['version']}, expected {ARCHIVE_VERSION}"
+            )
+        self._recordings = {}
+        self._traces = {}
+        self._samples = {}
+        self._time = {}
+        self._files = None
+
+    def __repr__(self):
+        return f"CohortArchive(path={str(self.path)!r})"
+
+    def __reduce__(self):
+        # Sent to worker processes by path, the memory maps are reopened there
+        return (CohortArchive, (self.path,))
+
+    def _load_index(self, protocol):
+        with np.load(self.path / f"{protocol}.index.npz", allow_pickle=False) as data:
+            recordings = pd.DataFrame(
+                {
+                    k.removeprefix("recording_"): data[k]
+                    for k in data.files
+                    if k.startswith("recording_")
+                }
+            )
+            traces = pd.DataFrame(
+                {
+                    k.removeprefix("trace_"): data[k]
+                    for k in data.files
+                    if k.startswith("trace_")
+                }
+            )
+        traces["length"] = recordings["length"].values[traces["recording"].values]
+        traces = traces.join(recordings[["patient", "date"]], on="recording")
+        self._recordings[protocol] = recordings
+        self._traces[protocol] = traces
+
+    def _memmap(self, protocol, kind, n):
+        if n == 0:
+            return np.zeros(0, dtype=np.float32)
+        return np.memmap(
+            self.path / f"{protocol}.{kind}.f32", dtype=np.float32, mode="r", shape=(n,)
+        )
+
+    def recordings(self, protocol) -> pd.DataFrame:
+        """Table of the recordings (one per file) of a protocol"""
+        if protocol not in self._recordings:
+            self._load_index(protocol)
+        return self._recordings[protocol]
+
+    def index(self, protocol) -> pd.DataFrame:
+        """Table of the traces of a protocol: recording, step, eye, offset, length, patient and date"""
+        if protocol not in self._traces:
+            self._load_index(protocol)
+        return self._traces[protocol]
+
+    def samples(self, protocol) -> np.ndarray:
+        """Memory-mapped float32 array holding all the traces of a protocol"""
+        if protocol not in self._samples:
+            n = self.meta["protocols"][protocol]["samples"]
+            self._samples[protocol] = self._memmap(protocol, "traces", n)
+        return self._samples[protocol]
+
+    def times(self, protocol) -> np.ndarray:
+        """Memory-mapped float32 array holding the time vectors of all the recordings of a protocol"""
+        if protocol not in self._time:
+            n = self.meta["protocols"][protocol]["time_samples"]
+            self._time[protocol] = self._memmap(protocol, "time", n)
+        return self._time[protocol]
+
+    def patients(self):
+        patients = set()
+        for protocol in PROTOCOLS:
+            patients.update(self.recordings(protocol)["patient"])
+        return sorted(patients)
+
+    def find_recording(self, protocol, patient, date) -> int:
+        recordings = self.recordings(protocol)
+        match = np.flatnonzero(
+            (recordings["patient"].values == patient)
+            & (recordings["date"].values == np.datetime64(date, "D"))
+        )
+        if len(match) == 0:
+            raise KeyError(f"No {protocol} recording for {patient} on {date}")
+        return int(match[-1])
+
+    def get_time(self, protocol, recording: int) -> np.ndarray:
+        row = self.recordings(protocol).iloc[recording]
+        return self.times(protocol)[row["time_offset"] : row["time_offset"] + row["length"]]
+
+    def get_trace(self, protocol, recording: int, step, eye) -> np.ndarray:
+        """Memory-mapped view of a single trace"""
+        traces = self.index(protocol)
+        match = traces[
+            (traces["recording"].values == recording)
+            & (traces["step"].values == step)
+            & (traces["eye"].values == eye)
+        ]
+        if len(match) == 0:
+            raise KeyError(f"No trace for step {step}, eye {eye} in recording {recording}")
+        offset, length = match.iloc[0][["offset", "length"]]
+        return self.samples(protocol)[offset : offset + length]
+
+    def find_file(self, filepath):
+        """
+        Locate a packed export.
+        returns:
+        - (protocol, recording), or None if the file is not in the archive or changed since it was packed
+        """
+        if self._files is None:
+            self._files = dict()
+            for protocol in PROTOCOLS:
+                for r, row in enumerate(self.recordings(protocol).itertuples()):
+                    self._files[row.path] = (protocol, r, row.mtime_ns, row.size)
+        filepath = Path(filepath)
+        entry = self._files.get(str(filepath.resolve()))
+        if entry is None:
+            return None
+        protocol, recording, mtime_ns, size = entry
+        stat = filepath.stat()
+        if (stat.st_mtime_ns, stat.st_size) != (mtime_ns, size):
+            return None
+        return protocol, recording
+
+    def load_patient(self, protocol, recording: int) -> pd.DataFrame:
+        """Rebuild the (Step, Eye) DataFrame of a recording, as returned by birdshot.io.load.load_patient"""
+        traces = self.index(protocol)
+        traces = traces[traces["recording"].values == recording]
+        length = self.recordings(protocol).iloc[recording]["length"]
+        # A recording without traces only has its time column
+        start = traces["offset"].iloc[0] if len(traces) else 0
+        block = self.samples(protocol)[start : start + length * len(traces)]
+        columns = pd.MultiIndex.from_arrays(
+            [traces["step"].tolist(), traces["eye"].tolist()], names=["Step", "Eye"]
+        )
+        df = pd.DataFrame(
+            block.reshape(len(traces), length).transpose().astype(np.float64),
+            columns=columns,
+        )
+        df[TIME_COLUMN] = self.get_time(protocol, recording).astype(np.float64)
+        return df
+
+    def stack(self, protocol, step, eyes=("OD", "OS")):
+        """
+        Stack the traces of a given step of every recording of a protocol.
+        returns:
+        - traces: np.ndarray (recordings, time, eyes) - padded with NaN for shorter recordings
+        - time: np.ndarray (recordings, time) - padded with NaN
+        - recordings: pd.DataFrame - the recordings table, aligned with the first axis
+        """
+        recordings = self.recordings(protocol)
+        index = self.index(protocol)
+        index = index[index["step"].values == step]
+        length = int(recordings["length"].max()) if len(recordings) else 0
+        stacked = np.full((len(recordings), length, len(eyes)), np.nan, dtype=np.float32)
+        time = np.full((len(recordings), length), np.nan, dtype=np.float32)
+        samples = self.samples(protocol)
+        times = self.times(protocol)
+        for r, row in enumerate(recordings.itertuples()):
+            time[r, : row.length] = times[row.time_offset : row.time_offset + row.length]
+        for row in index.itertuples():
+            if row.eye not in eyes:
+                continue
+            stacked[row.recording, : row.length, eyes.index(row.eye)] = samples[
+                row.offset : row.offset + row.length
+            ]
+        return stacked, time, recordings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Pack a folder of patients into a columnar cohort archive"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack = subparsers.add_parser("pack")
+    pack.add_argument("input_folder")
+    pack.add_argument("output_dir")
+    pack.add_argument("--quiet", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        archive = pack_cohort(
+            list_patients(args.input_folder), args.output_dir, verbose=not args.quiet
+        )
+        for protocol, info in archive.meta["protocols"].items():
+            print(f"{protocol}: {info['recordings']} recordings, {info['traces']} traces")
+
+
+if __name__ == "__main__":
+    main()
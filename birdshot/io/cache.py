@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+from pathlib import Path
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+TIME_COLUMN = ("", "Time (ms)")
+# A file whose mtime is this close to the time it was indexed may have been rewritten within the
+# mtime granularity of its file system (2 s on FAT, coarser on some network shares)
+RACY_WINDOW_NS = 2 * 10**9
+
+
+@contextmanager
+def atomic_write(filepath, mode="wb"):
+    """
+    Open a uniquely named temporary file next to filepath, moved over filepath once written.
+    A crash never leaves a truncated file, and concurrent writers (threads or processes) never
+    share a temporary file.
+    """
+    filepath = Path(filepath)
+    f = tempfile.NamedTemporaryFile(
+        mode, dir=filepath.parent, prefix=f".{filepath.name}.", suffix=".tmp", delete=False
+    )
+    try:
+        with f:
+            yield f
+        os.replace(f.name, filepath)
+    except BaseException:
+        Path(f.name).unlink(missing_ok=True)
+        raise
+
+
+def file_digest(filepath, chunk_size=1 << 20):
+    """Return the blake2b digest of the content of a file"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def save_traces(filepath, traces: pd.DataFrame):
+    """
+    Save a (Step, Eye) traces DataFrame (as returned by load_patient) to an uncompressed .npz file.
+    The file is written to a temporary location first so a crash never leaves a truncated entry.
+    """
+    columns = [c for c in traces.columns if c != TIME_COLUMN]
+    with atomic_write(filepath) as f:
+        np.savez(
+            f,
+            values=traces[columns].to_numpy(),
+            steps=np.asarray([c[0] for c in columns], dtype=np.int64),
+            eyes=np.asarray([c[1] for c in columns], dtype=str),
+            time=traces[TIME_COLUMN].to_numpy(),
+        )
+
+
+def load_traces(filepath) -> pd.DataFrame:
+    """Load a traces DataFrame saved with save_traces"""
+    with np.load(filepath, allow_pickle=False) as data:
+        columns = pd.MultiIndex.from_arrays(
+            [data["steps"].tolist(), data["eyes"].tolist()], names=["Step", "Eye"]
+        )
+        traces = pd.DataFrame(data["values"], columns=columns)
+        traces[TIME_COLUMN] = data["time"]
+    return traces
+
+
+class RecordingCache:
+    """
+    Persistent on-disk cache of parsed recordings.
+    Each source file is tracked by a small index entry (keyed by its resolved path) holding its
+    mtime, size and content digest. The traces themselves are stored once per content digest,
+    so an entry is reused as long as the content is unchanged, even if the file was touched or copied.
+    The content digest is checked whenever the mtime alone cannot be trusted: the file was touched,
+    or its mtime is within RACY_WINDOW_NS of the time it was indexed (a same-size rewrite in the
+    same mtime tick).
+    The total size of the stored traces is capped, least recently used entries are evicted first,
+    along with the index entries pointing to them.
+    """
+
+    def __init__(self, directory, max_size=1024**3):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+
+    def _index_path(self, filepath):
+        key = hashlib.blake2b(
+            str(Path(filepath).resolve()).encode(), digest_size=16
+        ).hexdigest()
+        return self.directory / f"{key}.json"
+
+    def _data_path(self, digest):
+        return self.directory / f"{digest}.npz"
+
+    def _write_index(self, index_path, entry):
+        with atomic_write(index_path, mode="w") as f:
+            f.write(json.dumps(entry))
+
+    def get(self, filepath):
+        """Return the cached traces of filepath, or None if missing or stale"""
+        filepath = Path(filepath)
+        stat = filepath.stat()
+        index_path = self._index_path(filepath)
+        try:
+            entry = json.loads(index_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if entry["size"] != stat.st_size:
+            return None
+        racy = stat.st_mtime_ns >= entry.get("indexed_ns", 0) - RACY_WINDOW_NS
+        if entry["mtime_ns"] != stat.st_mtime_ns or racy:
+            # The file was touched or possibly rewritten, only the content digest can tell
+            if file_digest(filepath) != entry["digest"]:
+                return None
+            # Verified now, so the entry is trusted again once the mtime is old enough
+            entry["mtime_ns"] = stat.st_mtime_ns
+            entry["indexed_ns"] = time.time_ns()
+            self._write_index(index_path, entry)
+
+        data_path = self._data_path(entry["digest"])
+        try:
+            traces = load_traces(data_path)
+        except (FileNotFoundError, ValueError, KeyError, OSError):
+            # The traces were evicted, the entry is useless
+            index_path.unlink(missing_ok=True)
+            return None
+        # Mark the entry as recently used
+        os.utime(data_path)
+        return traces
+
+    def put(self, filepath, traces: pd.DataFrame):
+        filepath = Path(filepath)
+        stat = filepath.stat()
+        entry = {
+            "path": str(filepath),
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "digest": file_digest(filepath),
+            "indexed_ns": time.time_ns(),
+        }
+        data_path = self._data_path(entry["digest"])
+        save_traces(data_path, traces)
+        self._write_index(self._index_path(filepath), entry)
+        self.evict(keep=[data_path])
+
+    def load(self, filepath, loader):
+        """Return the cached traces of filepath, calling loader(filepath) and storing the result on a miss"""
+        traces = self.get(filepath)
+        if traces is None:
+            traces = loader(filepath)
+            self.put(filepath, traces)
+        return traces
+
+    def size(self):
+        return sum(f.stat().st_size for f in self.directory.glob("*.npz"))
+
+    def evict(self, keep=()):
+        """
+        Remove the least recently used traces until the cache fits in max_size, then the index
+        entries pointing to removed traces.
+        The traces in keep (e.g. the entry just written) are never removed.
+        """
+        keep = {Path(f) for f in keep}
+        entries = []
+        total = 0
+        for f in self.directory.glob("*.npz"):
+            try:
+                stat = f.stat()
+            except FileNotFoundError:
+                continue
+            total += stat.st_size
+            if f not in keep:
+                entries.append((stat.st_mtime_ns, stat.st_size, f))
+        entries.sort(key=lambda x: x[0])
+        evicted = False
+        for _, size, f in entries:
+            if total <= self.max_size:
+                break
+            f.unlink(missing_ok=True)
+            total -= size
+            evicted = True
+        if evicted:
+            self._evict_index()
+
+    def _evict_index(self):
+        """Remove the index entries whose traces are gone"""
+        for f in self.directory.glob("*.json"):
+            try:
+                digest = json.loads(f.read_text())["digest"]
+            except (FileNotFoundError, ValueError, KeyError):
+                f.unlink(missing_ok=True)
+                continue
+            if not self._data_path(digest).exists():
+                f.unlink(missing_ok=True)
+
+    def clear(self):
+        for f in self.directory.glob("*.npz"):
+            f.unlink(missing_ok=True)
+        for f in self.directory.glob("*.json"):
+            f.unlink(missing_ok=True)
+
+
+_recording_cache = None
+
+
+def set_recording_cache(directory, max_size=1024**3):
+    """
+    Enable the persistent cache used by load_patient in directory.
+    Passing None disables it.
+    By default the cache is enabled only if the BIRDSHOT_CACHE_DIR environment variable is set.
+    """
+    global _recording_cache
+    if directory is None:
+        _recording_cache = False
+    else:
+        _recording_cache = RecordingCache(directory, max_size=max_size)
+    return _recording_cache
+
+
+def get_recording_cache():
+    global _recording_cache
+    if _recording_cache is None:
+        directory = os.environ.get("BIRDSHOT_CACHE_DIR")
+        max_size = int(os.environ.get("BIRDSHOT_CACHE_MAX_SIZE", 1024**3))
+        set_recording_cache(directory, max_size=max_size)
+    return _recording_cache or None
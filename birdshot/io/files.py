@@ -1,6 +1,28 @@
 from pathlib import Path
 from datetime import datetime
 
+PROTOCOLS = ["Scoto", "Photo", "F30"]
+
+
+def file_protocol(filepath: Path | str) -> str | None:
+    """Protocol of an export from its name (Scoto, Photo or F30), None if unknown"""
+    stem = Path(filepath).stem
+    if "F30" in stem:
+        return "F30"
+    elif "Scoto" in stem:
+        return "Scoto"
+    elif "Photo" in stem:
+        return "Photo"
+    return None
+
+
+def file_date(filepath: Path | str) -> datetime:
+    """Visit date of an export, from its name (e.g. P001 (2015.04.10) Scoto.TXT)"""
+    return datetime.strptime(
+        Path(filepath).stem.split(" ")[1].replace("(", "").replace(")", ""),
+        "%Y.%m.%d",
+    )
+
 
 def list_patient_files(patient_directory: Path | str) -> dict[str, list]:
     """List files in a patient directory.
@@ -15,24 +37,21 @@ def list_patient_files(patient_directory: Path | str) -> dict[str, list]:
     files_dict = {"Scoto": [], "Photo": [], "F30": []}
 
     for file in files:
-        if "F30" in file.stem:
-            files_dict["F30"].append(file)
-        elif "Scoto" in file.stem:
-            files_dict["Scoto"].append(file)
-        elif "Photo" in file.stem:
-            files_dict["Photo"].append(file)
+        protocol = file_protocol(file)
+        if protocol is not None:
+            files_dict[protocol].append(file)
 
     for key in files_dict:
-        files_dict[key].sort(
-            key=lambda x: datetime.strptime(
-                x.stem.split(" ")[1].replace("(", "").replace(")", ""),
-                "%Y.%m.%d",
-            )
-        )
+        files_dict[key].sort(key=file_date)
 
     return files_dict
 
 
+def patient_number(patient_name: str) -> int:
+    """Number of a patient folder, e.g. 1 for Patient 001"""
+    return int(patient_name.split(" ")[1])
+
+
 def list_patients(input_folder):
     """List all patients in a folder"""
     input_folder = Path(input_folder)
@@ -46,7 +65,7 @@ def list_patients(input_folder):
     # Sort the dict by key
 
     all_patients = dict(
-        sorted(all_patients.items(), key=lambda x: int(x[0].split(" ")[1]))
+        sorted(all_patients.items(), key=lambda x: patient_number(x[0]))
     )
 
     return all_patients
@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import warnings
+import threading
+from pathlib import Path
+
+from birdshot.io.cache import atomic_write
+from birdshot.io.files import PROTOCOLS, file_protocol, file_date, patient_number
+
+INDEX_VERSION = 1
+
+
+def user_cache_dir() -> Path:
+    """Cache folder of the user (LOCALAPPDATA on Windows, ~/Library/Caches on macOS, else XDG)"""
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or Path.home() / "AppData" / "Local"
+    elif sys.platform == "darwin":
+        base = Path.home() / "Library" / "Caches"
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "birdshot"
+
+
+def default_index_path(root) -> Path:
+    """
+    Location of the index of an archive: in BIRDSHOT_CACHE_DIR if set, otherwise in the cache folder
+    of the user, so the archive itself (often a read-only share) is never written to.
+    """
+    root = Path(root).resolve()
+    directory = os.environ.get("BIRDSHOT_CACHE_DIR") or user_cache_dir()
+    key = hashlib.blake2b(str(root).encode(), digest_size=8).hexdigest()
+    return Path(directory) / f"index_{key}.json"
+
+
+class ArchiveIndex:
+    """
+    Persistent index of the exports of a folder of patients (the layout expected by list_patients).
+    Each file is recorded with its patient, protocol, visit date, size and mtime, and each patient
+    folder with its mtime. refresh only rescans the patient folders whose mtime changed (files
+    added, removed or renamed), so listing a large archive costs one directory listing of the root.
+    Folders can also be watched for changes with watchdog (see watch), they are then rescanned
+    lazily on the next listing.
+    """
+
+    def __init__(self, root, filepath=None, refresh=True):
+        self.root = Path(root)
+        self.filepath = Path(filepath) if filepath is not None else default_index_path(root)
+        self.directories = dict()
+        self.files = dict()
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._observer = None
+        self._load()
+        if refresh:
+            self.refresh()
+
+    def _load(self):
+        try:
+            entry = json.loads(self.filepath.read_text())
+        except (FileNotFoundError, ValueError):
+            return
+        if entry.get("version") != INDEX_VERSION or entry.get("root") != str(
+            self.root.resolve()
+        ):
+            return
+        self.directories = entry["directories"]
+        self.files = {name: tuple(f) for name, f in entry["files"].items()}
+
+    def save(self):
+        """Save the index, a location that cannot be written only costs a rescan next time"""
+        entry = {
+            "version": INDEX_VERSION,
+            "root": str(self.root.resolve()),
+            "directories": self.directories,
+            "files": self.files,
+        }
+        try:
+            self.filepath.parent.mkdir(parents=True, exist_ok=True)
+            with atomic_write(self.filepath, mode="w") as f:
+                json.dump(entry, f)
+        except OSError as e:
+            warnings.warn(f"Could not save the archive index to {self.filepath}: {e}")
+
+    def _remove_directory(self, name) -> int:
+        prefix = f"{name}/"
+        removed = [f for f in self.files if f.startswith(prefix)]
+        for f in removed:
+            del self.files[f]
+        self.directories.pop(name, None)
+        return len(removed)
+
+    def _scan_directory(self, name) -> int:
+        """Rescan one patient folder, returns the number of files added, removed or modified"""
+        directory = self.root / name
+        try:
+            # Taken before listing, so files added during the scan are seen by the next refresh
+            mtime = directory.stat().st_mtime_ns
+            entries = list(os.scandir(directory))
+        except (FileNotFoundError, NotADirectoryError):
+            return self._remove_directory(name)
+
+        prefix = f"{name}/"
+        previous = {f for f in self.files if f.startswith(prefix)}
+        changed = 0
+        for entry in entries:
+            if not entry.name.endswith(".TXT") or not entry.is_file():
+                continue
+            protocol = file_protocol(entry.name)
+            if protocol is None:
+                continue
+            key = prefix + entry.name
+            previous.discard(key)
+            stat = entry.stat()
+            if key in self.files and self.files[key][3:] == (stat.st_size, stat.st_mtime_ns):
+                continue
+            try:
+                date = file_date(entry.name).date().isoformat()
+            except (ValueError, IndexError):
+                date = None
+            self.files[key] = (name, protocol, date, stat.st_size, stat.st_mtime_ns)
+            changed += 1
+        for key in previous:
+            del self.files[key]
+        self.directories[name] = mtime
+        return changed + len(previous)
+
+    def refresh(self, deep=False, save=True) -> int:
+        """
+        Update the index from the file system.
+        params:
+        - deep: bool (default False) - Rescan every patient folder, to catch the files modified in
+        place (which do not change the mtime of their folder)
+        - save: bool (default True) - Save the index if anything changed
+        returns:
+        - Number of files added, removed or modified
+        """
+        folders = dict()
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and not entry.name.startswith("."):
+                folders[entry.name] = entry.stat().st_mtime_ns
+        with self._lock:
+            self._dirty.clear()
+            changed = 0
+            for name in set(self.directories) - set(folders):
+                changed += self._remove_directory(name)
+            for name, mtime in folders.items():
+                if deep or self.directories.get(name) != mtime:
+                    changed += self._scan_directory(name)
+            if save and changed:
+                self.save()
+        return changed
+
+    def _update(self):
+        """Rescan the folders reported by the watcher"""
+        with self._lock:
+            if not self._dirty:
+                return
+            changed = sum(self._scan_directory(name) for name in self._dirty)
+            self._dirty.clear()
+            if changed:
+                self.save()
+
+    def _notify(self, path):
+        try:
+            relative = Path(os.fsdecode(path)).relative_to(self.root)
+        except ValueError:
+            return
+        if relative.parts and not relative.parts[0].startswith("."):
+            with self._lock:
+                self._dirty.add(relative.parts[0])
+
+    def watch(self, polling=False):
+        """
+        Watch the archive for changes with watchdog, in a background thread.
+        The changed patient folders are rescanned on the next call to list_patients or
+        list_patient_files.
+        params:
+        - polling: bool (default False) - Poll the file system instead of relying on native
+        events, which network shares usually do not deliver
+        """
+        from watchdog.events import FileSystemEventHandler
+
+        if polling:
+            from watchdog.observers.polling import PollingObserver as Observer
+        else:
+            from watchdog.observers import Observer
+
+        index = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                index._notify(event.src_path)
+                if getattr(event, "dest_path", ""):
+                    index._notify(event.dest_path)
+
+        if self._observer is None:
+            self._observer = Observer()
+            self._observer.schedule(Handler(), str(self.root), recursive=True)
+            self._observer.daemon = True
+            self._observer.start()
+        return self._observer
+
+    def stop(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+        self._update()
+
+    def list_patient_files(self, patient) -> dict[str, list]:
+        """Same as birdshot.io.files.list_patient_files, from the index"""
+        self._update()
+        files = {protocol: [] for protocol in PROTOCOLS}
+        prefix = f"{patient}/"
+        # The watcher thread may rescan folders meanwhile
+        with self._lock:
+            entries = list(self.files.items())
+        for key, (_, protocol, date, _, _) in entries:
+            if key.startswith(prefix):
+                files[protocol].append((date is None, date or "", self.root / key))
+        # Files without a date in their name are listed last
+        return {protocol: [f[2] for f in sorted(files[protocol])] for protocol in files}
+
+    def list_patients(self) -> dict:
+        """Same as birdshot.io.files.list_patients, from the index"""
+        self._update()
+        patients = dict()
+        with self._lock:
+            entries = list(self.files.items())
+        for key, (name, protocol, date, _, _) in entries:
+            files = patients.setdefault(name, {p: [] for p in PROTOCOLS})
+            files[protocol].append((date is None, date or "", self.root / key))
+        patients = {
+            Path(name).stem: {p: [f[2] for f in sorted(files[p])] for p in PROTOCOLS}
+            for name, files in patients.items()
+        }
+        return dict(sorted(patients.items(), key=lambda x: patient_number(x[0])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or update the index of a patient archive")
+    parser.add_argument("input_folder")
+    parser.add_argument("--index", default=None)
+    parser.add_argument("--deep", action="store_true")
+    args = parser.parse_args()
+
+    index = ArchiveIndex(args.input_folder, filepath=args.index, refresh=False)
+    changed = index.refresh(deep=args.deep)
+    print(f"{len(index.files)} files indexed in {index.filepath}, {changed} changed")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,115 +1,54 @@
+import os
 import pandas as pd
 import numpy as np
 from pathlib import Path
-import datetime
-from streamlit.runtime.uploaded_file_manager import UploadedFile
-from copy import deepcopy
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from birdshot.io.cache import get_recording_cache
+from birdshot.io.recording import read_recording
 
 
 def extract_age_and_sex(filepath):
-    age = None
-    sex = None
-    if isinstance(filepath, UploadedFile):
-        f = filepath.getvalue().decode("unicode_escape").split("\n")
-        for i, line in enumerate(f):
-            if line.startswith("DOB"):
-                DOB = line.split("\t")[1]
-                # DOB is in the format YYYY-MM-DD
-
-                age = datetime.datetime.now().year - int(DOB.split("-")[0])
-            if line.startswith("Gender"):
-                sex = line.split("\t")[1][0]
-    else:
-        with open(filepath, "r", encoding="unicode_escape") as f:
-            for i, line in enumerate(f):
-                if line.startswith("DOB"):
-                    DOB = line.split("\t")[1]
-                    # DOB is in the format YYYY-MM-DD
-
-                    age = datetime.datetime.now().year - int(DOB.split("-")[0])
-                if line.startswith("Gender"):
-                    sex = line.split("\t")[1][0]
-
-    return age, sex
+    recording = read_recording(filepath)
+    return recording.age, recording.sex
 
 
 def find_data_line(filepath):
-    if isinstance(filepath, UploadedFile):
-        f = filepath.getvalue().decode("unicode_escape").split("\n")
-        for i, line in enumerate(f):
-            if line.startswith("Data Table"):
-                try:
-                    return int(line.split("\t")[2]) - 2
-                except ValueError:
-                    return i + 2
-    else:
-        with open(filepath, "r", encoding="unicode_escape") as f:
-            for i, line in enumerate(f):
-                if line.startswith("Data Table"):
-                    try:
-                        return int(line.split("\t")[2]) - 2
-                    except ValueError:
-                        return i + 2
-
-    raise ValueError("Data line not found in file")
+    recording = read_recording(filepath)
+    if recording.data_line is None:
+        raise ValueError("Data line not found in file")
+    return recording.data_line
 
 
 def find_stimulus_line(filepath):
-    if isinstance(filepath, UploadedFile):
-        f = filepath.getvalue().decode("unicode_escape").split("\n")
-        for i, line in enumerate(f):
-            if line.startswith("Stimulus Table"):
-                start = int(line.split("\t")[2])
-                end = int(line.split("\t")[4])
-                return start - 3, end
-    else:
-        with open(filepath, "r", encoding="unicode_escape") as f:
-            for i, line in enumerate(f):
-                if line.startswith("Stimulus Table"):
-                    start = int(line.split("\t")[2])
-                    end = int(line.split("\t")[4])
-                    return start - 3, end - 1
-
-    raise ValueError("Stimulus line not found in file")
+    recording = read_recording(filepath)
+    if recording.stimulus_lines is None:
+        raise ValueError("Stimulus line not found in file")
+    return recording.stimulus_lines
 
 
 def find_marker_line(filepath):
-    if isinstance(filepath, UploadedFile):
-        f = filepath.getvalue().decode("unicode_escape").split("\n")
-        for i, line in enumerate(f):
-            if line.startswith("Marker Table"):
-                values = line.split("\t")
-                begin = int(values[2])
-                end = int(values[4])
-                return begin - 3, end
-    else:
-        with open(filepath, "r", encoding="unicode_escape") as f:
-            for i, line in enumerate(f):
-                if line.startswith("Marker Table"):
-                    values = line.split("\t")
-                    begin = int(values[2])
-                    end = int(values[4])
-                    return begin - 3, end
-
-    raise ValueError("Marker line not found in file")
-
-
-def load_patient(filepath):
-    if isinstance(filepath, str):
-        filepath = Path(filepath)
-
-    data_line = find_data_line(filepath)
-    try:
-        df = pd.read_csv(
-            deepcopy(filepath), sep="\t", skiprows=data_line, encoding="unicode_escape"
-        )
-    except pd.errors.EmptyDataError:
-        df = pd.read_csv(
-            deepcopy(filepath),
-            sep="\t",
-            skiprows=data_line + 1,
-            encoding="unicode_escape",
-        )
+    recording = read_recording(filepath)
+    if recording.marker_lines is None:
+        raise ValueError("Marker line not found in file")
+    return recording.marker_lines
+
+
+def load_patient(filepath, use_cache=True):
+    """
+    Load the traces of an ERG export as a DataFrame indexed by (Step, Eye).
+    filepath can be a path, an uploaded file or an already read ERGRecording.
+    Paths are served from the persistent recording cache when it is enabled
+    (see birdshot.io.cache.set_recording_cache).
+    """
+    cache = get_recording_cache()
+    if use_cache and cache is not None and isinstance(filepath, (str, Path)):
+        return cache.load(filepath, parse_patient)
+    return parse_patient(filepath)
+
+
+def parse_patient(filepath):
+    df = read_recording(filepath).data_table
 
     # First columns is the trials
     trials = df[df.columns[0]]
@@ -125,28 +64,7 @@ def get_photo_step_for_patient(filepath, val=5.0):
     """
     Get the step for the val (cd.s/m2) asked
     """
-    if isinstance(filepath, str):
-        filepath = Path(filepath)
-
-    stimulus_line_start, stimulus_line_end = find_stimulus_line(filepath)
-    nrows = stimulus_line_end - stimulus_line_start
-
-    try:
-        df = pd.read_csv(
-            deepcopy(filepath),
-            sep="\t",
-            skiprows=stimulus_line_start,
-            nrows=nrows,
-            encoding="unicode_escape",
-        )
-    except pd.errors.EmptyDataError:
-        df = pd.read_csv(
-            deepcopy(filepath),
-            sep="\t",
-            skiprows=stimulus_line_start,
-            nrows=nrows + 1,
-            encoding="unicode_escape",
-        )
+    df = read_recording(filepath).stimulus_table
     df = df[df.columns[:3]]
     df = df[1:]
     col_intensity = df.columns[-1]
@@ -192,40 +110,144 @@ def extract_data(df: pd.DataFrame, trials, indexes, channels, relevant_channels)
     return dfBoth
 
 
-def load_gt_spreadcheet(filepath):
-    excelFile = pd.ExcelFile(filepath)
-    patients = {}
-    for sheet in excelFile.sheet_names[1:]:
-        patient = int(
-            pd.read_excel(excelFile, sheet_name=sheet, header=None)
-            .loc[0, 1]
-            .split("Patient ")[1]
-        )
-        df = pd.read_excel(excelFile, sheet_name=sheet, header=1)
-        indices = np.arange(len(df))
-        good = indices >= 5
-        df = df.loc[good]
-        name_index = ["Technique", "Wave", "Laterality", "Data type"]
-        indices_cols = df.columns[:4]
-        data = df[df.columns[4:]]
-        data = data.dropna(how="all", axis=1)
-        indices_values = df[indices_cols].ffill().values
-
-        # Remove spaces from index values
-        indices_values = np.array([list(map(str.strip, row)) for row in indices_values])
-
-        data.index = pd.MultiIndex.from_arrays(
-            indices_values.transpose(), names=name_index
-        )
-        patients[patient] = data
+GT_INDEX_NAMES = ["Technique", "Wave", "Laterality", "Data type"]
+# Rows between the header and the first value of the ground truth sheets
+GT_SKIPPED_ROWS = 5
+# Strings read as missing values by pd.read_excel
+NA_STRINGS = {
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND",
+    "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+}
+
+# Parsed ground truth workbooks, by path (least recently used first)
+_gt_cache = OrderedDict()
+GT_CACHE_SIZE = 4
+
+
+def _header_labels(header):
+    """Column labels as given by pd.read_excel: unnamed columns and duplicates are renamed"""
+    labels = []
+    counts = dict()
+    for i, label in enumerate(header):
+        if label is None:
+            label = f"Unnamed: {i}"
+        if label in counts:
+            counts[label] += 1
+            label = f"{label}.{counts[label]}"
+        else:
+            counts[label] = 0
+        labels.append(label)
+    return labels
+
+
+def parse_gt_sheet(rows):
+    """
+    Parse the rows (tuples of cell values) of a ground truth sheet.
+    The first row holds the patient name ("Patient X") in its second cell, the second row the
+    column names (4 index columns, then one column per year).
+    returns:
+    - patient number, DataFrame indexed by (Technique, Wave, Laterality, Data type)
+    """
+    rows = iter(rows)
+    patient = int(next(rows)[1].split("Patient ")[1])
+    labels = _header_labels(next(rows))
+    values = list(rows)
+    # Trailing blank rows are dropped, as in pd.read_excel
+    while values and all(v is None for v in values[-1]):
+        values.pop()
+    values = values[GT_SKIPPED_ROWS:]
+    width = len(labels)
+    values = [
+        tuple(None if isinstance(v, str) and v in NA_STRINGS else v for v in row[:width])
+        + (None,) * (width - len(row))
+        for row in values
+    ]
+    df = pd.DataFrame.from_records(values, columns=labels)
+    data = df[df.columns[4:]].dropna(how="all", axis=1)
+    index = df[df.columns[:4]].ffill()
+    data.index = pd.MultiIndex.from_arrays(
+        [index[c].astype(str).str.strip().to_numpy() for c in index.columns],
+        names=GT_INDEX_NAMES,
+    )
+    return patient, data
+
+
+def _parse_gt_sheets(workbook, sheet_names):
+    """Parse some sheets of an open ground truth workbook, in a single streaming pass each"""
+    sheets = []
+    for sheet in sheet_names:
+        worksheet = workbook[sheet]
+        # The dimensions stored in the file may be wrong (e.g. written by another tool),
+        # read-only sheets would then be truncated or padded
+        worksheet.reset_dimensions()
+        sheets.append(parse_gt_sheet(worksheet.iter_rows(values_only=True)))
+    return sheets
+
+
+def _read_gt_sheets(filepath, sheet_names):
+    """Read some sheets of a ground truth workbook (see _parse_gt_sheets)"""
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(filepath, read_only=True, data_only=True)
+    try:
+        return _parse_gt_sheets(workbook, sheet_names)
+    finally:
+        workbook.close()
+
+
+def load_gt_spreadcheet(filepath, max_workers=1, use_cache=True):
+    """
+    Load the ground truth workbook (one sheet per patient, the first sheet is skipped).
+    Each sheet is read once in openpyxl read-only mode.
+    params:
+    - filepath: str or Path
+    - max_workers: int (default 1) - Number of worker processes parsing the sheets. If 1, the sheets
+    are parsed serially in the current process. None uses the number of CPUs.
+    - use_cache: bool (default True) - Reuse the result of a previous call until the workbook changes
+    (mtime or size), the last GT_CACHE_SIZE workbooks are kept
+    returns:
+    - dict patient number -> DataFrame indexed by (Technique, Wave, Laterality, Data type), with one
+    column per year
+    """
+    import openpyxl
+
+    filepath = Path(filepath)
+    stat = filepath.stat()
+    key = str(filepath.resolve())
+    version = (stat.st_mtime_ns, stat.st_size)
+    if use_cache and key in _gt_cache and _gt_cache[key][0] == version:
+        _gt_cache.move_to_end(key)
+        return {p: df.copy() for p, df in _gt_cache[key][1].items()}
+
+    workbook = openpyxl.load_workbook(filepath, read_only=True, data_only=True)
+    try:
+        sheet_names = workbook.sheetnames[1:]
+        if max_workers == 1:
+            # The workbook is only opened once
+            sheets = _parse_gt_sheets(workbook, sheet_names)
+    finally:
+        workbook.close()
+    if max_workers != 1:
+        # One chunk of consecutive sheets per worker, so each worker opens the workbook once
+        n = max_workers or os.cpu_count() or 1
+        size = -(-len(sheet_names) // n) or 1
+        chunks = [sheet_names[i : i + size] for i in range(0, len(sheet_names), size)]
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_read_gt_sheets, filepath, c) for c in chunks]
+            sheets = [sheet for f in futures for sheet in f.result()]
+
+    patients = dict(sheets)
+    if use_cache:
+        _gt_cache[key] = (version, patients)
+        _gt_cache.move_to_end(key)
+        while len(_gt_cache) > GT_CACHE_SIZE:
+            _gt_cache.popitem(last=False)
+        return {p: df.copy() for p, df in patients.items()}
     return patients
 
 
 def extract_markers(filepath):
-    begin, end = find_marker_line(filepath)
-    df = pd.read_csv(
-        filepath, sep="\t", skiprows=begin, nrows=end - begin, encoding="unicode_escape"
-    )
+    df = read_recording(filepath).marker_table
     df = df.dropna(how="all", axis=1)
     df = df.dropna(how="all", axis=0)
 
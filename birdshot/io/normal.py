@@ -1,9 +1,24 @@
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
 from birdshot.analysis.markers import (
     extract_f30_analysis,
     extract_scoto_rod_analysis,
     extract_scoto_rod_cone_analysis,
 )
+from birdshot.analysis.normative import NORMATIVE_STATS_PATH, build_normative_stats
+from birdshot.io.cache import TIME_COLUMN, atomic_write
+from birdshot.io.files import list_patients
 from birdshot.io.load import load_patient, get_photo_step_for_patient
+from birdshot.io.recording import read_recording
+
+NORMAL_DATABASE_VERSION = 1
+NORMAL_DATABASE_PATH = "models/normal_database.npz"
+PROTOCOLS = ["scoto", "f30", "photo"]
 
 
 class Results:
@@ -30,52 +45,248 @@ class Results:
         return f"Results(scoto={self.scoto}, f30={self.f30}, photo={self.photo})"
 
 
-def get_normal_trials(data):
+def load_control_visit(patient, index, files):
+    """
+    Load the traces of one visit of a control subject.
+    params:
+    - patient: str - Name of the subject folder, e.g. "Control 001 (F) 35yrs"
+    - index: int - Index of the visit in the subject files
+    - files: dict - The subject files, as returned by list_patient_files
+    returns:
+    - Results
+    """
     plot = False
+    p = patient.split(" ")[1]
+    sex = patient.split("(")[1][0]
+    years = patient.split("yrs")[0][-2:]
+    result = Results(None, None, None, years, p, sex, index)
+
+    result.scoto = (
+        extract_scoto_rod_analysis(
+            load_patient(files["Scoto"][index]),
+            plot=plot,
+            filtered=False,
+            return_filtered=True,
+        )
+    )[-1]
+    result.f30 = extract_f30_analysis(
+        load_patient(files["F30"][index]), plot=plot, filtered=False, return_filtered=True
+    )[-1]
+
+    recording = read_recording(files["Photo"][index])
+    photo_step = get_photo_step_for_patient(recording)
+    trials = load_patient(recording)
+    time = trials[("", "Time (ms)")]
+    trial = trials[photo_step].copy()
+    trial["Time (ms)"] = time
+    result.photo = trial
+    return result
+
+
+def _load_control_visit(patient, index, files):
+    """
+    Worker of build_normal_database, the errors of incomplete exports (missing step or file) are
+    returned instead of raised
+    """
+    try:
+        return load_control_visit(patient, index, files), None
+    except (KeyError, IndexError) as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def build_normal_database(data, max_workers=None, verbose=True):
+    """
+    Load all the visits of the control subjects in parallel.
+    Visits that cannot be loaded are skipped and reported.
+    params:
+    - data: dict - The output of list_patients on the control subjects folder
+    - max_workers: int (default None) - Number of worker processes (defaults to the number of CPUs).
+    If 1, everything is run serially in the current process.
+    returns:
+    - list of Results, in the order of the subjects and visits
+    - pd.DataFrame of the skipped visits (patient, index, files, error)
+    """
+    tasks = [
+        (patient, i, data[patient])
+        for patient in data
+        for i in range(len(data[patient]["Scoto"]))
+    ]
+    if max_workers == 1:
+        outputs = [_load_control_visit(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_load_control_visit, *task) for task in tasks]
+            outputs = [f.result() for f in futures]
+
     all_results = []
-    for patient in data:
-        p = patient.split(" ")[1]
-        sex = patient.split("(")[1][0]
-
-        nfiles = len(data[patient]["Scoto"])
-        years = patient.split("yrs")[0][-2:]
-        for i in range(nfiles):
-            result = Results(None, None, None, years, p, sex, i)
-            scoto_file = data[patient]["Scoto"][i]
-            laterality = []
-            if "use only" in scoto_file.name:
-                if "OS" in scoto_file.name:
-                    laterality.append("OS")
-                if "OD" in scoto_file.name:
-                    laterality.append("OD")
-            else:
-                laterality = ["OS", "OD"]
-            result.scoto = (
-                extract_scoto_rod_analysis(
-                    load_patient(scoto_file),
-                    plot=plot,
-                    filtered=False,
-                    return_filtered=True,
-                )
-            )[-1]
-
-            f30_file = data[patient]["F30"][i]
-            result.f30 = extract_f30_analysis(
-                load_patient(f30_file), plot=plot, filtered=False, return_filtered=True
-            )[-1]
-
-            photo_file = data[patient]["Photo"][i]
-
-            try:
-                photo_step = get_photo_step_for_patient(photo_file)
-                trials = load_patient(photo_file)
-            except (KeyError, IndexError):
-                print(f"Could not load patient data {patient}")
-                continue
-            time = trials[("", "Time (ms)")]
-            trial = trials[photo_step]
-            trial["Time (ms)"] = time
-
-            result.photo = trial
+    skipped = []
+    for (patient, i, files), (result, error) in zip(tasks, outputs):
+        if result is not None:
             all_results.append(result)
-    return all_results
+            continue
+        if verbose:
+            print(f"Could not load patient data {patient} ({error})")
+        visit_files = [
+            str(files[protocol][i])
+            for protocol in ["Scoto", "F30", "Photo"]
+            if i < len(files[protocol])
+        ]
+        skipped.append(
+            {
+                "patient": patient,
+                "index": i,
+                "files": ";".join(visit_files),
+                "error": error,
+            }
+        )
+    return all_results, pd.DataFrame(
+        skipped, columns=["patient", "index", "files", "error"]
+    )
+
+
+def get_normal_trials(data):
+    return build_normal_database(data, max_workers=1)[0]
+
+
+def _pack_frames(frames: list, prefix: str) -> dict:
+    """
+    Pack a list of traces DataFrames into flat arrays.
+    The traces of each frame are stored one after the other (float32), frames without steps
+    (photopic trials) are stored with step -1.
+    """
+    if not frames:
+        raise ValueError(f"No {prefix} traces to save, every control visit was skipped")
+    values = []
+    times = []
+    steps = []
+    eyes = []
+    ncolumns = []
+    for frame in frames:
+        time_column = TIME_COLUMN if TIME_COLUMN in frame.columns else "Time (ms)"
+        columns = [c for c in frame.columns if c != time_column]
+        values.append(frame[columns].to_numpy(dtype=np.float32).transpose().ravel())
+        times.append(frame[time_column].to_numpy(dtype=np.float32))
+        for c in columns:
+            step, eye = c if isinstance(c, tuple) else (-1, c)
+            steps.append(step)
+            eyes.append(eye)
+        ncolumns.append(len(columns))
+    return {
+        f"{prefix}_values": np.concatenate(values),
+        f"{prefix}_time": np.concatenate(times),
+        f"{prefix}_length": np.asarray([len(t) for t in times], dtype=np.int64),
+        f"{prefix}_columns": np.asarray(ncolumns, dtype=np.int64),
+        f"{prefix}_steps": np.asarray(steps, dtype=np.int64),
+        f"{prefix}_eyes": np.asarray(eyes, dtype=str),
+    }
+
+
+def _unpack_frames(data, prefix: str) -> list:
+    values = data[f"{prefix}_values"]
+    times = data[f"{prefix}_time"]
+    steps = data[f"{prefix}_steps"].tolist()
+    eyes = data[f"{prefix}_eyes"].tolist()
+    frames = []
+    offset = time_offset = column = 0
+    for length, ncolumns in zip(data[f"{prefix}_length"], data[f"{prefix}_columns"]):
+        block = values[offset : offset + length * ncolumns].reshape(ncolumns, length)
+        frame_steps = steps[column : column + ncolumns]
+        frame_eyes = eyes[column : column + ncolumns]
+        time = times[time_offset : time_offset + length].astype(np.float64)
+        if all(step < 0 for step in frame_steps):
+            frame = pd.DataFrame(
+                block.transpose().astype(np.float64),
+                columns=pd.Index(frame_eyes, name="Eye"),
+            )
+            frame["Time (ms)"] = time
+        else:
+            columns = pd.MultiIndex.from_arrays(
+                [frame_steps, frame_eyes], names=["Step", "Eye"]
+            )
+            frame = pd.DataFrame(block.transpose().astype(np.float64), columns=columns)
+            frame[TIME_COLUMN] = time
+        frames.append(frame)
+        offset += length * ncolumns
+        time_offset += length
+        column += ncolumns
+    return frames
+
+
+def save_normal_database(results: list, filepath):
+    """
+    Save the control subjects traces as a versioned .npz artifact made of plain arrays only,
+    so it can be loaded without unpickling pandas objects.
+    """
+    arrays = {
+        "version": np.asarray(NORMAL_DATABASE_VERSION),
+        "subject_patient": np.asarray([r.patient for r in results], dtype=str),
+        "subject_index": np.asarray([r.index for r in results], dtype=np.int64),
+        "subject_age": np.asarray([r.age for r in results], dtype=np.int64),
+        "subject_sex": np.asarray([r.sex for r in results], dtype=str),
+    }
+    for protocol in PROTOCOLS:
+        arrays.update(_pack_frames([getattr(r, protocol) for r in results], protocol))
+    # np.savez appends .npz to file names, not to open files
+    with atomic_write(filepath) as f:
+        np.savez(f, **arrays)
+
+
+def load_normal_database(filepath=NORMAL_DATABASE_PATH) -> list:
+    """Load the Results saved with save_normal_database"""
+    with np.load(filepath, allow_pickle=False) as data:
+        version = int(data["version"])
+        if version != NORMAL_DATABASE_VERSION:
+            raise ValueError(
+                f"Unsupported normal database version {version}, expected {NORMAL_DATABASE_VERSION}"
+            )
+        frames = {protocol: _unpack_frames(data, protocol) for protocol in PROTOCOLS}
+        return [
+            Results(
+                frames["scoto"][i],
+                frames["f30"][i],
+                frames["photo"][i],
+                age=age,
+                patient=str(patient),
+                sex=str(sex),
+                index=int(index),
+            )
+            for i, (patient, index, age, sex) in enumerate(
+                zip(
+                    data["subject_patient"],
+                    data["subject_index"],
+                    data["subject_age"],
+                    data["subject_sex"],
+                )
+            )
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rebuild the normative database from a folder of control subjects"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build")
+    build.add_argument("input_folder")
+    build.add_argument("--output", default=NORMAL_DATABASE_PATH)
+    build.add_argument("--stats", default=NORMATIVE_STATS_PATH)
+    build.add_argument("--workers", type=int, default=None)
+    build.add_argument("--quiet", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        results, skipped = build_normal_database(
+            list_patients(args.input_folder),
+            max_workers=args.workers,
+            verbose=not args.quiet,
+        )
+        save_normal_database(results, args.output)
+        build_normative_stats(results).save(args.stats)
+        # The skipped visits are logged next to the database
+        output = Path(args.output)
+        skipped.to_csv(output.with_name(f"{output.stem}.skipped.csv"), index=False)
+        print(f"{len(results)} visits saved to {args.output}, {len(skipped)} skipped")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,14 @@
-import pandas as pd
-from typing import Dict
+import os
 import io
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict
+
+import pandas as pd
+
+from birdshot.io.cache import atomic_write
+
+INDEX_NAMES = ["Technique", "Wave", "Laterality", "Data type"]
 
 
 def write_to_excel(patients_data: Dict[int, pd.DataFrame]):
@@ -14,3 +22,134 @@ def write_to_excel(patients_data: Dict[int, pd.DataFrame]):
             )
     in_memory_fp.seek(0)
     return in_memory_fp.getvalue()
+
+
+def features_to_long(patient, data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert the features of a patient (as returned by ERGFeatureExtractor.format_results)
+    to a long table with one row per (technique, wave, laterality, data type, peak, date).
+    The peak column numbers the repeated rows of a same feature (e.g. the F30 peaks).
+    """
+    long = data.reset_index()
+    long.insert(4, "Peak", long.groupby(INDEX_NAMES, sort=False).cumcount())
+    long = long.melt(id_vars=INDEX_NAMES + ["Peak"], var_name="Date", value_name="Value")
+    long["Date"] = pd.to_datetime(long["Date"])
+    long = long.dropna(subset=["Value"])
+    long.insert(0, "Patient", str(patient))
+    return long
+
+
+class FeatureWriter(ABC):
+    """
+    Base class of the streaming feature exporters.
+    Each call to write stores the features of one patient, so results can be written as soon as
+    they are computed, without keeping the whole cohort in memory.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = Path(filepath)
+
+    @abstractmethod
+    def write(self, patient, data: pd.DataFrame):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CSVFeatureWriter(FeatureWriter):
+    """
+    Append the features of each patient to a long-format CSV file.
+    The file is flushed after every patient, so partial results survive a crash.
+    """
+
+    def __init__(self, filepath, append=False):
+        super().__init__(filepath)
+        write_header = not (append and self.filepath.exists())
+        self._file = open(self.filepath, "a" if append else "w", newline="")
+        self._write_header = write_header
+
+    def write(self, patient, data: pd.DataFrame):
+        features_to_long(patient, data).to_csv(
+            self._file, header=self._write_header, index=False, date_format="%Y-%m-%d"
+        )
+        self._write_header = False
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetFeatureWriter(FeatureWriter):
+    """
+    Write the features of each patient as a separate part of a Parquet dataset (a directory).
+    Each part is a complete file, so partial results survive a crash.
+    The dataset can be read back with pd.read_parquet(filepath).
+    Requires pyarrow (pip install birdshot[parquet]).
+    """
+
+    def __init__(self, filepath):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError as e:
+            raise ImportError(
+                "Parquet export requires pyarrow, install it with pip install birdshot[parquet]"
+            ) from e
+        super().__init__(filepath)
+        self.filepath.mkdir(parents=True, exist_ok=True)
+        self._parts = len(list(self.filepath.glob("part-*.parquet")))
+
+    def write(self, patient, data: pd.DataFrame):
+        path = self.filepath / f"part-{self._parts:05d}.parquet"
+        with atomic_write(path) as f:
+            features_to_long(patient, data).to_parquet(f, index=False)
+        self._parts += 1
+
+
+class ExcelFeatureWriter(FeatureWriter):
+    """
+    Write the features of each patient in its own sheet of an Excel workbook: a header row with the
+    index names and the visit dates, then one row per feature.
+    Unlike write_to_excel, the index cells are repeated on every row instead of being merged
+    (write-only worksheets cannot merge cells), so pd.read_excel(filepath, sheet_name=None,
+    index_col=[0, 1, 2, 3]) reads the sheets back.
+    The workbook is opened in openpyxl write-only mode, rows are streamed to disk so memory stays flat,
+    but the file is only valid once closed.
+    """
+
+    def __init__(self, filepath):
+        from openpyxl import Workbook
+
+        super().__init__(filepath)
+        self._workbook = Workbook(write_only=True)
+
+    def write(self, patient, data: pd.DataFrame):
+        sheet = self._workbook.create_sheet(title=f"{patient}")
+        sheet.append(INDEX_NAMES + [d.strftime("%Y/%m/%d") for d in data.columns])
+        for index, values in zip(data.index, data.itertuples(index=False)):
+            sheet.append(list(index) + [None if pd.isna(v) else v for v in values])
+
+    def close(self):
+        self._workbook.save(self.filepath)
+        self._workbook.close()
+
+
+def open_feature_writer(filepath, **kwargs) -> FeatureWriter:
+    """Return the streaming writer matching the extension of filepath (.csv, .parquet or .xlsx)"""
+    suffix = Path(filepath).suffix.lower()
+    match suffix:
+        case ".csv":
+            return CSVFeatureWriter(filepath, **kwargs)
+        case ".parquet":
+            return ParquetFeatureWriter(filepath, **kwargs)
+        case ".xlsx":
+            return ExcelFeatureWriter(filepath, **kwargs)
+        case _:
+            raise ValueError(f"Unsupported export format {suffix}")
@@ -0,0 +1,119 @@
+import io
+import datetime
+from functools import cached_property
+from pathlib import Path
+
+import pandas as pd
+
+
+def read_export_text(filepath):
+    """Read the whole content of an ERG export (path or uploaded file) as text.
+    Line endings are normalized so that line indices match the ones used by pandas.
+    """
+    if hasattr(filepath, "getvalue"):
+        # Streamlit UploadedFile (or any in-memory binary buffer),
+        # checked by duck typing so that streamlit is not needed here
+        text = filepath.getvalue().decode("unicode_escape")
+    else:
+        with open(filepath, "rb") as f:
+            text = f.read().decode("unicode_escape")
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+class ERGRecording:
+    """
+    In-memory view of an ERG export (.TXT).
+    The file is read once, the positions of the Data, Stimulus and Marker tables
+    as well as the demographic fields are found in a single scan of the lines.
+    Each table is then parsed lazily from memory when first accessed.
+    """
+
+    def __init__(self, text: str, name: str = None):
+        self.name = name
+        self.lines = text.split("\n")
+        self.data_line = None
+        self.stimulus_lines = None
+        self.marker_lines = None
+        self.dob = None
+        self.sex = None
+
+        for i, line in enumerate(self.lines):
+            if self._all_tables_found() and i >= self.data_line:
+                # Only trace samples remain, no need to scan them
+                break
+            if line.startswith("Data Table") and self.data_line is None:
+                try:
+                    self.data_line = int(line.split("\t")[2]) - 2
+                except ValueError:
+                    self.data_line = i + 2
+            elif line.startswith("Stimulus Table") and self.stimulus_lines is None:
+                values = line.split("\t")
+                self.stimulus_lines = (int(values[2]) - 3, int(values[4]) - 1)
+            elif line.startswith("Marker Table") and self.marker_lines is None:
+                values = line.split("\t")
+                self.marker_lines = (int(values[2]) - 3, int(values[4]))
+            elif line.startswith("DOB"):
+                # DOB is in the format YYYY-MM-DD
+                self.dob = line.split("\t")[1]
+            elif line.startswith("Gender"):
+                self.sex = line.split("\t")[1][0]
+
+    def _all_tables_found(self):
+        return (
+            self.data_line is not None
+            and self.stimulus_lines is not None
+            and self.marker_lines is not None
+        )
+
+    @classmethod
+    def from_file(cls, filepath):
+        if isinstance(filepath, str):
+            filepath = Path(filepath)
+        return cls(read_export_text(filepath), name=filepath.name)
+
+    def __repr__(self):
+        return f"ERGRecording(name={self.name!r})"
+
+    @property
+    def age(self):
+        if self.dob is None:
+            return None
+        return datetime.datetime.now().year - int(self.dob.split("-")[0])
+
+    def _read_table(self, skiprows, nrows=None):
+        buffer = io.StringIO("\n".join(self.lines[skiprows:]))
+        return pd.read_csv(buffer, sep="\t", nrows=nrows)
+
+    @cached_property
+    def data_table(self) -> pd.DataFrame:
+        if self.data_line is None:
+            raise ValueError("Data line not found in file")
+        try:
+            return self._read_table(self.data_line)
+        except pd.errors.EmptyDataError:
+            return self._read_table(self.data_line + 1)
+
+    @cached_property
+    def stimulus_table(self) -> pd.DataFrame:
+        if self.stimulus_lines is None:
+            raise ValueError("Stimulus line not found in file")
+        start, end = self.stimulus_lines
+        nrows = end - start
+        try:
+            return self._read_table(start, nrows)
+        except pd.errors.EmptyDataError:
+            return self._read_table(start, nrows + 1)
+
+    @cached_property
+    def marker_table(self) -> pd.DataFrame:
+        if self.marker_lines is None:
+            raise ValueError("Marker line not found in file")
+        begin, end = self.marker_lines
+        return self._read_table(begin, end - begin)
+
+
+def read_recording(filepath) -> ERGRecording:
+    """Return an ERGRecording from a path, an uploaded file or an existing recording"""
+    if isinstance(filepath, ERGRecording):
+        return filepath
+    return ERGRecording.from_file(filepath)
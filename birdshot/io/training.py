@@ -1,25 +1,130 @@
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import pandas as pd
 
 from birdshot.io.load import load_patient, get_photo_step_for_patient, extract_markers
-from birdshot.io.files import list_patient_files, extract_date_from_file
+from birdshot.io.files import list_patients, patient_number
+from birdshot.io.recording import read_recording
+from birdshot.io.utils import extract_visit_date_from_filepath
 from tqdm.auto import tqdm
 
+LATERALITIES = ("OS", "OD")
+MARKERS = ("i", "b", "a")
+# Value of a missing marker in the label columns
+MISSING = np.iinfo(np.int64).min
+
 
 class PatientsData:
-    def __init__(self):
-        self.ids = []
-        self.data = []
-        self.i = []
-        self.b = []
-        self.a = []
-        self.lat = []
-        self.date = []
-        self.index = []
+    """
+    Training samples (one trace per eye and recording) stored in a preallocated float32 matrix
+    that grows geometrically, with integer label columns.
+    Missing markers are stored as MISSING.
+    """
+
+    __slots__ = ("time", "_size", "_data", "_ids", "_index", "_lat", "_date", "_markers")
+
+    def __init__(self, capacity=64):
         self.time = None
+        self._size = 0
+        self._data = None
+        self._ids = np.zeros(capacity, dtype=np.int64)
+        self._index = np.zeros(capacity, dtype=np.int64)
+        self._lat = np.zeros(capacity, dtype=np.int8)
+        self._date = np.full(capacity, np.datetime64("NaT"), dtype="datetime64[D]")
+        self._markers = np.full((capacity, len(MARKERS)), MISSING, dtype=np.int64)
 
     def __len__(self):
-        return len(self.ids)
+        return self._size
+
+    def _grow(self, capacity):
+        def resize(array, fill=0):
+            new = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+            new[: self._size] = array[: self._size]
+            return new
+
+        self._ids = resize(self._ids)
+        self._index = resize(self._index)
+        self._lat = resize(self._lat)
+        self._date = resize(self._date, np.datetime64("NaT"))
+        self._markers = resize(self._markers, MISSING)
+        if self._data is not None:
+            self._data = resize(self._data)
+
+    def append(self, id, x, lat, date, index, i=None, b=None, a=None):
+        """
+        Add a sample.
+        params:
+        - id: int - Patient number
+        - x: array (T,) - The trace, all the traces must have the same length
+        - lat: str - "OS" or "OD"
+        - date: datetime.date - Date of the visit
+        - index: int - Index of the visit
+        - i, b, a: int (default None) - Time of the markers (ms), None if missing
+        """
+        x = np.asarray(x, dtype=np.float32).reshape(-1)
+        if self._size == len(self._ids):
+            self._grow(2 * len(self._ids))
+        if self._data is None:
+            self._data = np.zeros((len(self._ids), len(x)), dtype=np.float32)
+        elif len(x) != self._data.shape[1]:
+            raise ValueError(
+                f"Trace of length {len(x)}, expected {self._data.shape[1]} samples"
+            )
+        n = self._size
+        self._data[n] = x
+        self._ids[n] = id
+        self._index[n] = index
+        self._lat[n] = LATERALITIES.index(lat)
+        self._date[n] = np.datetime64(date, "D")
+        self._markers[n] = [MISSING if m is None else m for m in (i, b, a)]
+        self._size += 1
+
+    def truncate(self, size):
+        """Drop the samples after the first size ones"""
+        if not 0 <= size <= self._size:
+            raise ValueError(f"Cannot truncate {self._size} samples to {size}")
+        self._size = size
+
+    @property
+    def data(self):
+        """Traces (N, T)"""
+        if self._data is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        return self._data[: self._size]
+
+    @property
+    def ids(self):
+        return self._ids[: self._size]
+
+    @property
+    def index(self):
+        return self._index[: self._size]
+
+    @property
+    def lat(self):
+        return np.asarray(LATERALITIES)[self._lat[: self._size]]
+
+    @property
+    def date(self):
+        return self._date[: self._size]
+
+    @property
+    def markers(self):
+        """Time of the i, b and a markers (N, 3)"""
+        return self._markers[: self._size]
+
+    @property
+    def i(self):
+        return self.markers[:, 0]
+
+    @property
+    def b(self):
+        return self.markers[:, 1]
+
+    @property
+    def a(self):
+        return self.markers[:, 2]
 
     def __getitem__(self, key):
         if isinstance(key, str):
@@ -48,65 +153,179 @@ class PatientsData:
             case "a":
                 y = self.a
             case _:
-                npoints = len(x[0])
-                y = []
-                for i, b, a in zip(self.i, self.b, self.a):
-                    gt = np.zeros((npoints))
-                    if i is not None:
-                        i_index = np.searchsorted(self.time.values, i)
-                        gt[i_index] = 1
-                    if b is not None:
-                        b_index = np.searchsorted(self.time.values, b)
-                        gt[b_index] = 2
-                    if a is not None:
-                        a_index = np.searchsorted(self.time.values, a)
-                        gt[a_index] = 3
-
-                    y.append(gt)
-
-        return np.array(x).squeeze(), np.array(y)
-
-
-def get_patients_photopic_trainable_data(root):
-    patients = PatientsData()
-    root = Path(root)
-
-    num_patients = len(list(root.glob("Patient *")))
-    if num_patients == 0:
+                markers = self.markers
+                # Sample index of every marker at once
+                indices = np.searchsorted(self.time, markers.ravel()).reshape(
+                    markers.shape
+                )
+                y = np.zeros(x.shape)
+                # The labels are written in the order i, b, a, the last one wins on a shared sample
+                for column in range(len(MARKERS)):
+                    rows = np.flatnonzero(markers[:, column] != MISSING)
+                    y[rows, indices[rows, column]] = column + 1
+
+        return x, y
+
+    def save(self, filepath):
+        """Save the samples as an .npz file"""
+        np.savez(
+            filepath,
+            time=np.asarray([] if self.time is None else self.time, dtype=float),
+            data=self.data,
+            ids=self.ids,
+            index=self.index,
+            lat=self._lat[: self._size],
+            date=self.date,
+            markers=self.markers,
+        )
+
+    @classmethod
+    def load(cls, filepath):
+        with np.load(filepath, allow_pickle=False) as f:
+            n = len(f["ids"])
+            patients = cls(capacity=max(n, 1))
+            patients.time = f["time"] if f["time"].size else None
+            if f["data"].size:
+                patients._data = f["data"].astype(np.float32)
+            patients._ids[:] = f["ids"]
+            patients._index[:] = f["index"]
+            patients._lat[:] = f["lat"]
+            patients._date[:] = f["date"]
+            patients._markers[:] = f["markers"]
+            patients._size = n
+        return patients
+
+
+def load_photopic_samples(patient_id, index, file):
+    """
+    Read the photopic training samples (both eyes) of one file.
+    The file is read once, its markers are extracted once for both eyes.
+    returns:
+    - list of dict with the arguments of PatientsData.append
+    - time vector of the traces (None if the file could not be read)
+    - list of dict errors (patient, index, file, eye, marker, error)
+    """
+    samples = []
+    errors = []
+
+    def error(message, eye=None, marker=None):
+        errors.append(
+            {
+                "patient": patient_id,
+                "index": index,
+                "file": str(file),
+                "eye": eye,
+                "marker": marker,
+                "error": message,
+            }
+        )
+
+    try:
+        date = extract_visit_date_from_filepath(Path(file))
+        recording = read_recording(file)
+        step = get_photo_step_for_patient(recording)
+        data = load_patient(recording)
+    except Exception as e:
+        error(f"Failed to read file: {type(e).__name__}: {e}")
+        return samples, None, errors
+    time = data[("", "Time (ms)")].to_numpy()
+    try:
+        marker = extract_markers(recording)
+    except KeyError as e:
+        error(f"Failed to read markers: {e}")
+        return samples, time, errors
+
+    for lat in ["OS", "OD"]:
+        values = dict()
+        for m in ["i", "a", "b"]:
+            try:
+                values[m] = int(marker[(step, lat, m)].iloc[0])
+            except (KeyError, ValueError):
+                error("Missing marker", eye=lat, marker=m)
+                values[m] = None
+        samples.append(
+            dict(
+                id=patient_id,
+                x=data[(step, lat)].to_numpy(),
+                lat=lat,
+                date=date,
+                index=index,
+                **values,
+            )
+        )
+    return samples, time, errors
+
+
+def get_patients_photopic_trainable_data(root, max_workers=None, verbose=True):
+    """
+    Build the photopic training set of all the patients of a folder.
+    Files are processed in parallel, the samples keep the order of the patients and visits.
+    params:
+    - root: str or Path - Folder of patients, as expected by list_patients
+    - max_workers: int (default None) - Number of worker processes (defaults to the number of CPUs).
+    If 1, everything is run serially in the current process.
+    returns:
+    - PatientsData
+    - pd.DataFrame of the errors (patient, index, file, eye, marker, error), one row per unreadable
+    file, missing marker or file whose traces do not match the time vector of the others
+    (those files are skipped)
+    """
+    all_patients = list_patients(root)
+    if len(all_patients) == 0:
         raise ValueError("No patients found in the specified directory.")
 
-    for i in tqdm(range(1, num_patients + 1)):
-        patient = f"{i:0=3}"
-        patient_filepath = Path(root) / f"Patient {patient}/"
-        patients_data = list_patient_files(patient_filepath)
-        for index, file in enumerate(patients_data["Photo"]):
-            date = extract_date_from_file(file)
-            for lat in ["OS", "OD"]:
-                step = get_photo_step_for_patient(file)
-
-                data = load_patient(file)
-                patients.time = data[("", "Time (ms)")]
-                x = data[(step, lat)]
-                x = np.expand_dims(x, axis=1)
-                try:
-                    marker = extract_markers(file)
-                except KeyError:
-                    print(f"Failed to read markers for file {file}")
-                    continue
-                patients.ids.append(int(patient))
-                patients.data.append(x)
-                patients.lat.append(lat)
-                patients.date.append(date)
-                patients.index.append(index)
-
-                for m in ["i", "a", "b"]:
-                    try:
-                        pt = int(marker[(step, lat, m)].iloc[0])
-                        patients[m].append(pt)
-                    except (KeyError, ValueError):
-                        print(
-                            f"Patient {patient} does not have marker {m} for {lat} eye, index {index}"
-                        )
-                        patients[m].append(None)
-
-    return patients
+    tasks = [
+        (patient_number(name), index, file)
+        for name, files in all_patients.items()
+        for index, file in enumerate(files["Photo"])
+    ]
+    if max_workers == 1:
+        outputs = (load_photopic_samples(*task) for task in tasks)
+        outputs = list(tqdm(outputs, total=len(tasks), disable=not verbose))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(load_photopic_samples, *task) for task in tasks]
+            outputs = [
+                f.result() for f in tqdm(futures, total=len(tasks), disable=not verbose)
+            ]
+
+    patients = PatientsData(capacity=max(2 * len(tasks), 1))
+    errors = []
+    for (patient_id, index, file), (samples, time, file_errors) in zip(tasks, outputs):
+        errors.extend(file_errors)
+        if not samples:
+            continue
+        # All the samples share the time vector of the first file
+        if patients.time is not None and not (
+            len(time) == len(patients.time) and np.allclose(time, patients.time)
+        ):
+            message = "Time vector differs from the other files"
+        else:
+            message = None
+            try:
+                for n, sample in enumerate(samples):
+                    patients.append(**sample)
+            except ValueError as e:
+                # Samples of the file appended before the error are dropped
+                patients.truncate(len(patients) - n)
+                message = str(e)
+        if message is not None:
+            errors.append(
+                {
+                    "patient": patient_id,
+                    "index": index,
+                    "file": str(file),
+                    "eye": None,
+                    "marker": None,
+                    "error": message,
+                }
+            )
+        elif patients.time is None:
+            patients.time = time
+
+    errors = pd.DataFrame(
+        errors, columns=["patient", "index", "file", "eye", "marker", "error"]
+    )
+    if verbose and len(errors):
+        print(f"{len(errors)} errors while reading {len(tasks)} files")
+    return patients, errors
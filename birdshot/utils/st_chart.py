@@ -1,7 +1,60 @@
+import numpy as np
 import streamlit as st
 import plotly.express as px
 import plotly.graph_objects as go
 
+# Points sent per trace spanning the whole width of a chart (about two per pixel)
+MAX_POINTS = 2000
+# The normal bands are smooth, fewer points are enough
+BAND_POINTS = 300
+# Traces with more points are drawn with WebGL (Scattergl) instead of SVG
+WEBGL_THRESHOLD = 5000
+
+
+def minmax_indices(values, max_points) -> np.ndarray:
+    """
+    Indices of the samples kept by min-max decimation: the values are split in max_points // 2
+    buckets and the minimum and maximum of each bucket are kept (with the first and last samples),
+    so the peaks of a trace are preserved exactly.
+    NaN samples are ignored.
+    """
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    if max_points is None or n <= max_points:
+        return np.arange(n)
+    buckets = max(max_points // 2, 1)
+    edges = np.linspace(0, n, buckets + 1).astype(int)
+    size = int(np.diff(edges).max())
+    indices = edges[:-1, None] + np.arange(size)[None, :]
+    valid = indices < edges[1:, None]
+    indices = np.minimum(indices, n - 1)
+    bucket_values = values[indices]
+    valid &= ~np.isnan(bucket_values)
+    rows = np.arange(buckets)
+    lowest = indices[rows, np.where(valid, bucket_values, np.inf).argmin(axis=1)]
+    highest = indices[rows, np.where(valid, bucket_values, -np.inf).argmax(axis=1)]
+    return np.unique(np.concatenate([lowest, highest, [0, n - 1]]))
+
+
+def decimate(x, y, max_points=MAX_POINTS):
+    """Min-max decimation of a trace (see minmax_indices), returns x and y as arrays"""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    keep = minmax_indices(y, max_points)
+    return x[keep], y[keep]
+
+
+def add_line(fig, x, y, max_points=MAX_POINTS, **kwargs):
+    """
+    Add a trace to a figure, decimated to max_points (None to send every sample).
+    Traces recorded with more than WEBGL_THRESHOLD samples use Scattergl.
+    kwargs are forwarded to go.Scatter (name, line, ...).
+    """
+    # Decided on the raw length, the decimated trace is always under the threshold
+    scatter = go.Scattergl if len(y) > WEBGL_THRESHOLD else go.Scatter
+    x, y = decimate(x, y, max_points)
+    fig.add_trace(scatter(x=x, y=y, mode="lines", **kwargs))
+
 
 def add_fill_between(
     fig,
@@ -11,32 +64,44 @@ def add_fill_between(
     std_mult=2.0,
     color="rgba(0,127,0,0.2)",
     showlegend=True,
+    offsets=(0,),
+    max_points=BAND_POINTS,
 ):
+    """
+    Add the normal band mean +/- std_mult * std as a single filled trace.
+    The band is drawn once for every x offset in offsets (e.g. the visits placed side by side
+    in the progression charts), all in the same trace.
+    """
     opacity = st.session_state.normal_opacity
 
     alpha = color.split(",")[-1]
     alpha = alpha[: alpha.index(")")]
     new_alpha = float(alpha) * opacity
     color = color.replace(alpha + ")", str(new_alpha) + ")")
-    if st.session_state.show_norm:
-        fig.add_trace(
-            go.Scatter(
-                x=time,
-                y=mean_values - std_mult * std_values,
-                name=None,
-                showlegend=False,
-                line=dict(color="rgba(0,0,0,0)"),
-                fillcolor=color,
-            )
-        )
-        fig.add_trace(
-            go.Scatter(
-                x=time,
-                y=mean_values + std_mult * std_values,
-                name=f"{std_mult:.1f} SD",
-                fill="tonexty",
-                line=dict(color="rgba(0,0,0,0)"),
-                fillcolor=color,
-                showlegend=showlegend,
-            )
+    if not st.session_state.show_norm:
+        return
+
+    mean_values = np.asarray(mean_values, dtype=float)
+    std_values = np.asarray(std_values, dtype=float)
+    time = np.asarray(time, dtype=float)
+    # Outside of the normative time range the band is undefined
+    valid = np.isfinite(mean_values) & np.isfinite(std_values)
+    time, mean_values, std_values = time[valid], mean_values[valid], std_values[valid]
+    upper_time, upper = decimate(time, mean_values + std_mult * std_values, max_points)
+    lower_time, lower = decimate(time, mean_values - std_mult * std_values, max_points)
+    # Closed outline: upper bound forward, lower bound backward
+    outline_time = np.concatenate([upper_time, lower_time[::-1], [np.nan]])
+    outline = np.concatenate([upper, lower[::-1], [np.nan]])
+    offsets = np.asarray(offsets, dtype=float)
+    fig.add_trace(
+        go.Scatter(
+            x=(outline_time[None, :] + offsets[:, None]).ravel(),
+            y=np.tile(outline, len(offsets)),
+            name=f"{std_mult:.1f} SD",
+            fill="toself",
+            line=dict(color="rgba(0,0,0,0)"),
+            fillcolor=color,
+            showlegend=showlegend,
+            hoverinfo="skip",
         )
+    )
@@ -0,0 +1,18 @@
+import pytest
+
+import birdshot.io.cache
+from benchmarks.synthetic import write_synthetic_cohort
+from birdshot.io.files import list_patients
+
+
+@pytest.fixture(autouse=True)
+def no_recording_cache(monkeypatch):
+    """The tests parse the exports, whatever BIRDSHOT_CACHE_DIR is"""
+    monkeypatch.setattr(birdshot.io.cache, "_recording_cache", False)
+
+
+@pytest.fixture(scope="session")
+def cohort(tmp_path_factory):
+    """Synthetic cohort of 3 patients with 2 visits each, as returned by list_patients"""
+    root = write_synthetic_cohort(tmp_path_factory.mktemp("cohort"), patients=3, visits=2)
+    return list_patients(root)
@@ -0,0 +1,24 @@
+import os
+
+from birdshot.analysis.cache import AnalysisCache
+
+
+def test_persisted_results_are_reloaded(tmp_path):
+    AnalysisCache(directory=tmp_path).put("key", b"result")
+    cache = AnalysisCache(directory=tmp_path)
+    assert cache.get("key") == b"result"
+    assert cache.get("other") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_disk_eviction_keeps_recently_used_results(tmp_path):
+    cache = AnalysisCache(directory=tmp_path, max_disk_bytes=250)
+    for i, key in enumerate(["a", "b"]):
+        cache.put(key, bytes(100))
+        os.utime(tmp_path / f"{key}.pkl", ns=(i * 10**9, i * 10**9))
+    # Reading "a" from disk marks it as recently used, "b" is evicted first
+    AnalysisCache(directory=tmp_path, max_disk_bytes=250).get("a")
+    cache.put("c", bytes(100))
+    assert sorted(f.stem for f in tmp_path.glob("*.pkl")) == ["a", "c"]
+    assert cache.disk_size() <= 250
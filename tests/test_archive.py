@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from birdshot.analysis.engine import extract_cohort_features
+from birdshot.io.archive import PROTOCOLS, CohortArchive, pack_cohort
+from birdshot.io.load import load_patient
+from birdshot.io.utils import extract_visit_date_from_filepath
+
+
+@pytest.fixture(scope="module")
+def archive(cohort, tmp_path_factory):
+    path = tmp_path_factory.mktemp("archive")
+    pack_cohort(cohort, path, verbose=False)
+    return CohortArchive(path)
+
+
+@pytest.mark.parametrize("protocol", PROTOCOLS)
+def test_archive_round_trip(cohort, archive, protocol):
+    n = sum(len(files[protocol]) for files in cohort.values())
+    assert len(archive.recordings(protocol)) == n
+    for patient, files in cohort.items():
+        for filepath in files[protocol]:
+            date = extract_visit_date_from_filepath(filepath)
+            recording = archive.find_recording(protocol, patient, date)
+            # The archive stores float32 samples
+            pd.testing.assert_frame_equal(
+                archive.load_patient(protocol, recording),
+                load_patient(filepath),
+                check_exact=False,
+                rtol=1e-6,
+                atol=1e-4,
+            )
+
+
+def test_archive_stack(archive):
+    traces, time, recordings = archive.stack("Scoto", 9)
+    for r, filepath in enumerate(recordings["path"]):
+        df = load_patient(filepath)
+        np.testing.assert_allclose(traces[r], df[[(9, "OD"), (9, "OS")]], rtol=1e-6, atol=1e-4)
+        np.testing.assert_allclose(time[r], df[("", "Time (ms)")], rtol=1e-6, atol=1e-4)
+
+
+def test_archive_with_empty_protocol(cohort, tmp_path):
+    patients = {
+        patient: {**files, "F30": []} for patient, files in list(cohort.items())[:2]
+    }
+    archive = pack_cohort(patients, tmp_path / "archive", verbose=False)
+    assert len(archive.recordings("F30")) == 0
+    assert len(archive.index("F30")) == 0
+    assert archive.patients() == list(patients)
+    traces, time, recordings = archive.stack("F30", 1)
+    assert traces.shape == (0, 0, 2) and len(recordings) == 0
+    date = archive.recordings("Scoto")["date"][0]
+    recording = archive.find_recording("Scoto", "Patient 001", date)
+    pd.testing.assert_frame_equal(
+        archive.load_patient("Scoto", recording),
+        load_patient(patients["Patient 001"]["Scoto"][0]),
+        check_exact=False,
+        rtol=1e-6,
+        atol=1e-4,
+    )
+
+
+def test_find_file_skips_changed_exports(cohort, tmp_path):
+    filepath = tmp_path / "P001 (2015.02.10) F30.TXT"
+    filepath.write_bytes(cohort["Patient 001"]["F30"][0].read_bytes())
+    archive = pack_cohort(
+        {"Patient 001": {"Scoto": [], "Photo": [], "F30": [filepath]}},
+        tmp_path / "archive",
+        verbose=False,
+    )
+    assert archive.find_file(filepath) == ("F30", 0)
+    filepath.write_bytes(filepath.read_bytes() + b"\n")
+    assert archive.find_file(filepath) is None
+
+
+def test_cohort_features_from_archive(cohort, archive):
+    # Every recording is read from the archive
+    for files in cohort.values():
+        for protocol in PROTOCOLS:
+            assert all(archive.find_file(f) is not None for f in files[protocol])
+    expected = extract_cohort_features(cohort, max_workers=1, verbose=False)
+    results = extract_cohort_features(
+        cohort, max_workers=2, archive=archive, verbose=False
+    )
+    assert list(results) == list(expected)
+    for patient in expected:
+        # The archive stores float32 samples
+        pd.testing.assert_frame_equal(
+            results[patient], expected[patient], check_exact=False, rtol=1e-4
+        )
@@ -0,0 +1,51 @@
+import os
+
+import pandas as pd
+
+import birdshot.io.cache
+from benchmarks.synthetic import write_synthetic_export
+from birdshot.io.cache import RecordingCache, load_traces, save_traces
+from birdshot.io.load import load_patient, parse_patient
+
+
+def test_traces_round_trip(cohort, tmp_path):
+    for files in cohort.values():
+        for protocol_files in files.values():
+            for filepath in protocol_files:
+                traces = parse_patient(filepath)
+                save_traces(tmp_path / "traces.npz", traces)
+                pd.testing.assert_frame_equal(load_traces(tmp_path / "traces.npz"), traces)
+
+
+def test_cache_hit_matches_parse(cohort, tmp_path):
+    cache = RecordingCache(tmp_path / "cache")
+    filepath = cohort["Patient 001"]["Scoto"][0]
+    reference = parse_patient(filepath)
+    assert cache.get(filepath) is None
+    pd.testing.assert_frame_equal(cache.load(filepath, parse_patient), reference)
+    pd.testing.assert_frame_equal(cache.get(filepath), reference)
+
+
+def test_cache_detects_rewrites(tmp_path):
+    cache = RecordingCache(tmp_path / "cache")
+    filepath = tmp_path / "P001 (2015.02.10) F30.TXT"
+    write_synthetic_export(filepath, "F30", samples=256, seed=0)
+    cache.load(filepath, parse_patient)
+    stat = filepath.stat()
+    # Other content, same mtime
+    write_synthetic_export(filepath, "F30", samples=256, seed=1)
+    os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    pd.testing.assert_frame_equal(
+        cache.load(filepath, parse_patient), parse_patient(filepath)
+    )
+
+
+def test_load_patient_through_cache(cohort, tmp_path, monkeypatch):
+    monkeypatch.setattr(birdshot.io.cache, "_recording_cache", None)
+    monkeypatch.setenv("BIRDSHOT_CACHE_DIR", str(tmp_path / "cache"))
+    filepath = cohort["Patient 002"]["Photo"][1]
+    first = load_patient(filepath)
+    second = load_patient(filepath)
+    pd.testing.assert_frame_equal(first, parse_patient(filepath))
+    pd.testing.assert_frame_equal(second, first)
+    assert any((tmp_path / "cache").glob("*.npz"))
@@ -0,0 +1,80 @@
+import pandas as pd
+import pytest
+
+from birdshot.io.utils import extract_visit_date_from_filepath
+from birdshot.analysis.engine import (
+    ERGFeatureExtractor,
+    extract_cohort_features,
+    extract_stacked_scoto_features,
+    split_patient_files_by_visit,
+)
+
+
+@pytest.fixture(scope="module")
+def serial(cohort):
+    """Features of each patient extracted one file at a time, in the current process"""
+    results = dict()
+    for patient, files in cohort.items():
+        featex = ERGFeatureExtractor(patient_files=files, verbose=False)
+        featex.extract_all_features()
+        results[patient] = featex.format_results()
+    return results
+
+
+def assert_same_features(results, expected):
+    assert list(results) == list(expected)
+    for patient in expected:
+        pd.testing.assert_frame_equal(results[patient], expected[patient])
+
+
+@pytest.mark.parametrize("max_workers, chunk_size", [(1, None), (2, None), (1, 3), (2, 16)])
+def test_cohort_matches_serial(cohort, serial, max_workers, chunk_size):
+    results = extract_cohort_features(
+        cohort, max_workers=max_workers, chunk_size=chunk_size, verbose=False
+    )
+    if chunk_size is None:
+        assert_same_features(results, serial)
+    else:
+        # The stacked kernels reduce in a different order than pandas
+        assert list(results) == list(serial)
+        for patient in serial:
+            pd.testing.assert_frame_equal(results[patient], serial[patient], rtol=1e-9)
+
+
+def test_stacked_kernels_match_per_file(cohort):
+    visits = [
+        visit_files
+        for files in cohort.values()
+        for visit_files in split_patient_files_by_visit(files).values()
+    ]
+    per_file = [ERGFeatureExtractor(patient_files=v, verbose=False) for v in visits]
+    stacked = [ERGFeatureExtractor(patient_files=v, verbose=False) for v in visits]
+    for featex in per_file:
+        featex.extract_scoto_rod_cone_features()
+        featex.extract_scoto_rod_features()
+    extract_stacked_scoto_features(stacked)
+    for expected, featex in zip(per_file, stacked):
+        assert featex.failed_visits == expected.failed_visits
+        assert featex.features_per_visit.keys() == expected.features_per_visit.keys()
+        for date, features in expected.features_per_visit.items():
+            assert len(features) == 12
+            assert featex.features_per_visit[date] == pytest.approx(features)
+
+
+def test_photo_features_match_single_trial(cohort):
+    pytest.importorskip("torch")
+    from birdshot.analysis.context import AnalysisContext
+    from birdshot.analysis.markers import extract_photo_analysis
+
+    files = next(iter(cohort.values()))
+    featex = ERGFeatureExtractor(patient_files=files, verbose=False)
+    featex.extract_photo_features()
+    assert not featex.failed_visits
+    for filepath in files["Photo"]:
+        features = featex.features_per_visit[extract_visit_date_from_filepath(filepath)]
+        markers = extract_photo_analysis(AnalysisContext(filepath).photo_trial())
+        for eye in ["OS", "OD"]:
+            for label in ["a", "b", "i"]:
+                (time,), (amplitude,) = markers[f"{eye} {label}"]
+                assert features[f"Photo_{label.upper()}_time_{eye}"] == time
+                assert features[f"Photo_{label.upper()}_amp_{eye}"] == pytest.approx(amplitude)
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+import scipy.signal
+
+from birdshot.analysis.filter import (
+    TIME_COLUMN,
+    butter_lowpass,
+    get_step_columns,
+    low_pass_filter,
+)
+from birdshot.io.load import load_patient
+
+
+@pytest.fixture(scope="module")
+def trial(cohort):
+    return load_patient(cohort["Patient 001"]["Scoto"][0])
+
+
+def sampling_rate(trial):
+    time = trial[TIME_COLUMN]
+    return len(trial) / (time.iloc[-1] - time.iloc[0]) * 1000
+
+
+@pytest.mark.parametrize("cutoff", [75, 150])
+def test_filtfilt_matches_per_column(trial, cutoff):
+    b, a = butter_lowpass(cutoff, sampling_rate(trial))
+    filtered = low_pass_filter(trial, cutoff)
+    assert filtered.columns.equals(trial.columns)
+    np.testing.assert_array_equal(filtered[TIME_COLUMN], trial[TIME_COLUMN])
+    for c in trial.columns:
+        if c != TIME_COLUMN:
+            expected = scipy.signal.filtfilt(b, a, trial[c].to_numpy())
+            np.testing.assert_allclose(filtered[c], expected, rtol=1e-10, atol=1e-10)
+
+
+def test_filtfilt_columns_subset(trial):
+    columns = get_step_columns(trial, 19)
+    filtered = low_pass_filter(trial, 75, columns=columns)
+    assert list(filtered.columns) == columns + [TIME_COLUMN]
+    np.testing.assert_allclose(filtered[columns], low_pass_filter(trial, 75)[columns])
+
+
+def test_sosfiltfilt_matches_per_column(trial):
+    sos = butter_lowpass(75, sampling_rate(trial), sos=True)
+    filtered = low_pass_filter(trial, 75, sos=True)
+    for c in get_step_columns(trial, 9):
+        expected = scipy.signal.sosfiltfilt(sos, trial[c].to_numpy())
+        np.testing.assert_allclose(filtered[c], expected, rtol=1e-10, atol=1e-10)
@@ -0,0 +1,110 @@
+import re
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from birdshot.io.load import load_gt_spreadcheet
+
+openpyxl = pytest.importorskip("openpyxl")
+
+ROWS = [
+    ("Scotopic (rod function) ", "b-wave", "OD", "amp"),
+    (None, None, None, "time"),
+    (None, None, "OS ", "amp"),
+    (None, None, None, "time"),
+    ("Scotopic (rod-cone function)", "a-wave", "OD", "amp"),
+    (None, None, None, "time"),
+    ("Photopic Flicker30HZ (cone function)", "b-wave", "OD", "amp"),
+    (None, None, None, "amp"),
+]
+
+
+def write_gt_workbook(filepath, patients=3, seed=0):
+    """
+    Ground truth workbook as exported by the clinic: a summary sheet, then one sheet per patient
+    with its name, the column names, 5 skipped rows and the values
+    """
+    rng = np.random.default_rng(seed)
+    workbook = openpyxl.Workbook()
+    workbook.active.title = "Summary"
+    for p in range(1, patients + 1):
+        sheet = workbook.create_sheet(f"P{p}")
+        sheet.append([None, f"Patient {p}"])
+        # Unnamed and duplicated columns are renamed as pd.read_excel does
+        sheet.append(["Technique", "Wave", "Laterality", "Data type", 2015, 2016, None, 2016])
+        for j in range(4):
+            sheet.append(["junk", None, None, None, j])
+        sheet.append([None] * 6)
+        for i, row in enumerate(ROWS):
+            values = [float(np.round(rng.normal(100, 20), 2)) for _ in range(4)]
+            if i == 1:
+                values[1] = "n/a"
+            elif i == 2:
+                values[0] = "NA"
+            elif i == 3:
+                values[1] = "NR"
+            elif i == 5:
+                values[0] = None
+            sheet.append(list(row) + values)
+            if i == 4:
+                sheet.append([None] * 6)
+        sheet.append([None] * 6)
+    workbook.save(filepath)
+    return filepath
+
+
+def read_gt_with_pandas(filepath):
+    """Reference: the ground truth read with pd.read_excel, two reads per sheet"""
+    excel = pd.ExcelFile(filepath)
+    patients = dict()
+    for sheet in excel.sheet_names[1:]:
+        name = pd.read_excel(excel, sheet_name=sheet, header=None).loc[0, 1]
+        df = pd.read_excel(excel, sheet_name=sheet, header=1)
+        df = df.loc[np.arange(len(df)) >= 5]
+        data = df[df.columns[4:]].dropna(how="all", axis=1)
+        index = df[df.columns[:4]].ffill().values
+        index = np.array([list(map(str.strip, row)) for row in index])
+        data.index = pd.MultiIndex.from_arrays(
+            index.transpose(), names=["Technique", "Wave", "Laterality", "Data type"]
+        )
+        patients[int(name.split("Patient ")[1])] = data
+    return patients
+
+
+@pytest.fixture(scope="module")
+def workbook(tmp_path_factory):
+    return write_gt_workbook(tmp_path_factory.mktemp("gt") / "gt.xlsx")
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_load_gt_matches_pandas(workbook, max_workers):
+    expected = read_gt_with_pandas(workbook)
+    result = load_gt_spreadcheet(workbook, max_workers=max_workers, use_cache=False)
+    assert list(result) == list(expected) == [1, 2, 3]
+    for patient, data in expected.items():
+        assert list(result[patient].columns) == [2015, 2016, "Unnamed: 6", "2016.1"]
+        pd.testing.assert_frame_equal(result[patient], data)
+
+
+def test_load_gt_wrong_dimensions(workbook, tmp_path):
+    # The dimensions written by some tools do not cover the whole sheet
+    filepath = tmp_path / "gt.xlsx"
+    with zipfile.ZipFile(workbook) as source, zipfile.ZipFile(filepath, "w") as target:
+        for item in source.infolist():
+            content = source.read(item.filename)
+            if item.filename.startswith("xl/worksheets/"):
+                content = re.sub(rb'<dimension ref="[^"]*"', b'<dimension ref="A1:B2"', content)
+            target.writestr(item, content)
+    expected = load_gt_spreadcheet(workbook, use_cache=False)
+    result = load_gt_spreadcheet(filepath, use_cache=False)
+    for patient, data in expected.items():
+        pd.testing.assert_frame_equal(result[patient], data)
+
+
+def test_load_gt_cache(workbook):
+    first = load_gt_spreadcheet(workbook)
+    first[1].iloc[0, 0] = -1.0
+    # Callers get their own copy of the cached frames
+    assert load_gt_spreadcheet(workbook)[1].iloc[0, 0] != -1.0
@@ -0,0 +1,60 @@
+import shutil
+
+import pytest
+
+from benchmarks.synthetic import write_synthetic_export, write_synthetic_cohort
+from birdshot.io.files import list_patient_files, list_patients
+from birdshot.io.index import ArchiveIndex
+
+
+def assert_same_listing(index, root):
+    expected = list_patients(root)
+    assert index.list_patients() == expected
+    for patient in expected:
+        assert index.list_patient_files(patient) == list_patient_files(root / patient)
+
+
+def test_listings_match_the_file_system(tmp_path):
+    root = write_synthetic_cohort(tmp_path / "archive", patients=3, visits=2, samples=64)
+    index = ArchiveIndex(root, filepath=tmp_path / "index.json")
+    assert len(index.files) == 18
+    assert_same_listing(index, root)
+
+
+def test_refresh(tmp_path):
+    root = write_synthetic_cohort(tmp_path / "archive", patients=3, visits=2, samples=64)
+    index = ArchiveIndex(root, filepath=tmp_path / "index.json")
+    assert index.refresh() == 0
+
+    # New visit, new patient and removed patient
+    write_synthetic_export(root / "Patient 001" / "P001 (2020.01.10) F30.TXT", "F30", samples=64)
+    shutil.copytree(root / "Patient 002", root / "Patient 004")
+    shutil.rmtree(root / "Patient 003")
+    assert index.refresh() == 1 + 6 + 6
+    assert_same_listing(index, root)
+
+    # Modified in place, the folder mtime does not change
+    filepath = root / "Patient 001" / "P001 (2020.01.10) F30.TXT"
+    write_synthetic_export(filepath, "F30", samples=128)
+    assert index.refresh() == 0
+    assert index.refresh(deep=True) == 1
+    assert index.files["Patient 001/" + filepath.name][3] == filepath.stat().st_size
+
+
+def test_save_load(tmp_path):
+    root = write_synthetic_cohort(tmp_path / "archive", patients=2, visits=1, samples=64)
+    index = ArchiveIndex(root, filepath=tmp_path / "index.json")
+    loaded = ArchiveIndex(root, filepath=tmp_path / "index.json", refresh=False)
+    assert loaded.files == index.files
+    assert loaded.directories == index.directories
+    assert loaded.refresh() == 0
+    assert_same_listing(loaded, root)
+
+    # The index of another archive is ignored
+    other = write_synthetic_cohort(tmp_path / "other", patients=1, visits=1, samples=64)
+    assert ArchiveIndex(other, filepath=tmp_path / "index.json", refresh=False).files == {}
+    # An index that cannot be saved only warns
+    index.filepath = next(root.glob("*/*.TXT")) / "index.json"
+    write_synthetic_export(root / "Patient 001" / "P001 (2020.01.10) F30.TXT", "F30", samples=64)
+    with pytest.warns(UserWarning, match="Could not save the archive index"):
+        index.refresh()
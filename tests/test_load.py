@@ -0,0 +1,63 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic import (
+    MARKERS,
+    PHOTO_STEP,
+    synthetic_traces,
+    write_synthetic_export,
+)
+from birdshot.io.load import extract_markers, get_photo_step_for_patient, load_patient
+from birdshot.io.recording import read_recording
+
+SAMPLES = 512
+SEED = 3
+EYES = {1: "OD", 2: "OS"}
+
+
+@pytest.fixture(params=["Scoto", "F30", "Photo"])
+def export(request, tmp_path):
+    protocol = request.param
+    filepath = tmp_path / f"P001 (2015.02.10) {protocol}.TXT"
+    write_synthetic_export(filepath, protocol, samples=SAMPLES, seed=SEED)
+    return protocol, filepath
+
+
+def test_parser_matches_synthetic_traces(export):
+    protocol, filepath = export
+    df = load_patient(filepath)
+
+    # Same time vector and random draws as write_synthetic_export
+    time = np.linspace(-20, 200 if protocol == "F30" else 250, SAMPLES)
+    traces = synthetic_traces(protocol, time, np.random.default_rng(SEED))
+    assert sorted(c for c in df.columns if c != ("", "Time (ms)")) == sorted(
+        (step, EYES[channel]) for step, channel in traces
+    )
+    # The exports store the time in µs and the traces in nV
+    np.testing.assert_allclose(df[("", "Time (ms)")], time, atol=5e-4)
+    for (step, channel), values in traces.items():
+        np.testing.assert_allclose(df[step, EYES[channel]], values, atol=5e-4)
+
+
+def test_parser_sources_agree(export):
+    _, filepath = export
+    reference = load_patient(filepath)
+    # Same interface as a streamlit UploadedFile
+    uploaded = io.BytesIO(filepath.read_bytes())
+    uploaded.name = filepath.name
+    pd.testing.assert_frame_equal(load_patient(uploaded), reference)
+    pd.testing.assert_frame_equal(load_patient(read_recording(filepath)), reference)
+
+
+def test_photo_step_and_markers(tmp_path):
+    filepath = tmp_path / "P001 (2015.02.10) Photo.TXT"
+    write_synthetic_export(filepath, "Photo", samples=SAMPLES, seed=SEED)
+    recording = read_recording(filepath)
+    assert get_photo_step_for_patient(recording) == PHOTO_STEP
+    markers = extract_markers(recording)
+    for eye in EYES.values():
+        for name, ms in MARKERS:
+            assert float(markers[(PHOTO_STEP, eye, name)].iloc[0]) == ms
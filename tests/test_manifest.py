@@ -0,0 +1,33 @@
+import os
+
+from birdshot.analysis.manifest import AnalysisManifest
+
+PARAMS = {"f30_low_pass": 150}
+
+
+def record(tmp_path, content=b"recording"):
+    filepath = tmp_path / "Patient 001 (2015.02.10) F30.TXT"
+    filepath.write_bytes(content)
+    visit_files = {"Scoto": [], "Photo": [], "F30": [filepath]}
+    manifest = AnalysisManifest(tmp_path / "features.csv.manifest.json")
+    manifest.update("2015-02-10", visit_files, PARAMS, {"F30_OD_amp_0": 1.5})
+    manifest.save()
+    return filepath, visit_files
+
+
+def test_unchanged_visit_is_reused(tmp_path):
+    _, visit_files = record(tmp_path)
+    manifest = AnalysisManifest(tmp_path / "features.csv.manifest.json")
+    assert manifest.get("2015-02-10", visit_files, PARAMS) == {"F30_OD_amp_0": 1.5}
+    assert manifest.get("2015-02-10", visit_files, {"f30_low_pass": 100}) is None
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_racy_rewrite_is_detected(tmp_path):
+    filepath, visit_files = record(tmp_path)
+    # Same size and same mtime, within the mtime granularity of the file system
+    stat = filepath.stat()
+    filepath.write_bytes(b"rewritten")
+    os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    manifest = AnalysisManifest(tmp_path / "features.csv.manifest.json")
+    assert manifest.get("2015-02-10", visit_files, PARAMS) is None
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+import scipy.signal
+
+from birdshot.analysis.filter import low_pass_filter
+from birdshot.analysis.markers import extract_f30_analysis
+from birdshot.io.load import load_patient
+
+
+def reference_f30_peaks(data, time, prominance, delta):
+    """Pairing of the minima and maxima of a trace, one peak at a time (former implementation)"""
+    T = 1 / 30
+    delta = T * delta
+    max_peaks, _ = scipy.signal.find_peaks(data - data.min(), prominence=prominance)
+    min_peaks, _ = scipy.signal.find_peaks(-(data - data.min()), prominence=prominance)
+    max_peaks = max_peaks[np.where(time[max_peaks] > time[min_peaks[0]])]
+    amplitudes = []
+    times = []
+    coords = []
+    for i, min_peak in enumerate(min_peaks):
+        if i >= len(max_peaks):
+            break
+        max_peak = max_peaks[i]
+        time_diff = (1e-3 * (time[max_peak] - time[min_peak])) * 2
+        if (time_diff < T - delta) or (time_diff > T + delta):
+            continue
+        amplitudes.append(data[max_peak] - data[min_peak])
+        times.append(time[max_peak])
+        coords.append((data[min_peak], data[max_peak], time[min_peak], time[max_peak]))
+    return amplitudes, times, coords
+
+
+@pytest.mark.parametrize("filtered", [0, 150])
+@pytest.mark.parametrize("prominance,delta", [(10, 0.4), (5, 0.7), (20, 0.2)])
+def test_f30_pairing_matches_reference(cohort, filtered, prominance, delta):
+    for files in cohort.values():
+        for filepath in files["F30"]:
+            trial = load_patient(filepath)
+            (
+                od_amplitude,
+                os_amplitude,
+                od_time,
+                os_time,
+                od_coords,
+                os_coords,
+            ) = extract_f30_analysis(
+                trial,
+                filtered=filtered,
+                prominance=prominance,
+                delta=delta,
+                return_peaks=True,
+            )
+            if filtered > 0:
+                trial = low_pass_filter(trial, filtered)
+            time = trial[("", "Time (ms)")].to_numpy()
+            for eye, amplitude, peak_time, coords in [
+                ("OD", od_amplitude, od_time, od_coords),
+                ("OS", os_amplitude, os_time, os_coords),
+            ]:
+                expected = reference_f30_peaks(
+                    trial[1, eye].to_numpy(), time, prominance, delta
+                )
+                assert len(expected[0]) > 0
+                np.testing.assert_array_equal(amplitude, expected[0])
+                np.testing.assert_array_equal(peak_time, expected[1])
+                np.testing.assert_array_equal(coords, expected[2])
@@ -0,0 +1,48 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from benchmarks.synthetic import synthetic_traces
+from birdshot.analysis.models import check_parity, load_model
+
+WEIGHTS = Path(__file__).parents[1] / "models" / "GRU_4l_16h.pt"
+# TorchScript runs the same float32 kernels as the eager model
+TORCHSCRIPT_TOLERANCE = 1e-5
+# int8 weights shift the probabilities slightly, on average
+INT8_MEAN_TOLERANCE = 1e-2
+
+
+@pytest.fixture(scope="module")
+def traces():
+    time = np.linspace(-20, 250, 1024)
+    rng = np.random.default_rng(0)
+    return np.stack(list(synthetic_traces("Photo", time, rng).values()))[:16]
+
+
+@pytest.fixture(scope="module")
+def reference():
+    return load_model(backend="eager", filepath=WEIGHTS)
+
+
+def test_default_backend_is_eager():
+    model = load_model(filepath=WEIGHTS)
+    assert isinstance(model, torch.nn.Module)
+    assert not isinstance(model, torch.jit.ScriptModule)
+
+
+def test_torchscript_parity(traces, reference):
+    model = load_model(backend="torchscript", filepath=WEIGHTS)
+    results = check_parity(model, reference=reference, x=traces)
+    assert results["max_proba_error"] <= TORCHSCRIPT_TOLERANCE
+    for marker in ["i", "b", "a"]:
+        assert results[marker] == 1.0
+
+
+@pytest.mark.parametrize("backend", ["eager", "torchscript"])
+def test_int8_parity(traces, reference, backend):
+    model = load_model(backend=backend, quantize=True, filepath=WEIGHTS)
+    results = check_parity(model, reference=reference, x=traces)
+    assert results["mean_proba_error"] <= INT8_MEAN_TOLERANCE
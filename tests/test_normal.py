@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic import write_synthetic_cohort
+from birdshot.analysis.normative import NormativeStats, build_normative_stats
+from birdshot.io.files import list_patients
+from birdshot.io.normal import (
+    build_normal_database,
+    load_normal_database,
+    save_normal_database,
+)
+
+CONTROLS = ["Control 001 (F) 35yrs", "Control 002 (M) 52yrs"]
+
+
+@pytest.fixture(scope="module")
+def controls(tmp_path_factory):
+    """Synthetic control subjects, the Photo file of the last visit of the second one is missing"""
+    root = write_synthetic_cohort(tmp_path_factory.mktemp("controls"), patients=2, visits=2)
+    for p, name in enumerate(CONTROLS, start=1):
+        (root / f"Patient {p:03d}").rename(root / name)
+    data = list_patients(root)
+    data[CONTROLS[1]]["Photo"][-1].unlink()
+    return list_patients(root)
+
+
+@pytest.fixture(scope="module")
+def database(controls):
+    return build_normal_database(controls, max_workers=1, verbose=False)
+
+
+def test_build_normal_database(controls, database):
+    results, skipped = database
+    assert [(r.patient, r.index, r.age, r.sex) for r in results] == [
+        ("001", 0, 35, "F"),
+        ("001", 1, 35, "F"),
+        ("002", 0, 52, "M"),
+    ]
+    assert skipped[["patient", "index"]].values.tolist() == [[CONTROLS[1], 1]]
+    assert skipped["error"][0].startswith("IndexError")
+    # The traces are filtered, the photopic trial has flat OD, OS and time columns
+    assert (9, "OD") in results[0].scoto.columns
+    assert (1, "OS") in results[0].f30.columns
+    assert list(results[0].photo.columns) == ["OD", "OS", "Time (ms)"]
+
+    parallel, parallel_skipped = build_normal_database(controls, max_workers=2, verbose=False)
+    assert [(r.patient, r.index) for r in parallel] == [(r.patient, r.index) for r in results]
+    pd.testing.assert_frame_equal(parallel_skipped, skipped)
+
+
+def test_normal_database_round_trip(tmp_path, database):
+    results, _ = database
+    filepath = tmp_path / "normal_database.npz"
+    save_normal_database(results, filepath)
+    assert [f.name for f in tmp_path.iterdir()] == ["normal_database.npz"]
+
+    loaded = load_normal_database(filepath)
+    assert [(r.patient, r.index, r.age, r.sex) for r in loaded] == [
+        (r.patient, r.index, r.age, r.sex) for r in results
+    ]
+    for expected, result in zip(results, loaded):
+        for protocol in ["scoto", "f30", "photo"]:
+            # The traces are stored as float32
+            pd.testing.assert_frame_equal(
+                getattr(result, protocol),
+                getattr(expected, protocol),
+                check_names=False,
+                check_column_type=False,
+                rtol=1e-5,
+                atol=1e-3,
+            )
+
+
+def test_normative_stats_round_trip(tmp_path, database):
+    stats = build_normative_stats(database[0])
+    filepath = tmp_path / "normative_stats.npz"
+    stats.save(filepath)
+    assert [f.name for f in tmp_path.iterdir()] == ["normative_stats.npz"]
+
+    loaded = NormativeStats.load(filepath)
+    assert loaded.keys == stats.keys
+    for protocol, step in [("Scoto", 9), ("F30", 1), ("Photo", None)]:
+        expected = stats.lookup(protocol, step, "OD", age=35, sex="F", min_count=1)
+        band = loaded.lookup(protocol, step, "OD", age=35, sex="F", min_count=1)
+        np.testing.assert_array_equal(band.mean, expected.mean)
+        np.testing.assert_array_equal(band.std, expected.std)
+        assert band.count == expected.count
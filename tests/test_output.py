@@ -0,0 +1,91 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from birdshot.io.output import INDEX_NAMES, features_to_long, open_feature_writer
+
+
+def make_features(offset=0.0):
+    """Features of a patient as returned by ERGFeatureExtractor.format_results"""
+    index = pd.MultiIndex.from_tuples(
+        [
+            ("Photopic Flicker30HZ (cone function)", "b-wave", "OD", "amp"),
+            ("Photopic Flicker30HZ (cone function)", "b-wave", "OD", "amp"),
+            ("Scotopic (rod function)", "b-wave", "OS", "time"),
+        ],
+        names=INDEX_NAMES,
+    )
+    dates = [datetime.date(2015, 2, 10), datetime.date(2016, 2, 11)]
+    values = np.array([[1.5, 2.5], [3.0, np.nan], [40.0, 41.0]]) + offset
+    return pd.DataFrame(values, index=index, columns=dates)
+
+
+def test_features_to_long():
+    long = features_to_long("Patient 001", make_features())
+    assert list(long.columns) == ["Patient"] + INDEX_NAMES + ["Peak", "Date", "Value"]
+    # The missing value is dropped, the repeated F30 rows are numbered
+    assert len(long) == 5
+    assert long["Peak"].tolist() == [0, 1, 0, 0, 0]
+    dates = [pd.Timestamp("2015-02-10")] * 3 + [pd.Timestamp("2016-02-11")] * 2
+    assert long["Date"].tolist() == dates
+    assert long["Value"].tolist() == [1.5, 3.0, 40.0, 2.5, 41.0]
+    assert (long["Patient"] == "Patient 001").all()
+
+
+def expected_long(patients):
+    return pd.concat(
+        [features_to_long(patient, data) for patient, data in patients.items()], ignore_index=True
+    )
+
+
+PATIENTS = {"Patient 001": make_features(), "Patient 002": make_features(offset=10.0)}
+
+
+def test_csv_round_trip(tmp_path):
+    filepath = tmp_path / "features.csv"
+    with open_feature_writer(filepath) as writer:
+        for patient, data in PATIENTS.items():
+            writer.write(patient, data)
+    result = pd.read_csv(filepath, parse_dates=["Date"])
+    pd.testing.assert_frame_equal(result, expected_long(PATIENTS), check_dtype=False)
+
+
+def test_csv_append(tmp_path):
+    filepath = tmp_path / "features.csv"
+    for patient, data in PATIENTS.items():
+        with open_feature_writer(filepath, append=True) as writer:
+            writer.write(patient, data)
+    result = pd.read_csv(filepath, parse_dates=["Date"])
+    pd.testing.assert_frame_equal(result, expected_long(PATIENTS), check_dtype=False)
+
+
+def test_parquet_round_trip(tmp_path):
+    pytest.importorskip("pyarrow")
+    filepath = tmp_path / "features.parquet"
+    with open_feature_writer(filepath) as writer:
+        for patient, data in PATIENTS.items():
+            writer.write(patient, data)
+    assert sorted(f.name for f in filepath.iterdir()) == [
+        "part-00000.parquet",
+        "part-00001.parquet",
+    ]
+    result = pd.read_parquet(filepath).sort_values(["Patient", "Date"], kind="stable")
+    expected = expected_long(PATIENTS).sort_values(["Patient", "Date"], kind="stable")
+    pd.testing.assert_frame_equal(
+        result.reset_index(drop=True), expected.reset_index(drop=True), check_dtype=False
+    )
+
+
+def test_excel_round_trip(tmp_path):
+    filepath = tmp_path / "features.xlsx"
+    with open_feature_writer(filepath) as writer:
+        for patient, data in PATIENTS.items():
+            writer.write(patient, data)
+    sheets = pd.read_excel(filepath, sheet_name=None, index_col=[0, 1, 2, 3])
+    assert list(sheets) == list(PATIENTS)
+    for patient, data in PATIENTS.items():
+        assert sheets[patient].index.equals(data.index)
+        assert sheets[patient].columns.tolist() == ["2015/02/10", "2016/02/11"]
+        np.testing.assert_array_equal(sheets[patient].to_numpy(), data.to_numpy())
@@ -0,0 +1,207 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from birdshot.analysis.results import (
+    F30,
+    INDEX_NAMES,
+    SCOTO_ROD,
+    SCOTO_ROD_CONE,
+    compute_scores,
+    extract_f30_score,
+    extract_scoto_cone_rod_score,
+    extract_scoto_rod_score,
+    match_results,
+)
+
+pytestmark = pytest.mark.filterwarnings("ignore::pandas.errors.PerformanceWarning")
+
+# Reference implementations: the per-patient, per-visit loops the vectorized scoring replaced
+
+
+def reference_rod_score(gt, pred):
+    results = {"amp pred": [], "time pred": [], "amp gt": [], "time gt": []}
+    for patient in set(gt).intersection(pred):
+        df_gt, df_pred = gt[patient], pred[patient]
+        for date in df_pred.columns:
+            if date.year not in df_gt.columns:
+                continue
+            for laterality in ["OD", "OS"]:
+                for data_type in ["amp", "time"]:
+                    key = (SCOTO_ROD, "b-wave", laterality, data_type)
+                    val_pred = df_pred.loc[key].squeeze()[date]
+                    val_gt = df_gt.loc[key].squeeze()[date.year]
+                    if np.isnan(val_pred) or np.isnan(val_gt):
+                        continue
+                    results[f"{data_type} pred"].append(val_pred)
+                    results[f"{data_type} gt"].append(val_gt)
+    # The amplitudes and times may have a different number of values
+    return pd.DataFrame({k: pd.Series(v, dtype=float) for k, v in results.items()})
+
+
+def reference_rod_cone_score(gt, pred):
+    cols = ["amp b-wave", "amp a-wave", "time b-wave", "time a-wave"]
+    results = {f"{col} {c}": [] for c in ["gt", "pred"] for col in cols}
+    for patient in set(gt).intersection(pred):
+        df_gt, df_pred = gt[patient], pred[patient]
+        for date in df_pred.columns:
+            if date.year not in df_gt.columns:
+                continue
+            for wave in ["b-wave", "a-wave"]:
+                for laterality in ["OD", "OS"]:
+                    for data_type in ["amp", "time"]:
+                        key = (SCOTO_ROD_CONE, wave, laterality, data_type)
+                        val_pred = df_pred.loc[key].squeeze()[date]
+                        val_gt = df_gt.loc[key].squeeze()[date.year]
+                        if not isinstance(val_pred, (int, float)):
+                            continue
+                        if not isinstance(val_gt, (int, float)):
+                            continue
+                        if np.isnan(val_pred) or np.isnan(val_gt):
+                            continue
+                        results[f"{data_type} {wave} pred"].append(val_pred)
+                        results[f"{data_type} {wave} gt"].append(val_gt)
+    return results
+
+
+def reference_f30_score(gt, pred):
+    results = {"F30 amp pred": [], "F30 amp gt": []}
+    for patient in set(gt).intersection(pred):
+        df_gt, df_pred = gt[patient], pred[patient]
+        for date in df_pred.columns:
+            if date.year not in df_gt.columns:
+                continue
+            for laterality in ["OD", "OS"]:
+                val_pred = df_pred.loc[(F30, "b-wave", laterality)].squeeze()[date]
+                val_gt = df_gt.loc[(F30, "b-wave", laterality)].squeeze()[date.year]
+                val_pred = val_pred[["amp" in c for c in val_pred.index]].mean()
+                val_gt = val_gt[["amp" in c for c in val_gt.index]].mean()
+                if np.isnan(val_pred) or np.isnan(val_gt):
+                    continue
+                results["F30 amp pred"].append(val_pred)
+                results["F30 amp gt"].append(val_gt)
+    return pd.DataFrame(results)
+
+
+def make_index(f30_types):
+    rows = [(F30, "b-wave", lat, data_type) for lat in ["OD", "OS"] for data_type in f30_types]
+    rows += [(SCOTO_ROD, "b-wave", lat, d) for lat in ["OD", "OS"] for d in ["amp", "time"]]
+    rows += [
+        (SCOTO_ROD_CONE, wave, lat, d)
+        for wave in ["b-wave", "a-wave"]
+        for lat in ["OD", "OS"]
+        for d in ["amp", "time"]
+    ]
+    return pd.MultiIndex.from_tuples(rows, names=INDEX_NAMES)
+
+
+@pytest.fixture(scope="module")
+def data():
+    """
+    Synthetic ground truth (one column per year) and predictions (one column per visit date, one
+    F30 row per peak as in ERGFeatureExtractor.format_results)
+    """
+    rng = np.random.default_rng(0)
+    visits = {
+        # Two visits the same year, both matched with the ground truth of that year
+        1: [datetime.date(2015, 2, 10), datetime.date(2015, 9, 1), datetime.date(2016, 3, 4)],
+        # The last visit has no ground truth for its year
+        2: [datetime.date(2015, 5, 6), datetime.date(2018, 5, 6)],
+        3: [datetime.date(2017, 1, 2), datetime.date(2019, 1, 3)],
+        # No ground truth at all
+        4: [datetime.date(2016, 1, 1)],
+    }
+    pred = dict()
+    gt = dict()
+    for patient, dates in visits.items():
+        index = make_index(["amp", "time"] * 3)
+        values = rng.normal(50, 20, (len(index), len(dates)))
+        values[rng.random(values.shape) < 0.1] = np.nan
+        pred[patient] = pd.DataFrame(values, index=index, columns=dates)
+        if patient == 4:
+            continue
+        # Years without visit do not matter, every sheet has several years
+        years = sorted({d.year for d in dates} - {2018} | {2020})
+        index = make_index(["amp", "time"])
+        values = rng.normal(50, 20, (len(index), len(years))).astype(object)
+        values[rng.random(values.shape) < 0.1] = np.nan
+        # Unparsed cells of the rod-cone rows
+        values[-1, 0] = "NR"
+        gt[patient] = pd.DataFrame(values, index=index, columns=years)
+    return gt, pred
+
+
+def assert_same_pairs(result, expected, names):
+    """The matched (pred, gt) pairs are the same, in any order"""
+    pairs = [
+        sorted(p for p in zip(*[r[name] for name in names]) if not np.isnan(p).any())
+        for r in (result, expected)
+    ]
+    assert len(pairs[0]) == len(pairs[1]) > 0
+    np.testing.assert_allclose(np.asarray(pairs[0], dtype=float), np.asarray(pairs[1], dtype=float))
+
+
+def test_rod_score_matches_reference(data):
+    gt, pred = data
+    expected = reference_rod_score(gt, pred)
+    result = extract_scoto_rod_score(gt, pred)
+    assert list(result.columns) == list(expected.columns)
+    for names in [["amp pred", "amp gt"], ["time pred", "time gt"]]:
+        assert_same_pairs(result, expected, names)
+
+
+def test_rod_cone_score_matches_reference(data):
+    gt, pred = data
+    expected = reference_rod_cone_score(gt, pred)
+    result = extract_scoto_cone_rod_score(gt, pred)
+    assert list(result) == list(expected)
+    for name in ["amp b-wave", "amp a-wave", "time b-wave", "time a-wave"]:
+        names = [f"{name} pred", f"{name} gt"]
+        assert_same_pairs(result, expected, names)
+
+
+def test_f30_score_matches_reference(data):
+    gt, pred = data
+    expected = reference_f30_score(gt, pred)
+    result = extract_f30_score(gt, pred)
+    assert_same_pairs(result, expected, ["F30 amp pred", "F30 amp gt"])
+
+
+def test_match_results(data, capsys):
+    gt, pred = data
+    matched = match_results(gt, pred)
+    # The visits of 2015 of patient 1 are both matched with the ground truth of 2015
+    rows = matched[(matched["patient"] == 1) & (matched["Technique"] == SCOTO_ROD)]
+    assert sorted(rows["visit"].unique()) == [
+        datetime.date(2015, 2, 10),
+        datetime.date(2015, 9, 1),
+        datetime.date(2016, 3, 4),
+    ]
+    assert set(matched["patient"]) == {1, 2, 3}
+    assert 2018 not in matched["year"].values
+    assert "Year 2018 not in gt of patient 2" in capsys.readouterr().out
+    np.testing.assert_allclose(matched["difference"], matched["pred"] - matched["gt"])
+    np.testing.assert_allclose(matched["mean"], (matched["pred"] + matched["gt"]) / 2)
+
+
+def test_compute_scores(data):
+    gt, pred = data
+    matched = match_results(gt, pred, verbose=False)
+    scores = compute_scores(matched)
+    for (technique, wave, data_type), row in scores.iterrows():
+        group = matched[
+            (matched["Technique"] == technique)
+            & (matched["Wave"] == wave)
+            & (matched["Data type"] == data_type)
+        ]
+        y, y_pred = group["gt"].to_numpy(), group["pred"].to_numpy()
+        difference = y_pred - y
+        r2 = 1 - np.sum(difference**2) / np.sum((y - y.mean()) ** 2)
+        assert row["n"] == len(group)
+        assert row["r2"] == pytest.approx(r2)
+        assert row["mae"] == pytest.approx(np.abs(difference).mean())
+        assert row["bias"] == pytest.approx(difference.mean())
+        assert row["sd"] == pytest.approx(difference.std(ddof=1))
+        assert row["loa_high"] == pytest.approx(difference.mean() + 1.96 * difference.std(ddof=1))
@@ -0,0 +1,73 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import MARKERS
+from birdshot.io.training import (
+    MISSING,
+    PatientsData,
+    get_patients_photopic_trainable_data,
+)
+
+
+def make_patients():
+    patients = PatientsData(capacity=1)
+    patients.time = np.arange(-20.0, 80.0, 10.0)
+    date = datetime.date(2015, 2, 10)
+    patients.append(1, np.arange(10), "OS", date, 0, i=60, b=30, a=10)
+    patients.append(1, np.arange(10) + 1, "OD", date, 0, i=60, b=None, a=-20)
+    patients.append(2, np.arange(10) + 2, "OS", datetime.date(2016, 2, 11), 1)
+    return patients
+
+
+def test_get_xy():
+    patients = make_patients()
+    x, y = patients.get_xy()
+    np.testing.assert_array_equal(x, np.arange(10) + np.arange(3)[:, None])
+    # Sample index of the markers: 1 for i, 2 for b, 3 for a
+    expected = np.zeros((3, 10))
+    expected[0, [8, 5, 3]] = [1, 2, 3]
+    expected[1, [8, 0]] = [1, 3]
+    np.testing.assert_array_equal(y, expected)
+
+    x, y = patients.get_xy("b")
+    np.testing.assert_array_equal(y, [30, MISSING, MISSING])
+    assert patients[1]["lat"] == "OD"
+    assert patients[1]["a"] == -20
+
+
+def test_save_load_round_trip(tmp_path):
+    patients = make_patients()
+    patients.save(tmp_path / "patients.npz")
+    loaded = PatientsData.load(tmp_path / "patients.npz")
+    assert len(loaded) == len(patients)
+    np.testing.assert_array_equal(loaded.time, patients.time)
+    for key in ["data", "ids", "index", "lat", "date", "markers"]:
+        np.testing.assert_array_equal(loaded[key], patients[key])
+    # The loaded samples can still grow
+    loaded.append(3, np.zeros(10), "OD", datetime.date(2017, 1, 1), 0)
+    assert len(loaded) == 4
+
+
+def test_truncate():
+    patients = make_patients()
+    patients.truncate(1)
+    assert len(patients) == 1
+    assert patients.ids.tolist() == [1]
+    with pytest.raises(ValueError):
+        patients.truncate(2)
+
+
+def test_photopic_trainable_data(cohort):
+    root = next(iter(cohort.values()))["Photo"][0].parents[1]
+    patients, errors = get_patients_photopic_trainable_data(root, max_workers=1, verbose=False)
+    assert errors.empty
+    # Both eyes of the 2 visits of the 3 patients
+    assert patients.ids.tolist() == [1, 1, 1, 1, 2, 2, 2, 2, 3, 3, 3, 3]
+    assert patients.lat.tolist() == ["OS", "OD"] * 6
+    assert patients.data.shape == (12, len(patients.time))
+    expected = dict(MARKERS)
+    assert (patients.i == expected["i"]).all()
+    assert (patients.b == expected["b"]).all()
+    assert (patients.a == expected["a"]).all()
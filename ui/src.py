@@ -1,6 +1,7 @@
 import streamlit as st
 import pandas as pd
-from birdshot.io.files import list_patients
+from birdshot.io.index import ArchiveIndex
+from birdshot.analysis.normative import get_normative_stats
 from birdshot.io.utils import extract_visit_date_from_filepath
 from ui.utils.builder import (
     build_export_tab,
@@ -32,9 +33,26 @@ warnings.simplefilter(
 patientsFiles = None
 
 
-@st.cache_data
+@st.cache_resource
+def get_archive_index(inputPath):
+    # The index is kept up to date by its watcher, new files show up without clearing the cache
+    index = ArchiveIndex(inputPath)
+    index.watch()
+    return index
+
+
+@st.cache_resource
+def get_normal_data():
+    # Loaded once for all the sessions, the charts only look the bands up
+    return get_normative_stats()
+
+
 def start(inputPath):
-    return list_patients(inputPath)
+    # Watch events are not delivered from network shares (SMB, NFS), only the patient folders
+    # whose mtime changed are rescanned
+    index = get_archive_index(inputPath)
+    index.refresh()
+    return index.list_patients()
 
 
 def init_params():
@@ -71,16 +89,19 @@ def main():
                     extract_visit_date_from_filepath(visit).strftime("%Y/%m/%d")
                     for visit in filepath
                 ]
+                normal_data = get_normal_data()
                 tabs = st.tabs(["Visits", "Progression"])
                 with tabs[0]:
                     build_plot_tab(
                         visits,
                         filepath,
+                        normal_data=normal_data,
                     )
                 with tabs[1]:
                     build_progression_tab(
                         visits,
                         filepath,
+                        normal_data=normal_data,
                     )
         else:
             st.write("No patients found")
@@ -7,14 +7,15 @@ from birdshot.analysis.markers import (
     extract_scoto_rod_cone_analysis,
     extract_photo_analysis,
 )
-from birdshot.utils.st_chart import add_fill_between
+from birdshot.utils.st_chart import add_fill_between, add_line
+from birdshot.analysis.normative import NormativeStats, normal_band
+from birdshot.analysis.alignment import estimate_lag
 from warnings import warn
 import pandas as pd
 import plotly.graph_objects as go
 from pickle import load
 import numpy as np
 
-from scipy import signal
 import streamlit as st
 from utils.colors import get_std_colors
 
@@ -26,8 +27,10 @@ line_dict = dict(
 
 def plot_photo(
     data,
-    normal_data,
+    normal_data: NormativeStats | list,
     extract_markers=False,
+    age=None,
+    sex=None,
 ):
     time = data["Time (ms)"]
     labels = ["a", "b", "i"]
@@ -37,16 +40,8 @@ def plot_photo(
 
     col1, col2 = st.columns(2)
     for laterality, col in zip(["OD", "OS"], [col1, col2]):
-        normal_values = np.asarray(
-            [
-                r[laterality].values
-                for r in normal_data
-                if len(r[laterality].values) == len(data[laterality])
-            ]
-        )
-
-        mean_normal = np.mean(normal_values, axis=0)
-        std_normal = np.std(normal_values, axis=0)
+        band = normal_band(normal_data, "Photo", None, laterality, time, age, sex)
+        mean_normal, std_normal = band.mean, band.std
         fig = go.Figure()
 
         colors = get_std_colors()
@@ -60,9 +55,7 @@ def plot_photo(
                 color=color,
             )
 
-        fig.add_trace(
-            go.Line(x=time, y=data[laterality], name=laterality, line=line_dict)
-        )
+        add_line(fig, time, data[laterality], name=laterality, line=line_dict)
 
         fig.update_yaxes(range=[-150, 150])
         if extract_markers and markers is not None:
@@ -82,12 +75,14 @@ def plot_photo(
 
 def plot_F30(
     data,
-    normal_data,
+    normal_data: NormativeStats | list,
     extract_markers=False,
     prominance=5,
     delta=0.7,
     filtered=180,
     align_with_normal=True,
+    age=None,
+    sex=None,
 ):
     col1, col2 = st.columns(2)
     od_marker = None
@@ -115,19 +110,15 @@ def plot_F30(
     for laterality, col, marker in zip(
         ["OD", "OS"], [col1, col2], [od_marker, os_marker]
     ):
-        normal_values = np.asarray([r[1, laterality].values for r in normal_data])
-        mean_normal = np.mean(normal_values, axis=0)
-        std_normal = np.std(normal_values, axis=0)
+        band = normal_band(
+            normal_data, "F30", 1, laterality, data[("", "Time (ms)")], age, sex
+        )
+        mean_normal, std_normal = band.mean, band.std
         if align_with_normal:
             # Find delay between normal and filtered data by cross-correlation
-            corr = signal.correlate(mean_normal, data[1, laterality], mode="full")
-            lag = np.argmax(corr) - (len(mean_normal) - 1)
-
-            # Find TE (1/Fe)
-            te = data[("", "Time (ms)")][1] - data[("", "Time (ms)")][0]
-
-            # Convert lag to time
-            lag = lag * te
+            lag = estimate_lag(
+                mean_normal, data[1, laterality].to_numpy(), data[("", "Time (ms)")]
+            )
         else:
             lag = 0
 
@@ -145,25 +136,23 @@ def plot_F30(
                 color=color,
             )
 
-        fig.add_trace(
-            go.Line(
-                x=data[("", "Time (ms)")],
-                y=data[1, laterality],
-                name=laterality,
-                line=line_dict,
-            )
+        add_line(
+            fig,
+            data[("", "Time (ms)")],
+            data[1, laterality],
+            name=laterality,
+            line=line_dict,
         )
 
         # set y axis to -150 150
         fig.update_yaxes(range=[-150, 150])
         if extract_markers and marker is not None:
-            fig.add_trace(
-                go.Line(
-                    x=filtered_data[("", "Time (ms)")],
-                    y=filtered_data[1, laterality],
-                    name="Filtered",
-                    line=dict(color="red", width=1),
-                )
+            add_line(
+                fig,
+                filtered_data[("", "Time (ms)")],
+                filtered_data[1, laterality],
+                name="Filtered",
+                line=dict(color="red", width=1),
             )
             for peak in marker:
                 ymin, ymax, xmin, xmax = tuple(peak)
@@ -185,13 +174,15 @@ def plot_F30(
 
 def plot_scoto(
     data,
-    normal_data,
+    normal_data: NormativeStats | list,
     extract_markers=False,
     rodOnly=True,
     scotorodcone_low_pass=75,
     scotorodcone_time_limits=(10, 60),
     scotorod_low_pass=75,
     scotorod_time_limits=(10, 125),
+    age=None,
+    sex=None,
 ):
     if rodOnly:
         step = 9
@@ -252,11 +243,10 @@ def plot_scoto(
     for laterality, col, marker in zip(
         ["OD", "OS"], [col1, col2], [od_markers, os_markers]
     ):
-        normal_values = [
-            r[(step, laterality)] for r in normal_data if len(r) == len(data)
-        ]
-        mean_normal = np.mean(normal_values, axis=0)
-        std_normal = np.std(normal_values, axis=0)
+        band = normal_band(
+            normal_data, "Scoto", step, laterality, data[("", "Time (ms)")], age, sex
+        )
+        mean_normal, std_normal = band.mean, band.std
         fig = go.Figure()
         colors = get_std_colors()
         for std_mult, color in colors.items():
@@ -269,23 +259,21 @@ def plot_scoto(
                 color=color,
             )
 
-        fig.add_trace(
-            go.Line(
-                x=data[("", "Time (ms)")],
-                y=data[step, laterality],
-                name=laterality,
-                line=line_dict,
-            )
+        add_line(
+            fig,
+            data[("", "Time (ms)")],
+            data[step, laterality],
+            name=laterality,
+            line=line_dict,
         )
 
         if extract_markers and marker is not None:
-            fig.add_trace(
-                go.Line(
-                    x=filtered[("", "Time (ms)")],
-                    y=filtered[step, laterality],
-                    name="Filtered",
-                    line=dict(color="red", width=1),
-                )
+            add_line(
+                fig,
+                filtered[("", "Time (ms)")],
+                filtered[step, laterality],
+                name="Filtered",
+                line=dict(color="red", width=1),
             )
             fig.add_hline(
                 y=baseline[(step, laterality)],
@@ -9,16 +9,60 @@ from birdshot.analysis.markers import (
     extract_baseline_value,
     extract_scoto_rod_cone_analysis,
 )
-from birdshot.utils.st_chart import add_fill_between
+from birdshot.utils.st_chart import add_fill_between, add_line, MAX_POINTS
+from birdshot.analysis.normative import NormativeStats, normal_band
 
 from utils.colors import get_std_colors
 
 
-def plot_f30_progression(data, normal_data, f30_low_pass, f30_prominance, f30_delta):
+def visit_offsets(data, spacing):
+    """x offsets placing the visits side by side, spacing times the duration of a visit apart"""
+    offsets = []
+    xoffset = 0
+    for visit in data:
+        x = data[visit][("", "Time (ms)")]
+        offsets.append(xoffset)
+        xoffset += (x.max() - x.min()) * spacing
+    return offsets
+
+
+def add_visit_bands(
+    fig, data, normal_data, protocol, step, laterality, offsets, age=None, sex=None
+):
+    """
+    Add the normal bands behind the visits placed side by side at offsets.
+    The band is computed once per distinct time vector, and sent once for all the visits sharing it.
+    """
+    groups = dict()
+    for visit, offset in zip(data, offsets):
+        x = data[visit][("", "Time (ms)")].to_numpy(dtype=float)
+        groups.setdefault(x.tobytes(), (x, []))[1].append(offset)
+    colors = get_std_colors()
+    for x, group_offsets in groups.values():
+        band = normal_band(normal_data, protocol, step, laterality, x, age, sex)
+        for std_mult, color in colors.items():
+            add_fill_between(
+                fig,
+                band.mean,
+                band.std,
+                time=x,
+                std_mult=std_mult,
+                color=color,
+                showlegend=False,
+                offsets=group_offsets,
+            )
+
+
+def plot_f30_progression(
+    data,
+    normal_data: NormativeStats | list,
+    f30_low_pass,
+    f30_prominance,
+    f30_delta,
+):
     meanAmplitudes = dict(OS=dict(), OD=dict())
     stdAmplitudes = dict(OS=dict(), OD=dict())
     for visit in data:
-        x = data[visit][("", "Time (ms)")]
         try:
             od_peaks_amplitude, os_peaks_amplitude, od_peaks_time, os_peaks_time = (
                 extract_f30_analysis(
@@ -42,16 +86,16 @@ def plot_f30_progression(data, normal_data, f30_low_pass, f30_prominance, f30_de
     col1, col2 = st.columns(2)
     for laterality, col in zip(["OD", "OS"], [col1, col2]):
         fig = go.Figure()
-        xoffset = 0
-        for visit in data:
-            fig.add_trace(
-                go.Scatter(
-                    x=x + xoffset,
-                    y=data[visit][1, laterality].values,
-                    name=visit,
-                )
+        offsets = visit_offsets(data, 1.2)
+        for visit, xoffset in zip(data, offsets):
+            # The visits share the width of the chart
+            add_line(
+                fig,
+                data[visit][("", "Time (ms)")] + xoffset,
+                data[visit][1, laterality].values,
+                max_points=MAX_POINTS // len(data),
+                name=visit,
             )
-            xoffset += (x.max() - x.min()) * 1.2
 
         fig.update_yaxes(range=[-150, 150])
         # Set the title of the graph
@@ -80,23 +124,37 @@ def plot_f30_progression(data, normal_data, f30_low_pass, f30_prominance, f30_de
 
 def plot_scoto_rod_progression(
     data,
-    normal_data,
+    normal_data: NormativeStats | list,
     rodOnly=True,
     scotorodcone_low_pass=75,
     scotorodcone_time_limits=(10, 60),
     scotorod_low_pass=75,
     scotorod_time_limits=(10, 125),
+    age=None,
+    sex=None,
 ):
     if rodOnly:
-        plot_scoto_rod(data, normal_data, scotorod_low_pass, scotorod_time_limits)
+        plot_scoto_rod(
+            data, normal_data, scotorod_low_pass, scotorod_time_limits, age, sex
+        )
     else:
         plot_scoto_rodcone(
-            data, normal_data, scotorodcone_low_pass, scotorodcone_time_limits
+            data,
+            normal_data,
+            scotorodcone_low_pass,
+            scotorodcone_time_limits,
+            age,
+            sex,
         )
 
 
 def plot_scoto_rodcone(
-    data, normal_data, scotorodcone_low_pass, scotorodcone_time_limits
+    data,
+    normal_data: NormativeStats | list,
+    scotorodcone_low_pass,
+    scotorodcone_time_limits,
+    age=None,
+    sex=None,
 ):
     amplitudeA = dict(OS=dict(), OD=dict())
     amplitudeB = dict(OS=dict(), OD=dict())
@@ -124,44 +182,21 @@ def plot_scoto_rodcone(
         timeB["OD"][visit] = B_time_od
         timeB["OS"][visit] = B_time_os
 
-    N = len(data[visit])
-
     for laterality, col in zip(["OD", "OS"], [col1, col2]):
-        normal_values = np.asarray(
-            [
-                r[19, laterality].values
-                for r in normal_data
-                if len(r[19, laterality].values) == N
-            ]
-        )
-
-        mean_normal = np.mean(normal_values, axis=0)
-        std_normal = np.std(normal_values, axis=0)
-
         fig = go.Figure()
-        x = data[visit][("", "Time (ms)")]
-        offset = 0
-        colors = get_std_colors()
-        for i, visit in enumerate(data):
-            for std_mult, color in colors.items():
-                add_fill_between(
-                    fig,
-                    mean_normal,
-                    std_normal,
-                    time=x + offset,
-                    std_mult=std_mult,
-                    color=color,
-                    showlegend=False,
-                )
+        offsets = visit_offsets(data, 1.25)
+        add_visit_bands(
+            fig, data, normal_data, "Scoto", 19, laterality, offsets, age, sex
+        )
 
-            fig.add_trace(
-                go.Scatter(
-                    x=x + offset,
-                    y=data[visit][19, laterality].values,
-                    name=visit,
-                )
+        for visit, offset in zip(data, offsets):
+            add_line(
+                fig,
+                data[visit][("", "Time (ms)")] + offset,
+                data[visit][19, laterality].values,
+                max_points=MAX_POINTS // len(data),
+                name=visit,
             )
-            offset += (x.max() - x.min()) * 1.25
 
         fig.update_yaxes(range=[-250, 250])
         fig.update_layout(title=f"Scotopic rod-cone progression {laterality}")
@@ -225,7 +260,14 @@ def plot_scoto_rodcone(
             st.plotly_chart(progress)
 
 
-def plot_scoto_rod(data, normal_data, scotorod_low_pass, scotorod_time_limits):
+def plot_scoto_rod(
+    data,
+    normal_data: NormativeStats | list,
+    scotorod_low_pass,
+    scotorod_time_limits,
+    age=None,
+    sex=None,
+):
     amplitude = dict(OS=dict(), OD=dict())
     time = dict(OS=dict(), OD=dict())
     col1, col2 = st.columns(2)
@@ -244,46 +286,20 @@ def plot_scoto_rod(data, normal_data, scotorod_low_pass, scotorod_time_limits):
         time["OD"][visit] = od_peaks_time
         time["OS"][visit] = os_peaks_time
 
-    N = len(data[visit])
-
     for laterality, col in zip(["OD", "OS"], [col1, col2]):
-        normal_values = np.asarray(
-            [
-                r[9, laterality].values
-                for r in normal_data
-                if len(r[9, laterality].values) == N
-            ]
-        )
-        mean_normal = np.mean(normal_values, axis=0)
-        std_normal = np.std(normal_values, axis=0)
-
         fig = go.Figure()
-        xoffset = 0
-        colors = get_std_colors()
-        for visit in data:
-            x = data[visit][("", "Time (ms)")]
-
-            for std_mult, color in colors.items():
-                add_fill_between(
-                    fig,
-                    mean_normal,
-                    std_normal,
-                    time=x + xoffset,
-                    std_mult=std_mult,
-                    color=color,
-                    showlegend=False,
-                )
+        offsets = visit_offsets(data, 1.5)
+        add_visit_bands(fig, data, normal_data, "Scoto", 9, laterality, offsets, age, sex)
 
-            fig.add_trace(
-                go.Scatter(
-                    x=x + xoffset,
-                    y=data[visit][9, laterality].values,
-                    name=visit,
-                )
+        for visit, xoffset in zip(data, offsets):
+            add_line(
+                fig,
+                data[visit][("", "Time (ms)")] + xoffset,
+                data[visit][9, laterality].values,
+                max_points=MAX_POINTS // len(data),
+                name=visit,
             )
 
-            xoffset += (x.max() - x.min()) * 1.5
-
         fig.update_yaxes(range=[-250, 250])
         fig.update_layout(title=f"Scotopic rod progression {laterality}")
         with col:
@@ -318,52 +334,28 @@ def plot_scoto_rod(data, normal_data, scotorod_low_pass, scotorod_time_limits):
             st.plotly_chart(progress)
 
 
-def plot_photo_progress(data, normal_data, steps):
+def plot_photo_progress(
+    data, normal_data: NormativeStats | list, steps, age=None, sex=None
+):
     col1, col2 = st.columns(2)
 
-    for _, d in data.items():
-        N = len(d)
-        break
-
     for laterality, col in zip(["OD", "OS"], [col1, col2]):
         fig = go.Figure()
-        xoffset = 0
-
-        normal_values = np.asarray(
-            [
-                r[laterality].values
-                for r in normal_data
-                if len(r[laterality].values) == N
-            ]
-        )
+        offsets = visit_offsets(data, 1.5)
 
-        mean_normal = np.mean(normal_values, axis=0)
-        std_normal = np.std(normal_values, axis=0)
-        colors = get_std_colors()
-        for visit, step in zip(data, steps):
-            x = data[visit][("", "Time (ms)")]
-
-            for std_mult, color in colors.items():
-                add_fill_between(
-                    fig,
-                    mean_normal,
-                    std_normal,
-                    time=x + xoffset,
-                    std_mult=std_mult,
-                    color=color,
-                    showlegend=False,
-                )
+        add_visit_bands(
+            fig, data, normal_data, "Photo", None, laterality, offsets, age, sex
+        )
 
-            fig.add_trace(
-                go.Scatter(
-                    x=x + xoffset,
-                    y=data[visit][step, laterality].values,
-                    name=visit,
-                )
+        for visit, step, xoffset in zip(data, steps, offsets):
+            add_line(
+                fig,
+                data[visit][("", "Time (ms)")] + xoffset,
+                data[visit][step, laterality].values,
+                max_points=MAX_POINTS // len(data),
+                name=visit,
             )
 
-            xoffset += (x.max() - x.min()) * 1.5
-
         fig.update_yaxes(range=[-150, 150])
         fig.update_layout(title=f"Photopic progression {laterality}")
         with col: